@@ -0,0 +1,292 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Größen, für die der Benchmark standardmäßig läuft (Anzahl der Zeilen im Kapitalflussbericht)
+DEFAULT_ROWS = [1000, 10000, 100000, 1000000]
+
+# Start von Main.py bis zur gelesenen Konfiguration in Sekunden, ohne dass ein Schritt ausgeführt wird
+STARTUP_BUDGET = 0.5
+STARTUP_REPEATS = 5
+
+# Module, die erst von den Schritten geladen werden sollen, die sie brauchen
+HEAVY_MODULES = ("pandas", "numpy", "openpyxl", "ib_insync", "asyncio")
+
+STARTUP_SCRIPT = """import json, sys, time
+started = time.perf_counter()
+import Main
+from ConfigHandler import ConfigHandler
+config = ConfigHandler()
+config.get_ib_accounts()
+config.get_start_date()
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "modules": [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+ACCOUNTS_CONFIG = """[Import]
+dateiname kapitalflussbericht = {statement}
+excel backup = no
+
+[Dates]
+start_date = 01.01.{year}
+end_date = 31.12.{year}
+
+[Processing]
+parallel accounts = no
+
+[Accounts]
+ib-accounts = {accounts}
+
+[IBAccountMappingToAccounting]
+{mapping}
+
+[IBTransferMapping]
+
+[OpenPositions]
+{open_positions}
+"""
+
+
+def get_peak_memory():
+    ''' Höchster Speicherverbrauch des Prozesses bisher in MB, None wenn das System es nicht unterstützt '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    ''' Misst Laufzeit, CPU-Zeit und den bisherigen Spitzenwert des Speichers je Schritt '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def measure(self, name, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+                stage["calls"] += 1
+                stage["wall"] += time.perf_counter() - wall
+                stage["cpu"] += time.process_time() - cpu
+                stage["peak_memory_mb"] = get_peak_memory()
+        return wrapper
+
+    def patch(self, owner, attribute, name):
+        ''' Ersetzt die Methode durch die gemessene Variante, gibt eine Funktion zum Zurücksetzen zurück '''
+        original = getattr(owner, attribute)
+        setattr(owner, attribute, self.measure(name, original))
+        return lambda: setattr(owner, attribute, original)
+
+
+def measure_startup(repeats=STARTUP_REPEATS):
+    ''' Misst den Start in jeweils einem neuen Prozess, gewertet wird der schnellste Lauf. Zusätzlich werden
+        die Module aus HEAVY_MODULES aufgeführt, die dabei schon geladen wurden. '''
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    fastest = min(runs, key=lambda run: run["seconds"])
+    return {"seconds": round(fastest["seconds"], 4), "repeats": repeats, "heavy_modules": fastest["modules"]}
+
+
+def check_startup(startup, budget):
+    ''' Gibt den Start aus und prüft ihn gegen das Budget, gibt False zurück, wenn es überschritten wird '''
+    print(f"Start bis zur Konfiguration: {startup['seconds']:.3f}s (Budget {budget:.3f}s)")
+    if startup["heavy_modules"]:
+        print(f"  beim Start geladen: {', '.join(startup['heavy_modules'])}")
+    return startup["seconds"] <= budget and not startup["heavy_modules"]
+
+
+def prepare(directory, rows, accounts, symbols, seed, year):
+    ''' Erstellt das Arbeitsverzeichnis mit Kapitalflussbericht, offenen Positionen und configuration.ini '''
+    from src.SyntheticStatement import SyntheticStatement
+
+    for folder in ("import", "export", "working_files"):
+        os.makedirs(os.path.join(directory, folder), exist_ok=True)
+
+    # Main.py liest für jeden Account zuerst das leere Backup der offenen Positionen
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "import", "Backup_OpenPositions.xlsx"),
+                os.path.join(directory, "import"))
+
+    account_ids = ["U%07d" % (index + 1) for index in range(accounts)]
+    statement = SyntheticStatement(account_ids, symbols=symbols, rows=rows, seed=seed, year=year)
+    statement.write_xml(os.path.join(directory, "import", "statement.xml"))
+
+    open_positions = []
+    for account in account_ids:
+        filename = f"OpenPositions_{account}.xlsx"
+        statement.write_open_positions(os.path.join(directory, "import", filename), account)
+        open_positions.append(f"{account.lower()} = {filename}")
+
+    with open(os.path.join(directory, "configuration.ini"), "w") as file:
+        file.write(ACCOUNTS_CONFIG.format(
+            statement="statement.xml", year=year, accounts=", ".join(account_ids),
+            mapping="\n".join(f"{account.lower()} = {1810 + index}" for index, account in enumerate(account_ids)),
+            open_positions="\n".join(open_positions)))
+
+
+def run_scale(rows, accounts, symbols, seed, year, keep=False):
+    ''' Führt den kompletten Ablauf wie in Main.py für eine Größe aus und misst die einzelnen Schritte '''
+    directory = tempfile.mkdtemp(prefix=f"benchmark_{rows}_")
+    started = time.perf_counter()
+    prepare(directory, rows, accounts, symbols, seed, year)
+    generated = time.perf_counter() - started
+
+    working_dir = os.getcwd()
+    os.chdir(directory)
+    try:
+        import pandas as pd
+        from pandas.io.excel._xlsxwriter import XlsxWriter
+
+        from ConfigHandler import ConfigHandler
+        from src.BookingStatementHandler import BookingStatementHandler
+        from src.ExportHandler import ExportHandler
+        from src.ImportHandler import ImportHandler
+        from src.Pipeline import run_pipeline
+
+        timer = StageTimer()
+        restore = [
+            timer.patch(ImportHandler, "import_ib_xml_manual", "import_ib_xml_manual"),
+            timer.patch(ImportHandler, "import_open_positions", "import_open_positions"),
+            timer.patch(BookingStatementHandler, "generate_single_statements", "generate_single_statements"),
+            timer.patch(BookingStatementHandler, "accounting_check", "accounting_check"),
+            timer.patch(ExportHandler, "generate_MSBuchhalter_Import", "msb_export"),
+            timer.patch(pd.DataFrame, "to_excel", "excel_writer"),
+            # pandas 1.4 schreibt die Datei in save, ab pandas 1.5 in _save
+            timer.patch(XlsxWriter, "_save" if "_save" in vars(XlsxWriter) else "save", "excel_writer"),
+        ]
+
+        try:
+            total = time.perf_counter()
+            bookings = run_pipeline(ConfigHandler())
+            total = time.perf_counter() - total
+        finally:
+            for undo in restore:
+                undo()
+    finally:
+        os.chdir(working_dir)
+        if not keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for stage in timer.stages.values():
+        stage["rows_per_second"] = round(rows / stage["wall"]) if stage["wall"] else None
+        stage["wall"] = round(stage["wall"], 4)
+        stage["cpu"] = round(stage["cpu"], 4)
+
+    return {"rows": rows, "accounts": accounts, "symbols": symbols, "generation_seconds": round(generated, 2),
+            "total_seconds": round(total, 4), "rows_per_second": round(rows / total) if total else None,
+            "peak_memory_mb": get_peak_memory(), "stages": timer.stages,
+            "quality_checks": bookings.quality_checks, "directory": directory if keep else None}
+
+
+def get_failed_checks(result):
+    ''' Accounts, deren Qualitätscheck nicht erfolgreich war. Der Lauf misst dann einen Fehlerfall. '''
+    return sorted(account for account, check in result["quality_checks"].items() if check != "erfolgreich")
+
+
+def print_results(results, baseline=None):
+    baseline = {result["rows"]: result for result in (baseline or {}).get("scales", [])}
+
+    for result in results:
+        print(f"\n{result['rows']} Zeilen, {result['accounts']} Accounts, {result['symbols']} Symbole: "
+              f"{result['total_seconds']:.2f}s, {result['rows_per_second']} Zeilen/s, "
+              f"Speicher {result['peak_memory_mb']} MB")
+        failed = get_failed_checks(result)
+        if failed:
+            print(f"  ACHTUNG: Qualitätscheck nicht erfolgreich für {', '.join(failed)}, der Lauf ist nicht gültig")
+        previous = baseline.get(result["rows"], {}).get("stages", {})
+        for name, stage in result["stages"].items():
+            line = f"  {name:<28}{stage['wall']:>10.3f}s wall {stage['cpu']:>10.3f}s cpu " \
+                   f"{stage['rows_per_second'] or 0:>12} Zeilen/s"
+            if name in previous and previous[name]["wall"]:
+                line += f"  x{stage['wall'] / previous[name]['wall']:.2f} gegenüber Baseline"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des Ablaufs mit synthetischen Kapitalflussberichten")
+    parser.add_argument("--rows", default=",".join(str(rows) for rows in DEFAULT_ROWS),
+                        help="Größen als Liste, z.B. 1000,10000")
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--symbols", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--year", type=int, default=2021)
+    parser.add_argument("--output", default="benchmark.json", help="JSON-Datei mit den Ergebnissen")
+    parser.add_argument("--baseline", help="JSON-Datei eines früheren Laufs zum Vergleich")
+    parser.add_argument("--keep", action="store_true", help="Arbeitsverzeichnisse nicht löschen")
+    parser.add_argument("--startup", action="store_true", help="nur den Start von Main.py messen")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET,
+                        help="erlaubte Sekunden für den Start, Standard: %(default)s")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    sizes = [int(rows) for rows in arguments.rows.split(",")]
+
+    if arguments.startup:
+        # Beendet sich mit Fehler, wenn der Start das Budget überschreitet oder schon pandas & Co. lädt
+        if not check_startup(measure_startup(), arguments.startup_budget):
+            sys.exit(1)
+        return
+
+    if arguments.single:
+        # Eine Größe im eigenen Prozess, damit der Spitzenwert des Speichers nur zu dieser Größe gehört
+        result = run_scale(sizes[0], arguments.accounts, arguments.symbols, arguments.seed, arguments.year,
+                           arguments.keep)
+        with open(arguments.output, "w") as file:
+            json.dump(result, file)
+        return
+
+    results = []
+    for rows in sizes:
+        handle, output = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        command = [sys.executable, os.path.abspath(__file__), "--single", "--rows", str(rows),
+                   "--accounts", str(arguments.accounts), "--symbols", str(arguments.symbols),
+                   "--seed", str(arguments.seed), "--year", str(arguments.year), "--output", output]
+        if arguments.keep:
+            command.append("--keep")
+        subprocess.run(command, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.DEVNULL)
+        with open(output) as file:
+            results.append(json.load(file))
+        os.remove(output)
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+
+    print_results(results, baseline)
+    startup = measure_startup()
+    print()
+    check_startup(startup, arguments.startup_budget)
+    report = {"python": platform.python_version(), "platform": platform.platform(), "startup": startup,
+              "scales": results}
+    with open(arguments.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"\nDie Ergebnisse wurden in {arguments.output} gespeichert")
+
+    # Beendet sich mit Fehler, wenn eine Größe die Daten nicht vollständig verbuchen konnte
+    if any(get_failed_checks(result) for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
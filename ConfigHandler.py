@@ -18,11 +18,31 @@ class ConfigHandler:
         with open('configuration.ini', 'w') as configfile:
             config.add_section('Import')
             config.set("Import", "Dateiname Kapitalflussbericht", "Kapitalflussbericht.xml")
+            config.set("Import", "Excel Backup", "no")
+            config.set("Import", "Level Of Detail", "")
+            config.set("Import", "Working Files", "yes")
+
+            config.add_section('Download')
+            config.set("Download", "Token", "")
+            config.set("Download", "Queries", "")
+            config.set("Download", "URL", "")
+            config.set("Download", "Max Concurrent", "4")
 
             config.add_section('Dates')
             config.set("Dates", "start_date", "01.01.2021")
             config.set("Dates", "end_date", "01.01.2021")
 
+            config.add_section('Processing')
+            config.set("Processing", "Parallel Accounts", "no")
+            config.set("Processing", "Parallel Symbols", "no")
+            config.set("Processing", "Incremental", "no")
+            config.set("Processing", "Instrumentation", "no")
+            config.set("Processing", "Profile", "no")
+
+            config.add_section('Logging')
+            config.set("Logging", "Level", "ERROR")
+            config.set("Logging", "Trace Buffer", "0")
+
             config.add_section('Accounts')
             config.set("Accounts", "IB-Accounts", "U7876826, U4876826, U6834633")
 
@@ -86,6 +106,178 @@ class ConfigHandler:
 
         return name
 
+    def get_statement_of_funds_names(self):
+        ''' Mehrere Kapitalflussberichte werden mit Komma getrennt angegeben, Muster wie "*.xml" sind erlaubt '''
+        names = self.get_statement_of_funds_name()
+        return [name.strip() for name in names.split(",") if name.strip()]
+
+    def get_levels_of_detail(self):
+        ''' Welche levelOfDetail (z.B. BaseCurrency) werden eingelesen? Mit Komma getrennt, Standard: alle '''
+        try:
+            settings = self.read_config()
+            entry = settings["Import"].get("Level Of Detail", fallback="")
+
+        except KeyError:
+            entry = ""
+
+        return [level.strip() for level in entry.split(",") if level.strip()]
+
+    def get_statement_filter(self):
+        ''' Bedingungen an die Zeilen, die schon beim Einlesen des Kapitalflussberichts geprüft werden '''
+        # StatementSchema lädt pandas, die Konfiguration selbst soll ohne pandas auskommen
+        from src.StatementSchema import StatementFilter
+
+        return StatementFilter(accounts=self.get_ib_accounts(), start_date=self.get_start_date(),
+                               end_date=self.get_end_date(), levels_of_detail=self.get_levels_of_detail())
+
+    def get_excel_backup(self):
+        ''' Soll die aufbereitete Importdatei zusätzlich als Excel gesichert werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Import"].getboolean("Excel Backup", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_working_files(self):
+        ''' Sollen die importierten Daten zusätzlich in working_files abgelegt werden? Standard: ja '''
+        try:
+            settings = self.read_config()
+            entry = settings["Import"].getboolean("Working Files", fallback=True)
+
+        except (KeyError, ValueError):
+            entry = True
+
+        return entry
+
+    def get_flex_token(self):
+        ''' Token des Flex Web Service von IB für den automatischen Download '''
+        try:
+            settings = self.read_config()
+            entry = settings["Download"].get("Token", fallback="").strip()
+
+        except KeyError:
+            entry = ""
+
+        return entry
+
+    def get_flex_queries(self):
+        ''' IDs der Flex-Queries, die heruntergeladen werden (z.B. eine je Account und Zeitraum), mit Komma
+            getrennt. Ohne Queries wird der Kapitalflussbericht aus dem Import-Ordner gelesen. '''
+        try:
+            settings = self.read_config()
+            entry = settings["Download"].get("Queries", fallback="")
+
+        except KeyError:
+            entry = ""
+
+        return [query.strip() for query in entry.split(",") if query.strip()]
+
+    def get_flex_url(self):
+        ''' Adresse des Flex Web Service, leer = IB (z.B. für den FlexStubServer) '''
+        try:
+            settings = self.read_config()
+            entry = settings["Download"].get("URL", fallback="").strip()
+
+        except KeyError:
+            entry = ""
+
+        return entry or None
+
+    def get_flex_max_concurrent(self):
+        ''' Wie viele Anfragen an den Flex Web Service laufen höchstens gleichzeitig? Standard: 4 '''
+        try:
+            settings = self.read_config()
+            entry = max(1, settings["Download"].getint("Max Concurrent", fallback=4))
+
+        except (KeyError, ValueError):
+            entry = 4
+
+        return entry
+
+    def get_parallel_accounts(self):
+        ''' Sollen die Accounts parallel in mehreren Prozessen verarbeitet werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Processing"].getboolean("Parallel Accounts", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_parallel_symbols(self):
+        ''' Sollen die Symbole eines Accounts getrennt und parallel verbucht werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Processing"].getboolean("Parallel Symbols", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_incremental(self):
+        ''' Sollen nur die neuen Zeilen seit dem letzten Lauf verbucht werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Processing"].getboolean("Incremental", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_instrumentation(self):
+        ''' Sollen die Laufzeiten gemessen und als Bericht im Export-Ordner abgelegt werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Processing"].getboolean("Instrumentation", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_profile(self):
+        ''' Soll zusätzlich ein cProfile-Profil im Export-Ordner abgelegt werden? Standard: nein '''
+        try:
+            settings = self.read_config()
+            entry = settings["Processing"].getboolean("Profile", fallback=False)
+
+        except (KeyError, ValueError):
+            entry = False
+
+        return entry
+
+    def get_log_level(self):
+        ''' Log-Level für die Datei Main.log, z.B. DEBUG, INFO oder ERROR. Standard: ERROR '''
+        try:
+            settings = self.read_config()
+            entry = settings["Logging"]["Level"].strip().upper()
+
+        except KeyError:
+            entry = "ERROR"
+
+        if entry not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+            entry = "ERROR"
+
+        return entry
+
+    def get_trace_buffer(self):
+        ''' Anzahl der letzten Einträge der Verbuchung, die im Speicher gehalten und nur bei einem Fehler ins Log
+            geschrieben werden. Standard: 0 (kein Ringpuffer) '''
+        try:
+            settings = self.read_config()
+            entry = settings["Logging"].getint("Trace Buffer", fallback=0)
+
+        except (KeyError, ValueError):
+            entry = 0
+
+        return entry
+
     def get_ib_accounts(self):
         settings = self.read_config()
         accounts = settings["Accounts"]["IB-Accounts"]
@@ -1,36 +1,99 @@
+import argparse
+import datetime
 import logging
+import multiprocessing
 import os
+import sys
 
 from ConfigHandler import ConfigHandler
-from src.BookingStatementHandler import BookingStatementHandler
-from src.ImportHandler import ImportHandler
-
-logging.basicConfig(level=logging.DEBUG, filename='Main.log')
-# logging.basicConfig(level=logging.ERROR)
-
-# Get the Instances
-imp = ImportHandler()
-config = ConfigHandler()
-
-# Importieren des Kapitalflussberichts - aktuell nur manuell
-print(os.getcwd())
-import_filename = config.get_statement_of_funds_name()
-open_position_filename = config.get_file_open_positions_name()
-print(import_filename)
-imp.import_ib_xml_manual(import_filename)
-
-for key in config.get_ib_accounts():
-    imp.import_open_position(key, "Backup_OpenPositions.xlsx")
-
-for key in open_position_filename:
-    imp.import_open_position(key, open_position_filename[key])
-
-# Erstellen der Buchungssätze
-accounts_to_process = config.get_ib_accounts()
-account_mapping = config.get_ib_to_accounting_map()
-start_date = config.get_start_date()
-end_date = config.get_end_date()
-bookings = BookingStatementHandler(accounts_to_process, account_mapping, start_date, end_date)
-
-accounts_to_combine = config.get_ib_acc_combination()
-bookings.generate_booking_journal(accounts_to_combine)
+from src.Instrumentation import Instrumentation
+from src.PathHandler import PathHandler
+from src.Pipeline import book_data, check_config, export_data, import_data, run_pipeline
+from src.Trace import Trace
+
+COMMANDS = {
+    "run": "Import, Verbuchung und Export in einem Lauf (Standard ohne Befehl)",
+    "import": "Kapitalflussbericht und offene Positionen importieren und in working_files ablegen",
+    "book": "die Daten aus working_files verbuchen, Excel-Dateien erstellen und das Journal ablegen",
+    "export": "die Import-Dateien für den MS-Buchhalter aus dem abgelegten Journal erstellen",
+    "check": "die Konfiguration und die angegebenen Dateien prüfen, ohne Daten zu lesen",
+}
+
+
+def parse_accounts(value):
+    return [account.strip() for account in value.split(",") if account.strip()]
+
+
+def parse_date(value):
+    ''' Datum wie in der configuration.ini (TT.MM.JJJJ), zurückgegeben als YYYYMMDD '''
+    try:
+        return datetime.datetime.strptime(value, "%d.%m.%Y").strftime("%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a date like 31.12.2021")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Buchungssätze aus den Kapitalflussberichten von Interactive Brokers")
+    commands = parser.add_subparsers(dest="command")
+
+    for command, description in COMMANDS.items():
+        subparser = commands.add_parser(command, help=description, description=description)
+        if command == "check":
+            continue
+        subparser.add_argument("--accounts", type=parse_accounts,
+                               help="nur diese IB-Accounts, mit Komma getrennt (Standard: alle)")
+        if command != "import":
+            subparser.add_argument("--since", type=parse_date,
+                                   help="nur Accounts mit Zeilen ab diesem Tag (TT.MM.JJJJ)")
+
+    arguments = parser.parse_args(argv)
+    if arguments.command is None:
+        arguments = parser.parse_args(["run"])
+    return arguments
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+
+    # Get the Instances
+    config = ConfigHandler()
+
+    # Die Prüfung der Konfiguration lädt weder pandas noch die Daten
+    if arguments.command == "check":
+        problems = check_config(config)
+        for problem in problems:
+            print(problem)
+        print("The configuration is valid" if not problems else f"{len(problems)} problems found")
+        return 1 if problems else 0
+
+    # Die Module setzen beim Import bereits ein Logging, daher force
+    logging.basicConfig(level=config.get_log_level(), filename='Main.log', force=True)
+    trace = Trace(config.get_trace_buffer())
+
+    # Messung der Laufzeiten, der Bericht wird am Ende im Export-Ordner abgelegt
+    instrumentation = Instrumentation(config.get_instrumentation(), config.get_profile())
+    instrumentation.start_profile()
+
+    if arguments.command == "import":
+        import_data(config, persist=True, instrumentation=instrumentation, accounts=arguments.accounts)
+    elif arguments.command == "book":
+        # Die Daten kommen aus working_files, das Journal wird dort für export abgelegt
+        book_data(config, instrumentation=instrumentation, trace=trace, accounts=arguments.accounts,
+                  since=arguments.since, persist=True, export=False)
+    elif arguments.command == "export":
+        for path in export_data(config, accounts=arguments.accounts, since=arguments.since):
+            print(f"{path} was written....")
+    else:
+        # Importieren des Kapitalflussberichts und der offenen Positionen und Erstellen der Buchungssätze,
+        # die importierten Daten werden direkt übergeben und nur auf Wunsch in working_files abgelegt
+        run_pipeline(config, persist=config.get_working_files(), instrumentation=instrumentation, trace=trace,
+                     accounts=arguments.accounts, since=arguments.since)
+
+    instrumentation.write_report(os.path.join(PathHandler().get_working_dir(), "export"))
+    return 0
+
+
+if __name__ == '__main__':
+    # notwendig für den Process-Pool in der Windows Executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
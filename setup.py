@@ -5,6 +5,12 @@ setup(console=['Main.py'],
           "py2exe": {
               "unbuffered": True,
               "optimize": 2,
-              "includes": ["ConfigHandler", "src.BookingStatementHandler", "src.ImportHandler", "configparser", ]
+              "includes": ["ConfigHandler", "src.BookingStatementHandler", "src.ImportHandler", "src.JournalBuffer",
+                           "src.ProcessingRegistry", "src.FifoLotStore", "src.BookingRules", "src.ExportHandler",
+                           "src.StatementSchema", "src.EngineState", "src.Instrumentation", "src.Trace",
+                           "src.ColumnStore", "src.Pipeline", "src.FlexDownloader", "src.FixedPoint",
+                           "configparser", ],
+              # werden vom Programm nicht verwendet und verlangsamen nur den Start der Executable
+              "excludes": ["matplotlib", "PIL", "tkinter", "lxml"]
           }
       })
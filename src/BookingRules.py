@@ -0,0 +1,319 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Platzhalter für das Bankkonto des jeweiligen IB-Accounts (siehe IBAccountMappingToAccounting)
+BANK = "BANK"
+
+# Platzhalter für den Buchungstext aus der activityDescription der Zeile
+DESCRIPTION = "DESCRIPTION"
+
+# Zustand der offenen Position zu dem Symbol der Zeile
+NO_POSITION = "none"
+FLAT = "flat"
+LONG = "long"
+SHORT = "short"
+POSITION_STATES = (NO_POSITION, FLAT, LONG, SHORT)
+OPEN_STATES = (FLAT, LONG, SHORT)
+
+# Vorzeichen des amount
+SIGNS = (-1, 0, 1)
+
+# Die bekannten IB assetCategories, Regeln ohne assetCategory gelten für alle (auch für unbekannte in den Daten).
+# Gibt es für eine assetCategory eine eigene Regel, hat diese Vorrang vor der Regel ohne assetCategory.
+ASSET_CATEGORIES = ["STK", "OPT", "FOP", "FUT", "CFD", "CASH", "BOND", "BILL", "FUND", "WAR", "IOPT", "CMDTY", "IND",
+                    "FXCFD", "CRYPTO", ""]
+ANY_CATEGORY = None
+OPTIONS = ["OPT", "FOP"]
+
+# Ein Buchungssatz einer Regel, close_lot schließt danach die offene Position der Zeile
+Posting = namedtuple("Posting", ["satz_id", "desc", "sdesc", "soll", "haben", "quality_check_relevant", "text",
+                                 "close_lot"], defaults=[None, False])
+
+# Handler, deren Buchung nur von der Zeile selbst abhängt und nicht von den offenen Positionen
+STATELESS_HANDLERS = ("posting", "cfd_charge", "tracking", "ignore", "error")
+
+# Handler und Buchungssätze einer Regel. Bei Regeln mit variants entscheidet das Feld der Zeile
+# (z.B. putCall oder buySell), welche Unterregel angewendet wird
+BookingRule = namedtuple("BookingRule", ["handler", "postings", "direction", "field", "variants"],
+                         defaults=[(), None, None, None])
+
+
+def posting(*postings):
+    return BookingRule("posting", postings)
+
+
+def posting_and_open(*postings):
+    return BookingRule("posting_and_open", postings)
+
+
+def fifo_close(direction):
+    return BookingRule("fifo_close", direction=direction)
+
+
+def first_lot_close(*postings):
+    return BookingRule("first_lot_close", postings)
+
+
+def variant(field, variants):
+    return BookingRule("variant", field=field, variants=variants)
+
+
+TRACKING = BookingRule("tracking")
+ZERO_TRACKING = BookingRule("zero_tracking")
+IGNORE = BookingRule("ignore")
+ERROR = BookingRule("error")
+
+# Buchungsregeln: (activityCode, assetCategories, Vorzeichen des amount, Positionszustände, Regel)
+BOOKING_RULES = [
+    # Futures - Anpassungen
+    ("ADJ", ["FUT"], [-1], POSITION_STATES,
+     posting(Posting("tbd", "Futures-Handel", "Verlust", 6300, BANK, True))),
+    ("ADJ", ["FUT"], [1], POSITION_STATES,
+     posting(Posting("tbd", "Futures-Handel", "Gewinn", BANK, 4905, True))),
+    # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf auf einer Position agregiert
+    # werden, d.h. die Teilverkäufe bekommen hier keinen Abzug. Daher tracke ich in einem solchen Fall nur, dass
+    # ich den Datensatz bearbeitet habe, aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
+    ("ADJ", ["FUT"], [0], POSITION_STATES, TRACKING),
+
+    # ATG_0000004: Zuteilung einer verkauften Optionsposition
+    ("ASSIGN", OPTIONS, SIGNS, OPEN_STATES, variant("putCall", {
+        "P": first_lot_close(Posting("ATG_0000004_0000002", "Zuteilung einer verkauften Optionsposition", "",
+                                     3500, 4830, False)),
+        "C": first_lot_close(Posting("ATG_0000004_0000003", "Zuteilung einer verkauften Optionsposition", "",
+                                     3500, 4830, False))})),
+    ("ASSIGN", OPTIONS, SIGNS, [NO_POSITION], ZERO_TRACKING),
+    # Zuteilungen anderer assetCategories werden nicht verbucht, 0 € Zeilen gelten aber als bearbeitet
+    ("ASSIGN", ANY_CATEGORY, SIGNS, POSITION_STATES, ZERO_TRACKING),
+    # ATG_0000004: Zuteilung einer verkauften Optionsposition, hier muss ich nun die Aktien verbuchen
+    ("ASSIGN", ["STK"], SIGNS, [NO_POSITION], variant("buySell", {
+        "BUY": posting_and_open(Posting("ATG_0000004_0000001", "Einbuchen einer verkauften Option", "",
+                                        1510, BANK, True)),
+        "SELL": posting(Posting("ATG_0000004_0000004", "Zuteilung einer verkauften Optionsposition",
+                                "keine offene Position => Short", 1510, BANK, True))})),
+    ("ASSIGN", ["STK"], SIGNS, [SHORT], variant("buySell", {
+        "BUY": posting_and_open(Posting("ATG_0000004_0000001", "Einbuchen einer verkauften Option", "",
+                                        1510, BANK, True)),
+        "SELL": posting_and_open(Posting("ATG_0000004_0000004", "Zuteilung einer verkauften Optionsposition",
+                                         "Erhöhung der Shortposition", 1510, BANK, True))})),
+    ("ASSIGN", ["STK"], SIGNS, [LONG], variant("buySell", {
+        "BUY": posting_and_open(Posting("ATG_0000004_0000001", "Einbuchen einer verkauften Option", "",
+                                        1510, BANK, True)),
+        "SELL": fifo_close("SELL")})),
+    ("ASSIGN", ["STK"], SIGNS, [FLAT], variant("buySell", {
+        "BUY": posting_and_open(Posting("ATG_0000004_0000001", "Einbuchen einer verkauften Option", "",
+                                        1510, BANK, True))})),
+
+    ("BFEE", ANY_CATEGORY, SIGNS, POSITION_STATES,
+     posting(Posting("ATG_0000010_0000001", "Investitionszinsen ", "Zinszahlung", 7300, BANK, True))),
+
+    # Kauf von Aktien
+    ("BUY", ["STK"], SIGNS, [NO_POSITION],
+     posting_and_open(Posting("ATG_0000005_0000001", "Aktienkauf", "keine offene Position", 1510, BANK, True))),
+    ("BUY", ["STK"], SIGNS, [LONG, FLAT],
+     posting_and_open(Posting("ATG_0000005_0000001", "Aktienkauf", "Erhöhung der offenen Position",
+                              1510, BANK, True))),
+    ("BUY", ["STK"], SIGNS, [SHORT], fifo_close("BUYTOCLOSESHORT")),
+    # Kauf einer Option
+    ("BUY", OPTIONS, SIGNS, [NO_POSITION],
+     posting_and_open(Posting("ATG_0000002_0000003", "Optionkauf", "keine offene Position", 1510, BANK, True))),
+    ("BUY", OPTIONS, SIGNS, [SHORT, FLAT], fifo_close("BUYTOCLOSESHORT")),
+    ("BUY", OPTIONS, SIGNS, [LONG],
+     posting_and_open(Posting("Tbd", "Optionkauf", "Erhöhung der bestehenden Long-Position", 1300, BANK, True))),
+    # Gewinn- und Verlustberechnung CFD
+    ("BUY", ["CFD"], [-1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000002", "CFD-Handel", "Verlust", 6300, BANK, True))),
+    ("BUY", ["CFD"], [1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000001", "CFD-Handel", "Gewinn", BANK, 4905, True))),
+    ("BUY", ["CFD"], [0], POSITION_STATES, TRACKING),
+    # Gewinn- und Verlustberechnung FUT
+    ("BUY", ["FUT"], [-1], POSITION_STATES,
+     posting(Posting("tbd", "Future-Handel", "Verlust", 6300, BANK, True))),
+    ("BUY", ["FUT"], [1], POSITION_STATES,
+     posting(Posting("tbd", "Future-Handel", "Gewinn", BANK, 4905, True))),
+    ("BUY", ["FUT"], [0], POSITION_STATES, TRACKING),
+
+    # CFD Interest and Fees: Unter diesem Code werden nur die Kursdifferenzen und Zinsen des CFD Handels aufgeführt,
+    # die Käufe- und Verkäufe werden wie bei den Aktien unter Sell und Buy getätigt
+    ("CFD", ANY_CATEGORY, [-1], POSITION_STATES, BookingRule("cfd_charge", variants={
+        "interest": posting(Posting("ATG_0000009_0000001", "CFD-Handel", "Zinsaufwendung", 7300, BANK, True,
+                                    DESCRIPTION, True)),
+        "fx": posting(Posting("ATG_0000010_0000004", "CFD-Handel", "Kursverlust", 6880, BANK, True,
+                              DESCRIPTION))})),
+    ("CFD", ANY_CATEGORY, [0], POSITION_STATES, BookingRule("cfd_charge", variants={
+        "interest": posting(Posting("ATG_0000009_0000001", "CFD-Handel", "Zinsaufwendung", 7300, BANK, True,
+                                    DESCRIPTION, True)),
+        "fx": ERROR})),
+    ("CFD", ANY_CATEGORY, [1], POSITION_STATES, BookingRule("cfd_charge", variants={
+        "interest": posting(Posting("ATG_0000009_0000002", "CFD-Handel", "Zinsgewinne", BANK, 7300, True,
+                                    DESCRIPTION, True)),
+        "fx": posting(Posting("ATG_0000010_0000003", "CFD-Handel", "Kursgewinn", BANK, 4840, True,
+                              DESCRIPTION))})),
+
+    # Credit and Debit Interest on cash balances
+    ("CINT", ANY_CATEGORY, [-1, 0], POSITION_STATES,
+     posting(Posting("ATG_0000009_0000001", "Zinsaufwendungen", "Bezahlte Zinsen", 7300, BANK, True, DESCRIPTION))),
+    ("CINT", ANY_CATEGORY, [1], POSITION_STATES,
+     posting(Posting("ATG_0000009_0000002", "Zinsaufwendungen", "Erhaltene Zinsen", BANK, 7100, True, DESCRIPTION))),
+    ("DINT", ANY_CATEGORY, [-1, 0], POSITION_STATES,
+     posting(Posting("ATG_0000009_0000001", "Zinsaufwendungen", "Bezahlte Zinsen", 7300, BANK, True, DESCRIPTION))),
+    ("DINT", ANY_CATEGORY, [1], POSITION_STATES,
+     posting(Posting("ATG_0000009_0000002", "Zinsaufwendungen", "Erhaltene Zinsen", BANK, 7100, True, DESCRIPTION))),
+
+    ("DIV", ANY_CATEGORY, SIGNS, POSITION_STATES,
+     posting(Posting("ATG_0000008_0000001", "Dividendeneinnahmen", "Verbuchung der Dividenden", BANK, 7020, True))),
+
+    # ATG_0000003: Expiration einer Stillhalterposition
+    ("EXP", OPTIONS, SIGNS, OPEN_STATES,
+     first_lot_close(Posting("ATG_0000003_0000001", "Expiration einer Stillhalterposition",
+                             "Verbuchen des Gewinns", 3500, 4830, False))),
+    ("EXP", OPTIONS, SIGNS, [NO_POSITION], ZERO_TRACKING),
+    # Verfälle anderer assetCategories haben keine Regel, sie werden wie bisher weder verbucht noch als bearbeitet
+    # gemerkt und vorab gemeldet (siehe DispatchTable.prepare)
+
+    # TODO: neuer Fall, Konto muss noch geprüft werden ob richtig
+    ("FOREX", ["CASH"], [1], POSITION_STATES,
+     posting(Posting("tbd", "Währungsumrechnung", "Verbuchung des Gewinns", BANK, 4840, True))),
+    ("FOREX", ["CASH"], [-1], POSITION_STATES,
+     posting(Posting("tbd", "Währungsumrechnung", "Verbuchung des Verlusts", BANK, 6880, True))),
+    ("FOREX", ["CASH"], [0], POSITION_STATES, IGNORE),
+
+    ("FRTAX", ANY_CATEGORY, SIGNS, POSITION_STATES,
+     posting(Posting("ATG_0000008_0000002", "Dividendeneinnahmen", "Verbuchung der Quellsteuer", 7639, BANK, True))),
+
+    ("OFEE", ANY_CATEGORY, [-1, 0], POSITION_STATES,
+     posting(Posting("ATG_0000007_0000001", "Marktdatengebuehren", "Verbuchung der Kosten", 6300, BANK, True))),
+    ("OFEE", ANY_CATEGORY, [1], POSITION_STATES,
+     posting(Posting("ATG_0000007_0000002", "Marktdatengebuehren", "Verbuchung der Gutschrift", BANK, 6300, True))),
+
+    # TODO => neu, Ersatzzahlung Dividenden https://ibkr.info/article/2713
+    ("PIL", ANY_CATEGORY, SIGNS, POSITION_STATES,
+     posting(Posting("", "Dividendeneinnahmen", "Payment in Lieu of Dividend (Ordinary Dividend)", BANK, 7020,
+                     True))),
+
+    # Bei den CFD's habe ich keine direkte Position, sondern mir werden täglich die Gebühren in Rechnung gestellt,
+    # somit ist es hier egal, ob eine Position eröffnet ist oder nicht
+    ("SELL", ["CFD"], [-1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000002", "CFD-Handel", "Verlust", 6300, BANK, True))),
+    ("SELL", ["CFD"], [1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000001", "CFD-Handel", "Gewinn", BANK, 4905, True, close_lot=True))),
+    ("SELL", ["CFD"], [0], POSITION_STATES, TRACKING),
+    # Bei den Futures tracke ich weder eine offene, noch eine geschlossene Position
+    ("SELL", ["FUT"], [-1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000020", "Futures-Handel", "Verlust", 6300, BANK, True))),
+    ("SELL", ["FUT"], [1], POSITION_STATES,
+     posting(Posting("ATG_0000010_0000025", "Futures-Handel", "Gewinn", BANK, 4905, True))),
+    ("SELL", ["FUT"], [0], POSITION_STATES, TRACKING),
+    # Verkauf einer Option: ohne offene Position eröffne ich eine Stillhalterposition
+    ("SELL", OPTIONS, SIGNS, [NO_POSITION],
+     posting_and_open(Posting("ATG_0000002_0000001", "Eröffnen einer Stillhalterposition",
+                              "Eröffnung ohne bestehende Long-Position", BANK, 3500, True))),
+    ("SELL", OPTIONS, SIGNS, [SHORT],
+     posting_and_open(Posting("ATG_0000002_0000002", "Eröffnen einer Stillhalterposition",
+                              "Erhöhung der Shortposition", BANK, 3500, True))),
+    ("SELL", OPTIONS, SIGNS, [LONG], fifo_close("SELLTOCLOSELONG")),
+    ("SELL", OPTIONS, SIGNS, [FLAT], IGNORE),
+    # Verkauf von Aktien, die Umsetzung ist in dem Prozessfluss ATG_0000006_Aktienverkauf_Close_Long beschrieben
+    ("SELL", ["STK"], SIGNS, [NO_POSITION],
+     posting_and_open(Posting("ATG_0000006_0000005", "Aktienverkauf", "Sell-Short, ohne offene Position",
+                              BANK, 1510, True))),
+    ("SELL", ["STK"], SIGNS, [SHORT],
+     posting_and_open(Posting("ATG_0000006_0000005", "Aktienverkauf", "Erhöhung der Shortposition",
+                              BANK, 1510, True))),
+    ("SELL", ["STK"], SIGNS, [LONG], fifo_close("SELL")),
+    ("SELL", ["STK"], SIGNS, [FLAT], IGNORE),
+
+    ("STAX", ANY_CATEGORY, SIGNS, POSITION_STATES,
+     posting(Posting("ATG_0000007_0000003", "Marktdatengebuehren", "Steuerverbuchung", 6300, BANK, True))),
+]
+
+
+def amount_sign(amount):
+    ''' Vorzeichen des amount, leere Werte werden wie 0 behandelt '''
+    if amount > 0:
+        return 1
+    if amount < 0:
+        return -1
+    return 0
+
+
+def position_state(quantity):
+    if quantity > 0:
+        return LONG
+    if quantity < 0:
+        return SHORT
+    return FLAT
+
+
+class DispatchTable:
+    ''' Die Buchungsregeln werden einmal in ein Dictionary übersetzt, mit dem Schlüssel
+        (activityCode, assetCategory, Vorzeichen des amount, Positionszustand). Pro Zeile ist damit nur noch ein
+        Lookup nötig, der Handler und die Regel werden direkt zurückgegeben. '''
+
+    def __init__(self, handlers, rules=None):
+        self.handlers = handlers
+        self.rules = BOOKING_RULES if rules is None else rules
+        self.table = {}
+        self.mapped = set()
+        self.stateless = {}
+        self.categories = set()
+
+        # activityCodes, bei denen die Regel vom Zustand der offenen Position abhängt
+        self.state_codes = {code for code, _, _, states, _ in self.rules if tuple(states) != POSITION_STATES}
+
+        self.__compile__(ASSET_CATEGORIES)
+
+    def __compile__(self, categories):
+        new_categories = [category for category in categories if category not in self.categories]
+
+        for code, rule_categories, signs, states, rule in self.rules:
+            fallback = rule_categories is ANY_CATEGORY
+            if fallback:
+                rule_categories = new_categories
+            else:
+                rule_categories = [category for category in rule_categories if category in new_categories]
+
+            entry = (self.handlers[rule.handler], rule)
+            for category in rule_categories:
+                for sign in signs:
+                    self.mapped.add((code, category, sign))
+                    for state in states:
+                        if fallback:
+                            self.table.setdefault((code, category, sign, state), entry)
+                        else:
+                            self.table[(code, category, sign, state)] = entry
+
+        # Kombinationen, die in jedem Positionszustand mit der selben zustandslosen Regel gebucht werden, können
+        # vorab für alle Zeilen gemeinsam verbucht werden (siehe stateless_rule)
+        for code, category, sign in self.mapped:
+            if category not in new_categories:
+                continue
+            entries = {id(self.table.get((code, category, sign, state))) for state in POSITION_STATES}
+            entry = self.table.get((code, category, sign, NO_POSITION))
+            if len(entries) == 1 and entry is not None and entry[1].handler in STATELESS_HANDLERS:
+                self.stateless[(code, category, sign)] = entry[1]
+
+        self.categories.update(new_categories)
+
+    def get(self, key):
+        return self.table.get(key)
+
+    def stateless_rule(self, code, category, sign):
+        ''' Gibt die Regel zurück, falls die Buchung nicht vom Zustand der offenen Position abhängt '''
+        return self.stateless.get((code, category, sign))
+
+    def prepare(self, data):
+        ''' Ergänzt die Regeln ohne assetCategory um die Kategorien aus den Daten und gibt die Kombinationen aus
+            (activityCode, assetCategory, Vorzeichen) mit der Anzahl der Zeilen zurück, für die es keine Regel gibt '''
+        if data.empty:
+            return {}
+
+        self.__compile__(data["assetCategory"].unique())
+
+        combinations = data[["activityCode", "assetCategory"]].copy()
+        combinations["sign"] = np.sign(pd.to_numeric(data["amount"], errors="coerce").fillna(0)).astype(int)
+        counts = combinations.groupby(["activityCode", "assetCategory", "sign"],
+                                      observed=True).size()
+
+        return {key: count for key, count in counts.items() if key not in self.mapped}
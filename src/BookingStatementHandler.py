@@ -1,36 +1,114 @@
 import logging
 import os
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
 import pandas as pd
 
+from src.BookingRules import BANK, DESCRIPTION, FLAT, NO_POSITION, DispatchTable, amount_sign, position_state
+from src.ColumnStore import CLEANED_DATA, JOURNAL, OPEN_POSITIONS, ColumnStore
+from src.EngineState import EngineState, get_fingerprint
+from src.ExportHandler import ExportHandler
+from src.FifoLotStore import FifoLotStore
+from src.FixedPoint import SCALE, from_fixed, scale_fixed, to_fixed, to_fixed_array
+from src.Instrumentation import Instrumentation
+from src.JournalBuffer import JournalBuffer, JOURNAL_COLUMNS
 from src.PathHandler import PathHandler
+from src.ProcessingRegistry import ProcessingRegistry
+from src.Trace import Trace
 
 logging.basicConfig(level=logging.ERROR)
 debug = False
 save_to_excel = True
+save_accounting_drill_down = True  # Acc_Sim_1: Allokation der Buchungen auf die Konten
+
+# Ergebnis der Verarbeitung eines Accounts, wird für den parallelen Lauf zwischen den Prozessen übergeben
+# Bei incremental kommen der neue Zustand und die Anzahl der Buchungen dazu, die schon im abgelegten Journal stehen
+AccountResult = namedtuple("AccountResult", ["account", "quality_check", "journal", "processed_registry",
+                                             "instrumentation", "engine_state", "stored_rows"],
+                           defaults=(None, 0))
+
+# Ergebnis der Verarbeitung eines Shards (siehe book_shards)
+ShardResult = namedtuple("ShardResult", ["positions", "lot_counts", "open_count", "journal_buffer",
+                                         "processed_registry", "fifo_positions", "instrumentation"])
+
+
+def has_current_journal(store):
+    ''' Prüft, ob das abgelegte Journal die Beträge in der aktuellen Einheit enthält (siehe FixedPoint) '''
+    try:
+        return store.exists(JOURNAL) and store.get_attributes(JOURNAL).get("amount_scale") == SCALE
+    except ValueError:  # mit einer anderen Version der Ablage geschrieben
+        return False
+
+
+def combine_account(account, accounts_to_combine):
+    ''' Der Account, unter dem die Zeilen verbucht werden, wenn Accounts kombiniert werden (IBTransferMapping) '''
+    for key, value in accounts_to_combine.items():
+        if account == key:
+            account = value
+    return account
 
 
 class BookingStatementHandler:
 
-    def __init__(self, accounts_to_process, account_mapping, start_date, end_date):
+    def __init__(self, accounts_to_process, account_mapping, start_date, end_date, data=None, open_positions=None):
+        ''' data ist der aufbereitete Kapitalflussbericht und open_positions die offenen Positionen je Account,
+            wie sie der ImportHandler zurückgibt. Ohne diese werden die Daten aus working_files gelesen. '''
         # Zuerst muss ich die Pfade erstellen
         self.dir = PathHandler()
         dir = self.dir.get_working_dir()
         self.pickle_files = os.path.join(dir, "working_files")
-        self.dir_pickle_file = os.path.join(dir, "working_files", "cleaned_data.pkl")
         self.dir_excel_backup = os.path.join(dir, "working_files", "ib_statement_prepared.xlsx")
         self.dir_import = os.path.join(dir, "import")
         self.dir_export = os.path.join(dir, "export")
 
-        self.imported_data = pd.read_pickle(self.dir_pickle_file)
+        # Die Daten der Accounts werden erst bei der Verarbeitung einzeln gelesen (siehe load_account_data)
+        self.store = ColumnStore(self.pickle_files)
+        self.imported_data = data
+        self.open_positions = open_positions or {}
         self.modified_data = pd.DataFrame()
-        self.fifo_positions = pd.DataFrame()
+        self.fifo_positions = FifoLotStore()
+        self.assumed_empty = None  # siehe is_store_empty
+
+        # Mit parallel_symbols werden die Symbole eines Accounts getrennt verbucht (siehe book_shards)
+        self.parallel_symbols = False
+        self.max_workers = None
+
+        # Mit incremental wird nach jedem Lauf der Zustand gespeichert und nur noch neue Zeilen verbucht
+        self.incremental = False
+        self.accounts_to_combine = {}
+
+        # Messung der Laufzeiten, wird über generate_booking_journal aktiviert (siehe Instrumentation)
+        self.instrumentation = Instrumentation()
+
+        # Protokoll der Verbuchung, wird über generate_booking_journal gesetzt (siehe Trace)
+        self.trace = Trace()
+
+        self.stock_adjustment = 0
+        self.restbuchwert = 0
+        self.einnahmen = 0
+
+        # Buchungsregeln für generate_single_statements, die Handler sind in dieser Klasse definiert
+        self.dispatch_table = DispatchTable({
+            "posting": self.apply_posting,
+            "posting_and_open": self.apply_posting_and_open,
+            "fifo_close": self.apply_fifo_close,
+            "first_lot_close": self.apply_first_lot_close,
+            "variant": self.apply_variant,
+            "cfd_charge": self.apply_cfd_charge,
+            "tracking": self.apply_tracking,
+            "zero_tracking": self.apply_zero_tracking,
+            "ignore": self.apply_nothing,
+            "error": self.apply_error,
+        })
 
         self.journal = pd.DataFrame()
-        self.processed_entries = pd.DataFrame()
-        self.qualitycheck = pd.DataFrame()
+        self.journal_buffer = JournalBuffer()
+        self.processed_registry = ProcessingRegistry()
+        self.quality_checks = {}  # Account => Ergebnis des Qualitätschecks (siehe process_account)
         self.account_mapping = account_mapping
 
         self.start = start_date
@@ -45,17 +123,91 @@ class BookingStatementHandler:
             else:
                 logging.error(f"The following account ({account})is missing in the config-file, please add!")
 
+    def __getstate__(self):
+        ''' Für den Process-Pool werden die Daten aller Accounts nicht mit übertragen, jeder Prozess bekommt nur
+            die Daten seines Accounts '''
+        state = self.__dict__.copy()
+        state["imported_data"] = None
+        state["modified_data"] = pd.DataFrame()
+        state["journal"] = pd.DataFrame()
+        state["journal_buffer"] = JournalBuffer()
+        state["processed_registry"] = ProcessingRegistry()
+        state["fifo_positions"] = FifoLotStore()
+        return state
+
     def unique(self, list):
         x = np.array(list)
         return x
 
     def read_accounts(self):
-        ''' Read the accounts which are in the export of IB '''
-        account_list = self.imported_data["accountId"]
+        ''' Read the accounts which are in the export of IB, from the store only the manifest is read '''
+        if self.imported_data is not None:
+            account_list = self.imported_data["accountId"]
+        else:
+            account_list = self.store.get_partitions(CLEANED_DATA)
         account_list = list(set(account_list))
 
         return account_list
 
+    def load_account_data(self, account, accounts_to_combine):
+        ''' Liest nur die Partitionen des Accounts und der Accounts, die mit ihm kombiniert werden.
+            Gibt die kombinierten Daten und die unveränderten Daten des Accounts zurück. '''
+        sources = [source for source in self.read_accounts()
+                   if combine_account(source, accounts_to_combine) == account]
+
+        if self.imported_data is not None:
+            imported_data = self.imported_data[self.imported_data["accountId"].isin(sources)]
+        else:
+            imported_data = self.store.read(CLEANED_DATA, partitions=sources)
+        modified_data = imported_data
+        for key, value in accounts_to_combine.items():
+            modified_data = modified_data.replace(to_replace=key, value=value)
+
+        return modified_data[modified_data["accountId"] == account], \
+            imported_data[imported_data["accountId"] == account]
+
+    def get_changed_accounts(self, since, accounts_to_combine):
+        ''' Die Accounts (nach der Kombination), die Zeilen ab since (YYYYMMDD) haben. Aus der Ablage werden nur
+            die Spalten accountId und date gelesen. '''
+        if self.imported_data is not None:
+            data = self.imported_data[["accountId", "date"]]
+        else:
+            data = self.store.read(CLEANED_DATA, columns=["accountId", "date"])
+
+        changed = data.loc[data["date"] >= pd.Timestamp(since), "accountId"].unique()
+        return sorted({combine_account(account, accounts_to_combine) for account in changed})
+
+    def store_journal(self):
+        ''' Legt das Journal je Account in working_files ab, damit der Export ohne neue Verbuchung erstellt werden
+            kann. Die Buchungen der Accounts, die in diesem Lauf nicht verbucht wurden, bleiben erhalten.
+            Bei incremental wurden die neuen Buchungen bereits angehängt (siehe save_engine_state). '''
+        if self.incremental:
+            return
+
+        journals = []
+        engine_states = {}
+        if has_current_journal(self.store):
+            # Die Zustände der nicht verbuchten Accounts passen weiterhin zu ihren Buchungen
+            engine_states = {account: digest for account, digest in
+                             self.store.get_attributes(JOURNAL).get("engine_states", {}).items()
+                             if account not in self.accounts}
+            others = [account for account in self.store.get_partitions(JOURNAL) if account not in self.accounts]
+            if others:
+                # ohne mmap, da die Dateien gleich ersetzt werden
+                journals.append(self.store.read(JOURNAL, partitions=others, mmap_mode=None))
+        elif self.store.exists(JOURNAL):
+            logging.warning("The stored journal was written by another version, only the accounts booked in this "
+                            "run are kept")
+        if not self.journal.empty:
+            journals.append(self.journal[JOURNAL_COLUMNS])
+
+        journal = pd.DataFrame(columns=JOURNAL_COLUMNS)
+        if journals:
+            journal = pd.concat(journals, ignore_index=True).sort_values("Account", kind="stable")
+        # Die Beträge sind Ganzzahlen, die Einheit wird für export_data mit abgelegt
+        self.store.write(JOURNAL, journal.reset_index(drop=True), partition_by="Account",
+                         attributes={"amount_scale": SCALE, "engine_states": engine_states})
+
     def delete_selected_fifo_positions(self, open_trades):
         '''
             Einzelne Einträge sind nicht wirklich in der offenen Posten liste benötigt, da es keine
@@ -87,27 +239,12 @@ class BookingStatementHandler:
     def track_processing(self, account_id, transactionID, amount, date):
         ''' Speichert die Transaction-ID, die erfolgreich verbucht wurde '''
 
-        dict_to_save = {"account": account_id,
-                        "transactionID": transactionID,
-                        "date": date,
-                        "processedAmount": amount,
-                        }
-
-        if self.processed_entries.empty:  # initiale Befüllung
-            self.processed_entries = pd.concat([self.processed_entries, pd.DataFrame([dict_to_save])],
-                                               ignore_index=True)
-
-        elif self.processed_entries["transactionID"].isin(
-                [transactionID]).any().any():  # wenn TA vorhanden, dann check ob doppeltes Datum
-            pass
-
-        else:
-            self.processed_entries = pd.concat([self.processed_entries, pd.DataFrame([dict_to_save])],
-                                               ignore_index=True)
-            self.qualitycheck = pd.concat([self.qualitycheck, pd.DataFrame([dict_to_save])], ignore_index=True)
+        # wenn die TA schon verbucht wurde, bleibt der erste Eintrag bestehen
+        self.processed_registry.register(account_id, transactionID, amount, date)
 
     def book_statement(self, row, id, desc, sdesc, amount, soll, haben, account_id, quality_check_relevant, text=None):
-        ''' Definiert den Buchungssatz, damit diese immer gleich aussehen '''
+        ''' Definiert den Buchungssatz, damit diese immer gleich aussehen. amount ist eine Ganzzahl (siehe FixedPoint),
+            das Journal wird erst bei der Ausgabe umgerechnet. '''
 
         if text:
             text_to_journal = str(int(row["transactionID"])) + "_" + row["activityCode"] + "_" + row[
@@ -124,37 +261,36 @@ class BookingStatementHandler:
                 "DATE": row["date"],
                 "SETTLEDATE": row["settleDate"],
                 "TEXT": text_to_journal,
-                "AMOUNT": abs(amount),
+                "AMOUNT": abs(int(amount)),
                 "SOLL": soll,
                 "HABEN": haben,
                 "QUALITYREL": quality_check_relevant}
 
-        self.journal = pd.concat([self.journal, pd.DataFrame([dict])], ignore_index=True)
+        self.journal_buffer.append(dict)
         self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
-        logging.debug(f"Buchungssatz: {dict}")
+        if self.trace.active:
+            self.trace.record(logging.DEBUG, "Buchungssatz", **{**dict, "AMOUNT": from_fixed(dict["AMOUNT"])})
 
         return dict
 
     def add_open_position(self, row):
         ''' Eröffnet manuell eine offene Position '''
-        self.fifo_positions = pd.concat([self.fifo_positions, pd.DataFrame([row])], ignore_index=True)
-        self.fifo_positions.drop_duplicates(inplace=True)
+        self.fifo_positions.add(row)
 
-        logging.debug(f"Ich eröffne die Position {row['transactionID']}")
+        if self.trace.active:
+            self.trace.record(logging.DEBUG, "Position eröffnet", transactionID=row["transactionID"])
 
     def close_open_position(self, open_transactionID):
         ''' Schließt eine offene Position und nimmt diese aus der offenen Posten Liste '''
         # now I need to clear the open position entry
-        self.fifo_positions = self.fifo_positions[self.fifo_positions["transactionID"] != open_transactionID]
+        self.fifo_positions.close(open_transactionID)
 
-        logging.debug(f"Ich schließe die Position: {open_transactionID}")
+        if self.trace.active:
+            self.trace.record(logging.DEBUG, "Position geschlossen", transactionID=open_transactionID)
 
     def calculate_p_l(self, direction, amount_in_depot, amount_based_on_direction):
-        ''' Berechnet den Gewinn und Verlust '''
-
-        amount_in_depot = round(amount_in_depot, 8)
-        amount_based_on_direction = round(amount_based_on_direction, 8)
-
+        ''' Berechnet den Gewinn und Verlust, die Beträge sind Ganzzahlen (siehe FixedPoint) und werden damit
+            exakt verglichen '''
         if direction == "BUY":
             result = amount_in_depot - amount_based_on_direction
         elif direction == "BUYTOCLOSESHORT":
@@ -170,46 +306,57 @@ class BookingStatementHandler:
         else:
             identifier = "even"
 
-        logging.debug(f"P&L is calculated as follows with the following "
-                      f"parameters: trade direction {direction}, amount_based_on_sell: {amount_based_on_direction}, "
-                      f"amount_in_depot: {amount_in_depot}, p/l={identifier}, result:{result}")
+        if self.trace.active:
+            self.trace.record(logging.DEBUG, "GuV", direction=direction,
+                              amount_in_depot=from_fixed(amount_in_depot),
+                              amount_based_on_direction=from_fixed(amount_based_on_direction),
+                              identifier=identifier, result=from_fixed(result))
 
         return identifier, result
 
     def close_position_fifo(self, direction, row, open_in_depot, stock_adjustment, restbuchwert, einnahmen,
                             bank_account_id, account_id):
-        ''' Schließen von offenen Positionen nach dem FIFO-Prinzip '''
+        ''' Schließen von offenen Positionen nach dem FIFO-Prinzip. Stückzahlen, Beträge und die Zwischenwerte
+            stock_adjustment, restbuchwert und einnahmen werden als Ganzzahlen gerechnet (siehe FixedPoint),
+            die Lots führen tradeQuantity und amount ebenfalls als Ganzzahlen (siehe FifoLotStore.Lot). '''
+        trace = self.trace if self.trace.active else None
 
-        stocks_to_sell = abs(row["tradeQuantity"])
-        amount_to_sell = abs(row["amount"])
+        stocks_to_sell = abs(to_fixed(row["tradeQuantity"]))
+        amount_to_sell = abs(to_fixed(row["amount"]))
 
         if not einnahmen > 0:
-            einnahmen = 0.0
+            einnahmen = 0
 
         if not stock_adjustment > 0:
-            stock_adjustment = 0.0
+            stock_adjustment = 0
 
         if not restbuchwert > 0:
-            restbuchwert = 0.0
+            restbuchwert = 0
 
         self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
 
-        for i, row in open_in_depot.iterrows():
+        # open_in_depot ist die Queue des Symbols selbst, die Lots werden daher erst nach der Schleife geschlossen
+        closed = []
+        for row in open_in_depot:
 
-            stocks_in_depot_entry = abs(row["tradeQuantity"])
+            stocks_in_depot_entry = abs(row.tradeQuantity)
 
             if stock_adjustment > 0:
                 stocks_in_depot_entry = stock_adjustment
 
-            stocks_in_depot_entry_original = abs(row["tradeQuantity"])
-            amount_in_depot_entry = abs(row["amount"])
-            amount_in_depot_entry_original = abs(row["amount"])
+            stocks_in_depot_entry_original = abs(row.tradeQuantity)
+            amount_in_depot_entry = abs(row.amount)
+            amount_in_depot_entry_original = amount_in_depot_entry
             stock_in_depot_id = int(row["transactionID"])
 
             if stocks_to_sell == 0:
-                pass
+                # Die weiteren Lots bleiben unverändert, nur beim Schließen von gekauften Optionen wird unten
+                # noch für jedes Lot gebucht
+                if direction != "SELLTOCLOSELONG" and direction != "SELLTOCLOSESHORT":
+                    break
             else:
                 if stocks_in_depot_entry == stocks_to_sell:
+                    self.instrumentation.count("close_position_fifo Option 1")
 
                     # Calculate the values for the p&l calculation and bookings
                     quantity = abs(stocks_in_depot_entry)
@@ -224,17 +371,16 @@ class BookingStatementHandler:
                     else:
                         amount_in_depot_entry = restbuchwert
 
-                    amount_to_sell = (amount_to_sell / stocks_to_sell) * quantity
+                    amount_to_sell = scale_fixed(amount_to_sell, quantity, stocks_to_sell)
 
                     # Calculate the values for the p&l calculation and bookings
                     quantity = abs(stocks_to_sell)
 
-                    logging.info(f'{int(row["transactionID"])} / {row["symbol"]} '
-                                 f'=> Option 1: Ich habe {stocks_in_depot_entry} Aktien im Depot. '
-                                 f'Hier will ich nun die folgende Operation {direction} '
-                                 f'mit der Menge {quantity} durchführen. '
-                                 f'Diese bewerte ich mit einem Depotwert von {amount_in_depot_entry}, und '
-                                 f'dem Verrechnungswert von {amount_to_sell}.')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Option 1", transactionID=int(row["transactionID"]),
+                                     symbol=row["symbol"], direction=direction, depot=from_fixed(stocks_in_depot_entry),
+                                     quantity=from_fixed(quantity), depotwert=from_fixed(amount_in_depot_entry),
+                                     verrechnungswert=from_fixed(amount_to_sell))
 
                     # Adapt the loop
                     stocks_to_sell = 0
@@ -242,15 +388,16 @@ class BookingStatementHandler:
                     einnahmen = 0
                     restbuchwert = restbuchwert - amount_in_depot_entry
 
-                    logging.info(f'Nach der Durchführung der Berechnung, habe ich noch die folgende Operation: '
-                                 f'{direction} mit der Menge von {stocks_to_sell} Aktien. Bei dem aktuellen Eintrag '
-                                 f'habe ich noch {stocks_in_depot_entry} im Depot. Der Buchwert beträgt hierbei '
-                                 f'{restbuchwert} und die noch offenen Einnahmen belaufen sich noch auf {einnahmen}')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Rest", direction=direction, offen=from_fixed(stocks_to_sell),
+                                     depot=from_fixed(stocks_in_depot_entry), restbuchwert=from_fixed(restbuchwert),
+                                     einnahmen=from_fixed(einnahmen))
 
-                    if stocks_in_depot_entry == 0.0:
-                        self.close_open_position(stock_in_depot_id)
+                    if stocks_in_depot_entry == 0:
+                        closed.append(stock_in_depot_id)
 
                 elif stocks_in_depot_entry < stocks_to_sell:
+                    self.instrumentation.count("close_position_fifo Option 2")
 
                     # Calculate the values for the p&l calculation and bookings
                     quantity = abs(stocks_in_depot_entry)
@@ -265,14 +412,13 @@ class BookingStatementHandler:
                     else:
                         amount_in_depot_entry = restbuchwert
 
-                    amount_to_sell = (amount_to_sell / stocks_to_sell) * quantity
+                    amount_to_sell = scale_fixed(amount_to_sell, quantity, stocks_to_sell)
 
-                    logging.info(f'{int(row["transactionID"])} / {row["symbol"]} '
-                                 f'=> Option 2: Ich habe {stocks_in_depot_entry} Aktien im Depot. '
-                                 f'Hier will ich nun die folgende Operation {direction} '
-                                 f'mit der Menge {quantity} durchführen. '
-                                 f'Diese bewerte ich mit einem Depotwert von {amount_in_depot_entry}, und '
-                                 f'dem Verrechnungswert von {amount_to_sell}.')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Option 2", transactionID=int(row["transactionID"]),
+                                     symbol=row["symbol"], direction=direction, depot=from_fixed(stocks_in_depot_entry),
+                                     quantity=from_fixed(quantity), depotwert=from_fixed(amount_in_depot_entry),
+                                     verrechnungswert=from_fixed(amount_to_sell))
 
                     # Adapt the loop and baseline
                     stocks_to_sell = stocks_to_sell - quantity
@@ -281,37 +427,37 @@ class BookingStatementHandler:
                     einnahmen = einnahmen - amount_to_sell
                     restbuchwert = restbuchwert - amount_in_depot_entry
 
-                    logging.info(f'Nach der Durchführung der Berechnung, habe ich noch die folgende Operation: '
-                                 f'{direction} mit der Menge von {stocks_to_sell} Aktien. Bei dem aktuellen Eintrag '
-                                 f'habe ich noch {stocks_in_depot_entry} im Depot. Der Buchwert beträgt hierbei '
-                                 f'{restbuchwert} und die noch offenen Einnahmen belaufen sich noch auf {einnahmen}')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Rest", direction=direction, offen=from_fixed(stocks_to_sell),
+                                     depot=from_fixed(stocks_in_depot_entry), restbuchwert=from_fixed(restbuchwert),
+                                     einnahmen=from_fixed(einnahmen))
 
-                    if stocks_in_depot_entry == 0.0:
-                        self.close_open_position(stock_in_depot_id)
+                    if stocks_in_depot_entry == 0:
+                        closed.append(stock_in_depot_id)
 
                 elif stocks_in_depot_entry > stocks_to_sell:
+                    self.instrumentation.count("close_position_fifo Option 3")
 
                     # Calculate the values for the p&l calculation and bookings
                     quantity = abs(stocks_to_sell)
                     if restbuchwert > 0:
                         amount_in_depot_entry = restbuchwert
 
-                    amount_in_depot_entry = (amount_in_depot_entry / stocks_in_depot_entry) * stocks_to_sell
+                    amount_in_depot_entry = scale_fixed(amount_in_depot_entry, stocks_to_sell, stocks_in_depot_entry)
 
                     if einnahmen > 0:
                         amount_to_sell = einnahmen
 
-                    logging.info(f'{int(row["transactionID"])} / {row["symbol"]} => '
-                                 f'Option 3: Ich habe {stocks_in_depot_entry} Aktien im Depot. '
-                                 f'Hier will ich nun die folgende Operation {direction} '
-                                 f'mit der Menge {quantity} durchführen. '
-                                 f'Diese bewerte ich mit einem Depotwert von {amount_in_depot_entry}, und '
-                                 f'dem Verrechnungswert von {amount_to_sell}.')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Option 3", transactionID=int(row["transactionID"]),
+                                     symbol=row["symbol"], direction=direction, depot=from_fixed(stocks_in_depot_entry),
+                                     quantity=from_fixed(quantity), depotwert=from_fixed(amount_in_depot_entry),
+                                     verrechnungswert=from_fixed(amount_to_sell))
 
                     # Adapt the loop
                     stocks_to_sell = stocks_to_sell - quantity
 
-                    if row["tradeQuantity"] < 0 and quantity > 0:
+                    if row.tradeQuantity < 0 and quantity > 0:
                         stocks_in_depot_entry = (stocks_in_depot_entry * -1) + quantity
                     else:
                         stocks_in_depot_entry = stocks_in_depot_entry - quantity
@@ -328,36 +474,34 @@ class BookingStatementHandler:
                     else:
                         restbuchwert = restbuchwert - amount_in_depot_entry
 
-                    logging.info(f'Nach der Durchführung der Berechnung, habe ich noch die folgende Operation: '
-                                 f'{direction} mit der Menge von {stocks_to_sell} Aktien. Bei dem aktuellen Eintrag '
-                                 f'habe ich noch {stocks_in_depot_entry} im Depot. Der Buchwert beträgt hierbei '
-                                 f'{restbuchwert} und die noch offenen Einnahmen belaufen sich noch auf {einnahmen}')
+                    if trace is not None:
+                        trace.record(logging.INFO, "FIFO Rest", direction=direction, offen=from_fixed(stocks_to_sell),
+                                     depot=from_fixed(stocks_in_depot_entry), restbuchwert=from_fixed(restbuchwert),
+                                     einnahmen=from_fixed(einnahmen))
 
-                    if stocks_in_depot_entry == 0.0:
-                        self.close_open_position(stock_in_depot_id)
+                    if stocks_in_depot_entry == 0:
+                        closed.append(stock_in_depot_id)
 
                 else:
                     logging.error("Long Position konnte nicht geschlossen werden!")
+                    self.trace.dump(f"Die Position {int(row['transactionID'])} konnte nicht geschlossen werden")
 
                 # Update the open position entries
                 # If I reduced the amount of stocks I have in the depot, I will adjust my open positions
                 if stocks_in_depot_entry_original != stocks_in_depot_entry:
-                    self.fifo_positions.loc[self.fifo_positions['transactionID'] == int(
-                        row["transactionID"]), 'tradeQuantity'] = stocks_in_depot_entry
+                    self.fifo_positions.update(int(row["transactionID"]), "tradeQuantity", stocks_in_depot_entry)
 
-                    stock_adjustment = 0.0
+                    stock_adjustment = 0
 
                 # Update the open position entries
                 # If I reduced the amount of stocks, I need to reevaluate my open positions and adjust
                 if amount_in_depot_entry_original != restbuchwert:
-                    self.fifo_positions.loc[self.fifo_positions['transactionID'] == int(
-                        row["transactionID"]), 'amount'] = restbuchwert
+                    self.fifo_positions.update(int(row["transactionID"]), "amount", restbuchwert)
 
-                    restbuchwert = 0.0
+                    restbuchwert = 0
 
                 # Calculate P&L
                 identifier, result = self.calculate_p_l(direction, amount_in_depot_entry, amount_to_sell)
-                logging.debug(f'Mit diesem Trade habe ich einen {identifier} gemacht und {result} realisiert!')
 
                 if row["assetCategory"] == "STK" and direction == "SELL":
 
@@ -533,6 +677,9 @@ class BookingStatementHandler:
                                             amount=result, soll=7210, haben=bank_account_id, account_id=account_id,
                                             quality_check_relevant=False)
 
+        for transactionID in closed:
+            self.close_open_position(transactionID)
+
         return stock_adjustment, restbuchwert, einnahmen
 
     def account_closure(self, working_dict, soll_account, haben_account, target_soll, target_haben,
@@ -555,42 +702,46 @@ class BookingStatementHandler:
 
         return working_dict
 
-    def accounting_check(self, journal):
+    def accounting_check(self, journal, drill_down=True):
         ''' Diese Methode simuliert den Jahresabschluss um hier noch einmal einen Check zu machen ob die
-        Buchunssätze passen, alles verbucht wurde und die Konten am Ende dann abgestimmt sind'''
-
-        accounting = journal.copy()
-
-        # Anlegen der einzelnen Soll und Haben Spalten für die hinterlegten Konten
-        account_list = pd.unique(accounting[["SOLL", "HABEN"]].values.ravel("K"))
+        Buchunssätze passen, alles verbucht wurde und die Konten am Ende dann abgestimmt sind.
+        Die Summen je Konto werden über ein groupby auf SOLL und HABEN gebildet, der Jahresabschluss läuft nur noch
+        auf dieser Summenliste. Mit drill_down wird zusätzlich die Allokation der Buchungen auf die Konten als
+        Tabelle im Langformat (eine Zeile je Buchung und Seite) zurückgegeben.
+        Die Summen und der Abschluss werden exakt mit den Ganzzahlen des Journals gerechnet (siehe FixedPoint),
+        erst die zurückgegebenen Tabellen enthalten wieder Beträge. '''
+
+        # Reihenfolge der Konten wie in den Buchungen (zuerst Soll, dann Haben je Buchung)
+        account_list = pd.unique(journal[["SOLL", "HABEN"]].values.ravel("K"))
         account_list = [int(acc) for acc in account_list]
 
-        for acc in account_list:
-            accounting[str(acc) + "_S"] = 0.00
-            accounting[str(acc) + "_H"] = 0.00
-
-        # Allokation der einzelnen Buchungen auf die Konten (wird ebenfalls abgelegt um die Nachvollziehbarkeit zu haben)
-        for index, row in journal.iterrows():
-            accounting.loc[index, str(int(row["SOLL"])) + "_S"] = float(row["AMOUNT"])
-            accounting.loc[index, str(int(row["HABEN"])) + "_H"] = float(row["AMOUNT"])
-
         # Summierung der einzelnen Werte über die Konten
+        amounts = journal["AMOUNT"].astype("int64")
+        soll_sums = amounts.groupby(journal["SOLL"].astype(int)).sum()
+        haben_sums = amounts.groupby(journal["HABEN"].astype(int)).sum()
+
         account_summary = {}
 
         for acc in account_list:
-            soll = str(acc) + "_S"
-            haben = str(acc) + "_H"
-            account_summary[soll] = accounting[soll].sum()
-            account_summary[haben] = accounting[haben].sum()
+            account_summary[str(acc) + "_S"] = int(soll_sums.get(acc, 0))
+            account_summary[str(acc) + "_H"] = int(haben_sums.get(acc, 0))
+
+        # Allokation der einzelnen Buchungen auf die Konten (wird ebenfalls abgelegt um die Nachvollziehbarkeit zu haben)
+        accounting = pd.DataFrame()
+        if drill_down:
+            soll_side = journal.assign(KONTO=journal["SOLL"].astype(int), SEITE="S")
+            haben_side = journal.assign(KONTO=journal["HABEN"].astype(int), SEITE="H")
+            accounting = pd.concat([soll_side, haben_side]).sort_index(kind="stable").reset_index(drop=True)
+            accounting["AMOUNT"] = from_fixed(accounting["AMOUNT"].astype("int64"))
 
         # Simulation der Jahresabschlusstätigkeiten und Verbuchungen
         year_end_summary = account_summary.copy()
-        year_end_summary["Guv_S"] = 0.00
-        year_end_summary["Guv_H"] = 0.00
-        year_end_summary["EK_S"] = 0.00
-        year_end_summary["EK_H"] = 0.00
-        year_end_summary["SBK_S"] = 0.00
-        year_end_summary["SBK_H"] = 0.00
+        year_end_summary["Guv_S"] = 0
+        year_end_summary["Guv_H"] = 0
+        year_end_summary["EK_S"] = 0
+        year_end_summary["EK_H"] = 0
+        year_end_summary["SBK_S"] = 0
+        year_end_summary["SBK_H"] = 0
         bestandskonten = [0, 1, 2, 3]  # diese werden über die Schlussbilanz verrechnet
         erfolgskonten = [4, 5, 6, 7]  # diese werden in die G&V verrechnet
 
@@ -618,7 +769,7 @@ class BookingStatementHandler:
         year_end_summary = self.account_closure(year_end_summary, "EK_S", "EK_H", "SBK_S", "SBK_H")
 
         # Berechnung des Schlussbilanzsaldos
-        sbk_saldo = round(year_end_summary["SBK_H"] - year_end_summary["SBK_S"], 2)
+        sbk_saldo = year_end_summary["SBK_H"] - year_end_summary["SBK_S"]
         year_end_summary["SBK_Saldo"] = sbk_saldo
 
         if sbk_saldo == 0:
@@ -626,39 +777,14 @@ class BookingStatementHandler:
         else:
             logging.error("Quality Check: Validation: Soll und Haben der Schlussbilanz unterscheiden sich!}!")
 
-        account_summary = pd.DataFrame(data=account_summary, index=[0])
-        accounting_simulation_final = pd.DataFrame(data=year_end_summary, index=[0])
+        account_summary = pd.DataFrame(data=account_summary, index=[0], dtype="int64")
+        accounting_simulation_final = pd.DataFrame(data=year_end_summary, index=[0], dtype="int64")
 
-        return accounting, account_summary, accounting_simulation_final
+        return accounting, from_fixed(account_summary), from_fixed(accounting_simulation_final)
 
     def generate_MSBuchhalter_Import(self, data_to_import, account, path):
         ''' Diese Methode erstellt die Import-Datei für den MS-Buchhalter 3.0'''
-
-        for index, row in data_to_import.iterrows():
-            data_to_import.loc[index, "SOLL"] = str(int(row["SOLL"]))
-            data_to_import.loc[index, "HABEN"] = str(int(row["HABEN"]))
-            data_to_import.loc[index, "AMOUNT"] = str(row["AMOUNT"]).replace(".", ",")
-
-        import_data = pd.DataFrame()
-        import_data["Belegdatum"] = pd.to_datetime(data_to_import["DATE"], format="%Y%m%d").dt.strftime("%d.%m.%Y")
-        import_data["Buchungsdatum"] = pd.to_datetime(data_to_import["SETTLEDATE"], format="%Y%m%d").dt.strftime(
-            "%d.%m.%Y")
-        import_data["Belegnummernkreis"] = ""
-        import_data["Belegnummer"] = ""
-        import_data["Buchungstext"] = data_to_import["TEXT"]
-        import_data["Betrag"] = data_to_import["AMOUNT"]
-        import_data["Sollkonto"] = data_to_import["SOLL"]
-        import_data["Habenkonto"] = data_to_import["HABEN"]
-        import_data["Steuerschlüssel"] = "0"
-        import_data["Kostenstelle 1"] = ""
-        import_data["Kostenstelle 2"] = ""
-        import_data["Währung"] = "EUR"
-
-        path_to_store = os.path.join(path, f"AccountingJournal_Import_MSB_{account}.csv")
-        import_data.to_csv(path_or_buf=path_to_store,
-                           sep=";",
-                           index=False,
-                           quotechar='"')
+        ExportHandler(path).generate_MSBuchhalter_Import(data_to_import, [account])
 
     def processing_check(self, processed_ids, expected_ids):
 
@@ -669,548 +795,806 @@ class BookingStatementHandler:
             s = pd.DataFrame()
         return s
 
-    def generate_single_statements(self, data, open):
-        ''' In dieser Methode prüfe ich nun die einzelnen Datensätze und erstelle hier,
-            basierend auf den einzelnen Buchungsvorschriften und Fällen die
-            einzelnen Buchungssätze '''
-
-        # Setzen der open files des accounts
-        self.fifo_positions = open
-
-        # Da IB auch Teilverkäufe vornimmt, habe ich hier einen Abgleich eingebaut,
-        # der mir ermöglicht über die einzelen Zeilen hinweg die Trades zu verbuchen
-        stock_adjustment = 0.0
-        restbuchwert = 0.0
-        einnahmen = 0.0
-
-        # Da ich jede Zeile verbuchen muss, prüfe ich jede Zeile einzeln
-        for i, row in data.iterrows():
-            account_id = row["accountId"]
-            position_open = False
-            bank_account_id = self.account_mapping[account_id]
-            logging.debug(row)
-
-            time.sleep(1 / 1000)
-
-            # Ich prüfe zuerst, ob ich eine offene Position im Depot habe, die ich
-            # dann nach dem FIFO-Prinzip verarbeiten muss
-            if not row["symbol"] == "":
-                if not self.fifo_positions.empty:
-                    if row["symbol"] in self.fifo_positions["symbol"].values:
-                        position_open = True
-                        open_in_depot = self.fifo_positions[self.fifo_positions["symbol"] == row["symbol"]]
-                    else:
-
-                        # As I have a Case where IB changed the underlying symbol name, I need to do a seperate check
-                        # this is covered in the test case SPECIAL_CASE_DELL
-                        if row["activityCode"] == "EXP":  # currently only the case for expirations
-                            find_addition = row["underlyingSymbol"].rfind("1")  # check if there is a 1 at the end
-                            if find_addition > 0:  # if yes
-                                cleaned_string = row["underlyingSymbol"][:-1]  # get the correct string
-                                correct_entry = row["symbol"].replace(row["underlyingSymbol"], cleaned_string + " ")
-
-                                # now, check again if I have an open position
-                                if correct_entry in self.fifo_positions["symbol"].values:
-                                    position_open = True
-                                    open_in_depot = self.fifo_positions[self.fifo_positions["symbol"] == correct_entry]
-                                    row["symbol"] = correct_entry
-                                else:
-                                    self.fifo_positions = pd.concat([self.fifo_positions, pd.DataFrame([row])])
-                                    position_open = False
-                        else:
-                            self.fifo_positions = pd.concat([self.fifo_positions, pd.DataFrame([row])])
-                            position_open = False
-            else:
-                if self.fifo_positions.isin([row["activityDescription"]]).any().any():
-                    position_open = True
-                    open_in_depot = self.fifo_positions[
-                        self.fifo_positions["activityDescription"] == row["activityDescription"]]
-                else:
-                    self.fifo_positions = pd.concat([self.fifo_positions, pd.DataFrame([row])])
-                    position_open = False
-
-            logging.debug(f"Das Ergebnis der Suche nach einem offenen Posten ist: {position_open}")
-
-            # Hier drösle ich nun die einzelnen Geschäftsvorfälle auf und
-            # berwete diese ja nach Fall und Gegebenheit
-            if row["activityCode"] == "ADJ":
-                if row["assetCategory"] == "FUT":
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="tbd",
-                                            desc="Futures-Handel", sdesc="Verlust",
-                                            amount=row["amount"], soll=6300, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="tbd",
-                                            desc="Futures-Handel", sdesc="Gewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4905,
-                                            account_id=account_id, quality_check_relevant=True)
-
-                    else:  # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf
-                        # auf einer Position agregiert werden, d.h. die Teilverkäufe bekommen hier keinen Abzug
-                        # daher tracke ich in einem solchen Fall nur dass ich den Datensatz bearbeitet habe,
-                        # aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
-                        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
-
-                else:
-                    logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                    logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
-            elif row["activityCode"] == "ASSIGN":
-
-                # ATG_0000004: Zuteilung einer verkauften Optionsposition
-                if (row["assetCategory"] == "OPT" or row["assetCategory"] == "FOP") and position_open:
-
-                    # ATG_0000004: Verbuchung der Put-Prämie
-                    if row["putCall"] == "P":
-                        self.book_statement(row=row, id="ATG_0000004_0000002",
-                                            desc="Zuteilung einer verkauften Optionsposition",
-                                            sdesc="", amount=abs(open_in_depot["amount"].iloc[0]), soll=3500,
-                                            haben=4830, account_id=account_id, quality_check_relevant=False)
-
-                        self.close_open_position(open_in_depot["transactionID"].iloc[0])
-
-                    # ATG_0000004: Verbuchung der Call-Prämie
-                    if row["putCall"] == "C":
-                        self.book_statement(row=row, id="ATG_0000004_0000003",
-                                            desc="Zuteilung einer verkauften Optionsposition",
-                                            sdesc="", amount=abs(open_in_depot["amount"].iloc[0]), soll=3500,
-                                            haben=4830, account_id=account_id, quality_check_relevant=False)
-
-                        self.close_open_position(open_in_depot["transactionID"].iloc[0])
-
-                # ATG_0000004: Zuteilung einer verkauften Optionsposition
-                # Hier muss ich nun die Aktien verbuchen
-                elif row["assetCategory"] == "STK":
-
-                    # Kauf von Aktien (Zuteilung des Puts)
-                    if row["buySell"] == "BUY":
-                        self.book_statement(row=row, id="ATG_0000004_0000001",
-                                            desc="Einbuchen einer verkauften Option",
-                                            sdesc="", amount=row["amount"], soll=1510, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
+    def book_posting(self, row, posting, amount, bank_account_id, account_id):
+        ''' Verbucht einen Buchungssatz aus den Buchungsregeln, amount ist bereits eine Ganzzahl (siehe FixedPoint) '''
+        soll = bank_account_id if posting.soll == BANK else posting.soll
+        haben = bank_account_id if posting.haben == BANK else posting.haben
+        text = row["activityDescription"] if posting.text == DESCRIPTION else posting.text
+
+        return self.book_statement(row=row, id=posting.satz_id, desc=posting.desc, sdesc=posting.sdesc,
+                                   amount=amount, soll=soll, haben=haben, account_id=account_id,
+                                   quality_check_relevant=posting.quality_check_relevant, text=text)
+
+    def apply_posting(self, row, rule, open_in_depot, bank_account_id, account_id):
+        for posting in rule.postings:
+            self.book_posting(row, posting, to_fixed(row["amount"]), bank_account_id, account_id)
+            if posting.close_lot:
+                self.close_open_position(row["transactionID"])
+
+    def apply_posting_and_open(self, row, rule, open_in_depot, bank_account_id, account_id):
+        self.apply_posting(row, rule, open_in_depot, bank_account_id, account_id)
+        self.add_open_position(row)
+
+    def apply_fifo_close(self, row, rule, open_in_depot, bank_account_id, account_id):
+        self.stock_adjustment, self.restbuchwert, self.einnahmen = self.close_position_fifo(
+            rule.direction, row, open_in_depot, self.stock_adjustment, self.restbuchwert, self.einnahmen,
+            bank_account_id, account_id=account_id)
+
+    def apply_first_lot_close(self, row, rule, open_in_depot, bank_account_id, account_id):
+        ''' Verbucht den Wert der ersten offenen Position (z.B. die Prämie) und schließt diese '''
+        lot = next(iter(open_in_depot))
+        for posting in rule.postings:
+            self.book_posting(row, posting, abs(lot.amount), bank_account_id, account_id)
+        self.close_open_position(lot.transactionID)
+
+    def apply_variant(self, row, rule, open_in_depot, bank_account_id, account_id):
+        variant = rule.variants.get(row[rule.field])
+        if variant is not None:
+            self.dispatch_table.handlers[variant.handler](row, variant, open_in_depot, bank_account_id, account_id)
+
+    def apply_cfd_charge(self, row, rule, open_in_depot, bank_account_id, account_id):
+        ''' Zinsen (ohne Symbol) und Kursdifferenzen (mit Symbol) aus dem CFD Handel '''
+        if (row["symbol"] == "") and "CFD INTEREST" in row["activityDescription"]:
+            variant = rule.variants["interest"]
+        elif (row["symbol"] != "") and "USD" in row["activityDescription"]:
+            variant = rule.variants["fx"]
+        else:
+            return
+        self.dispatch_table.handlers[variant.handler](row, variant, open_in_depot, bank_account_id, account_id)
 
-                        self.add_open_position(row)
+    def apply_tracking(self, row, rule, open_in_depot, bank_account_id, account_id):
+        ''' Keine Buchung (z.B. 0 € Buchungen), ich merke mir nur, dass die Zeile bearbeitet wurde '''
+        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
 
-                    # Verkauf von Aktien (Ausübung des Calls)
-                    if row["buySell"] == "SELL":
-                        if position_open == False:  # Falls es keine offenen Positionen gibt, eröffne ich einen Short
-                            self.book_statement(row=row, id="ATG_0000004_0000004",
-                                                desc="Zuteilung einer verkauften Optionsposition",
-                                                sdesc="keine offene Position => Short",
-                                                amount=row["amount"], soll=1510, haben=bank_account_id,
-                                                account_id=account_id,
-                                                quality_check_relevant=True)
+    def apply_zero_tracking(self, row, rule, open_in_depot, bank_account_id, account_id):
+        if row["amount"] == 0:
+            self.track_processing(account_id, row["transactionID"], row["amount"], row["date"])
 
-                        elif position_open == True:  # Falls offene Position, Short oder Long im Depot?
+    def apply_nothing(self, row, rule, open_in_depot, bank_account_id, account_id):
+        pass
 
-                            # Wenn ich schon short bin, muss ich die Position erhöhen
-                            if open_in_depot["tradeQuantity"].sum() < 0:
-                                self.book_statement(row=row, id="ATG_0000004_0000004",
-                                                    desc="Zuteilung einer verkauften Optionsposition",
-                                                    sdesc="Erhöhung der Shortposition",
-                                                    amount=row["amount"], soll=1510, haben=bank_account_id,
-                                                    account_id=account_id, quality_check_relevant=True)
+    def apply_error(self, row, rule, open_in_depot, bank_account_id, account_id):
+        logging.error("Der Trade konnte nicht verbucht werden!")
+        self.trace.dump(f"Die Zeile {int(row['transactionID'])} konnte nicht verbucht werden")
 
-                                self.add_open_position(row)  # Eintrag in den offenen Posten
+    def text_to_journal(self, rows, text):
+        ''' Buchungstext wie in book_statement, für einen Block von Zeilen '''
+        prefix = rows["transactionID"].astype("int64").astype(str) + "_" + rows["activityCode"].astype(str) + "_" + \
+            rows["assetCategory"].astype(str) + "_"
 
-                            # Wenn ich eine bestehende Long-Position habe, muss ich diese FIFO mäßig verarbeiten
-                            elif open_in_depot["tradeQuantity"].sum() > 0:
-                                stock_adjustment, restbuchwert, einnahmen = self.close_position_fifo(
-                                    "SELL", row, open_in_depot, stock_adjustment, restbuchwert, einnahmen,
-                                    bank_account_id, account_id=account_id)
+        if text == DESCRIPTION:
+            text = rows["activityDescription"]
+            use_default = ~text.astype(bool).to_numpy()
+        elif text:
+            use_default = np.zeros(len(rows), dtype=bool)
+        else:
+            text = ""
+            use_default = np.ones(len(rows), dtype=bool)
+
+        text_to_journal = prefix + text
+        if use_default.any():
+            default = rows[use_default]
+            text_to_journal[use_default] = prefix[use_default] + \
+                default["tradeQuantity"].astype("int64").astype(str) + "_" + default["symbol"].astype(str)
+
+        return text_to_journal
+
+    def book_stateless(self, rows, rule, positions):
+        ''' Verbucht einen Block von Zeilen mit der selben zustandslosen Regel, entspricht apply_posting,
+            apply_tracking, apply_nothing und apply_error. Gibt zurück, ob die Lots der Zeilen danach geschlossen
+            werden müssen. '''
+        if rule.handler == "error":
+            for _ in range(len(rows)):
+                logging.error("Der Trade konnte nicht verbucht werden!")
+            self.trace.dump(f"{len(rows)} Zeilen konnten nicht verbucht werden")
+        if rule.handler not in ("posting", "tracking"):
+            return False
+
+        close_lot = False
+        bank_account_ids = rows["accountId"].map(self.account_mapping).to_numpy()
+        for posting in rule.postings:
+            journal = pd.DataFrame({
+                "Account": rows["accountId"].to_numpy(),
+                "Belegnummer": rows["transactionID"].astype("int64").to_numpy(),
+                "SATZ_ID": posting.satz_id,
+                "DESC": posting.desc,
+                "SUBDESC": posting.sdesc,
+                "DATE": rows["date"].to_numpy(),
+                "SETTLEDATE": rows["settleDate"].to_numpy(),
+                "TEXT": self.text_to_journal(rows, posting.text).to_numpy(),
+                "AMOUNT": np.abs(to_fixed_array(rows["amount"])),
+                "SOLL": bank_account_ids if posting.soll == BANK else posting.soll,
+                "HABEN": bank_account_ids if posting.haben == BANK else posting.haben,
+                "QUALITYREL": posting.quality_check_relevant})
+            self.journal_buffer.extend(journal, positions)
+            close_lot = close_lot or posting.close_lot
+
+        self.processed_registry.register_many(rows["accountId"], rows["transactionID"].astype("int64"),
+                                              rows["amount"], rows["date"], positions)
+
+        return close_lot
+
+    def generate_stateless_statements(self, data):
+        ''' Verbucht vorab alle Zeilen, deren Buchung nur von der Zeile selbst und dem Vorzeichen des amount
+            abhängt (Dividenden, Steuern, Zinsen, Gebühren, Forex und die CFD/Futures Zahlungen).
+            Die Buchungssätze werden pro Regel mit Spaltenoperationen erstellt und über die Position der Zeile
+            wieder an der richtigen Stelle im Journal einsortiert. Zurückgegeben wird, welche Zeilen verbucht
+            wurden und bei welchen danach noch die offene Position geschlossen werden muss. '''
+        prebooked = np.zeros(len(data), dtype=bool)
+        close_lot = np.zeros(len(data), dtype=bool)
+        if data.empty:
+            return prebooked, close_lot
+
+        keys = pd.DataFrame({
+            "activityCode": data["activityCode"].to_numpy(),
+            "assetCategory": data["assetCategory"].to_numpy(),
+            "sign": np.sign(pd.to_numeric(data["amount"], errors="coerce").fillna(0)).astype(int).to_numpy()})
+
+        for (activity_code, asset_category, sign), positions in keys.groupby(
+                ["activityCode", "assetCategory", "sign"]).indices.items():
+            rule = self.dispatch_table.stateless_rule(activity_code, asset_category, sign)
+            if rule is None:
+                continue
+
+            started = time.perf_counter()
+            prebooked[positions] = True
+            rows = data.iloc[positions]
+
+            # Bei den CFD Zahlungen entscheidet die Zeile, ob es Zinsen oder Kursdifferenzen sind (apply_cfd_charge)
+            if rule.handler == "cfd_charge":
+                description = rows["activityDescription"].astype(str)
+                interest = ((rows["symbol"] == "") & description.str.contains("CFD INTEREST", regex=False)).to_numpy()
+                fx = ((rows["symbol"] != "") & description.str.contains("USD", regex=False)).to_numpy()
+                variants = [(rule.variants["interest"], interest), (rule.variants["fx"], fx)]
+            else:
+                variants = [(rule, np.ones(len(rows), dtype=bool))]
 
-                else:
-                    logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                    logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
+            for variant, selected in variants:
+                if selected.any() and self.book_stateless(rows[selected], variant, positions[selected]):
+                    close_lot[positions[selected]] = True
 
-                    if row["amount"] == 0:
-                        self.track_processing(account_id, row["transactionID"], row["amount"], row["date"])
+            # Die Zeilen werden in book_rows gezählt, hier kommt nur die Zeit für den Block dazu
+            if self.instrumentation.enabled:
+                self.instrumentation.add_branch(activity_code, asset_category, time.perf_counter() - started, 0)
 
-            elif row["activityCode"] == "BFEE":
+        return prebooked, close_lot
 
-                self.book_statement(row=row, id="ATG_0000010_0000001",
-                                    desc="Investitionszinsen ", sdesc="Zinszahlung",
-                                    amount=row["amount"], soll=7300, haben=bank_account_id, account_id=account_id,
-                                    quality_check_relevant=True)
+    def is_store_empty(self, position):
+        ''' Prüft, ob es vor der Zeile keine offenen Positionen gibt. In einem Shard wird der Zustand aller
+            offenen Positionen des Accounts über assumed_empty vorgegeben (siehe book_shards). '''
+        if self.assumed_empty is None:
+            return self.fifo_positions.empty
+        return position in self.assumed_empty
 
-            elif row["activityCode"] == "BUY":
+    def book_rows(self, records, positions, prebooked, close_lot):
+        ''' Verbucht die Zeilen nacheinander mit den offenen Positionen aus self.fifo_positions.
+            positions sind die Positionen der Zeilen im Account, prebooked und close_lot gehören zu den Zeilen
+            (siehe generate_stateless_statements). Gibt die Anzahl der offenen Positionen nach jeder Zeile zurück. '''
 
-                # Kauf von Aktien
-                if row["assetCategory"] == "STK":
-                    if position_open == False:  # Falls es keine offenen Positionen gibt, kaufe ich die Aktien
-                        self.book_statement(row=row, id="ATG_0000005_0000001",
-                                            desc="Aktienkauf", sdesc="keine offene Position",
-                                            amount=row["amount"], soll=1510, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                        self.add_open_position(row)
-
-                    elif position_open == True:  # Falls offene Position, Short oder Long im Depot?
-
-                        # Wenn ich schon long bin, muss ich die Position erhöhen
-                        if open_in_depot["tradeQuantity"].sum() >= 0:
-                            self.book_statement(row=row, id="ATG_0000005_0000001",
-                                                desc="Aktienkauf", sdesc="Erhöhung der offenen Position",
-                                                amount=row["amount"], soll=1510, haben=bank_account_id,
-                                                account_id=account_id, quality_check_relevant=True)
-
-                            # hier muss ich die offene Position manuell hinterlegen
-                            self.add_open_position(row)
-
-                        # Wenn ich eine bestehende Short-Position habe, muss ich diese FIFO mäßig verarbeiten
-                        elif open_in_depot["tradeQuantity"].sum() < 0:
-                            stock_adjustment, restbuchwert, einnahmen = self.close_position_fifo(
-                                "BUYTOCLOSESHORT", row, open_in_depot, stock_adjustment, restbuchwert, einnahmen,
-                                bank_account_id, account_id)
-
-                # Kauf einer Option
-                elif (row["assetCategory"] == "OPT" or row["assetCategory"] == "FOP"):
-
-                    # Fall 1: No open position => create long entry
-                    if position_open == False:
-                        self.book_statement(row=row, id="ATG_0000002_0000003",
-                                            desc="Optionkauf", sdesc="keine offene Position",
-                                            amount=row["amount"], soll=1510, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                        # hier muss ich die offene Position manuell hinterlegen
-                        self.add_open_position(row)
-
-                    if position_open == True:
-                        if open_in_depot["tradeQuantity"].sum() <= 0:
-                            stock_adjustment, restbuchwert, einnahmen = self.close_position_fifo(
-                                "BUYTOCLOSESHORT", row, open_in_depot, stock_adjustment, restbuchwert, einnahmen,
-                                bank_account_id,
-                                account_id=account_id)
-                        elif open_in_depot["tradeQuantity"].sum() > 0:
-                            self.book_statement(row=row, id="Tbd",
-                                                desc="Optionkauf", sdesc="Erhöhung der bestehenden Long-Position",
-                                                amount=row["amount"], soll=1300, haben=bank_account_id,
-                                                account_id=account_id, quality_check_relevant=True)
-                            # hier muss ich die offene Position manuell hinterlegen
-                            self.add_open_position(row)
-
-                # Gewinn- und Verlustberechnung CFD
-                elif row["assetCategory"] == "CFD":
-
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000002",
-                                            desc="CFD-Handel", sdesc="Verlust",
-                                            amount=row["amount"], soll=6300, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000001",
-                                            desc="CFD-Handel", sdesc="Gewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4905,
-                                            account_id=account_id, quality_check_relevant=True)
-                    else:  # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf
-                        # auf einer Position agregiert werden, d.h. die Teilverkäufe bekommen hier keinen Abzug
-                        # daher tracke ich in einem solchen Fall nur dass ich den Datensatz bearbeitet habe,
-                        # aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
-                        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
-
-                # Gewinn- und Verlustberechnung FUT
-                elif row["assetCategory"] == "FUT":
-
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="tbd",
-                                            desc="Future-Handel", sdesc="Verlust",
-                                            amount=row["amount"], soll=6300, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="tbd",
-                                            desc="Future-Handel", sdesc="Gewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4905,
-                                            account_id=account_id, quality_check_relevant=True)
-                    else:  # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf
-                        # auf einer Position agregiert werden, d.h. die Teilverkäufe bekommen hier keinen Abzug
-                        # daher tracke ich in einem solchen Fall nur dass ich den Datensatz bearbeitet habe,
-                        # aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
-                        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
+        # Da ich jede Zeile verbuchen muss, prüfe ich jede Zeile einzeln
+        lot_counts = []
+        instrumentation = self.instrumentation if self.instrumentation.enabled else None
+        trace = self.trace if self.trace.active else None
+        row = None
+        try:
+            for position, row, is_prebooked, is_close_lot in zip(positions, records, prebooked, close_lot):
+                if instrumentation is not None:
+                    started = time.perf_counter()
+                    branch = (row["activityCode"], row["assetCategory"])
+                self.journal_buffer.position = position
+                self.processed_registry.position = position
+                self.fifo_positions.position = position
+                account_id = row["accountId"]
+                position_open = False
+                open_in_depot = []
+                open_quantity = 0  # Summe der tradeQuantity der Lots in open_in_depot
+                bank_account_id = self.account_mapping[account_id]
+
+                # Ich prüfe zuerst, ob ich eine offene Position im Depot habe, die ich
+                # dann nach dem FIFO-Prinzip verarbeiten muss
+                if not row["symbol"] == "":
+                    if not self.is_store_empty(position):
+                        if self.fifo_positions.has_symbol(row["symbol"]):
+                            position_open = True
+                            open_in_depot = self.fifo_positions.lots_for_symbol(row["symbol"])
+                            open_quantity = self.fifo_positions.quantity_for_symbol(row["symbol"])
+                        else:
 
+                            # As I have a Case where IB changed the underlying symbol name,
+                            # I need to do a seperate check
+                            # this is covered in the test case SPECIAL_CASE_DELL
+                            if row["activityCode"] == "EXP":  # currently only the case for expirations
+                                find_addition = row["underlyingSymbol"].rfind("1")  # check if there is a 1 at the end
+                                if find_addition > 0:  # if yes
+                                    cleaned_string = row["underlyingSymbol"][:-1]  # get the correct string
+                                    correct_entry = row["symbol"].replace(row["underlyingSymbol"], cleaned_string + " ")
+
+                                    # now, check again if I have an open position
+                                    if self.fifo_positions.has_symbol(correct_entry):
+                                        position_open = True
+                                        open_in_depot = self.fifo_positions.lots_for_symbol(correct_entry)
+                                        open_quantity = self.fifo_positions.quantity_for_symbol(correct_entry)
+                                        row["symbol"] = correct_entry
+                                    else:
+                                        self.fifo_positions.append(row)
+                                        position_open = False
+                            else:
+                                self.fifo_positions.append(row)
+                                position_open = False
                 else:
-                    logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                    logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
-
-            elif row["activityCode"] == "CFD":  # CFD Interest and Fees
-                # Unter diesem Code werden nur die Kursdifferenzen und Zinsen des CFD Handels aufgeführt,
-                # die Käufe- und Verkäufe werden wie bei den Aktien unter Sell und Buy getätigt
-
-                # Zinsen
-                if (row["symbol"] == "") and "CFD INTEREST" in row["activityDescription"]:
-
-                    if row["amount"] <= 0:
-                        self.book_statement(row=row, id="ATG_0000009_0000001",
-                                            desc="CFD-Handel", sdesc="Zinsaufwendung",
-                                            amount=row["amount"], soll=7300, haben=bank_account_id,
-                                            account_id=account_id,
-                                            quality_check_relevant=True, text=row["activityDescription"])
-                        self.close_open_position(row["transactionID"])
-
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="ATG_0000009_0000002",
-                                            desc="CFD-Handel", sdesc="Zinsgewinne",
-                                            amount=row["amount"], soll=bank_account_id, haben=7300,
-                                            account_id=account_id,
-                                            quality_check_relevant=True, text=row["activityDescription"])
-                        self.close_open_position(row["transactionID"])
-
-                # Kursdifferenzen
-                if (row["symbol"] != "") and "USD" in row["activityDescription"]:
-
-                    # Kursverluste
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000004",
-                                            desc="CFD-Handel", sdesc="Kursverlust",
-                                            amount=row["amount"], soll=6880, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True,
-                                            text=row["activityDescription"])
-                    # Kursgewinne
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000003",
-                                            desc="CFD-Handel", sdesc="Kursgewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4840,
-                                            account_id=account_id, quality_check_relevant=True,
-                                            text=row["activityDescription"])
-                    else:
-                        logging.error("Der Trade konnte nicht verbucht werden!")
-
-            elif row["activityCode"] == "CINT":  # Credit Interest on cash balances
-
-                if row["amount"] <= 0:
-                    self.book_statement(row=row, id="ATG_0000009_0000001",
-                                        desc="Zinsaufwendungen", sdesc="Bezahlte Zinsen",
-                                        amount=row["amount"], soll=7300, haben=bank_account_id, account_id=account_id,
-                                        quality_check_relevant=True, text=row["activityDescription"])
-                elif row["amount"] > 0:
-                    self.book_statement(row=row, id="ATG_0000009_0000002",
-                                        desc="Zinsaufwendungen", sdesc="Erhaltene Zinsen",
-                                        amount=row["amount"], soll=bank_account_id, haben=7100, account_id=account_id,
-                                        quality_check_relevant=True, text=row["activityDescription"])
-
-            elif row["activityCode"] == "DINT":
-                if row["amount"] <= 0:
-                    self.book_statement(row=row, id="ATG_0000009_0000001",
-                                        desc="Zinsaufwendungen", sdesc="Bezahlte Zinsen",
-                                        amount=row["amount"], soll=7300, haben=bank_account_id, account_id=account_id,
-                                        quality_check_relevant=True, text=row["activityDescription"])
-                elif row["amount"] > 0:
-                    self.book_statement(row=row, id="ATG_0000009_0000002",
-                                        desc="Zinsaufwendungen", sdesc="Erhaltene Zinsen",
-                                        amount=row["amount"], soll=bank_account_id, haben=7100, account_id=account_id,
-                                        quality_check_relevant=True, text=row["activityDescription"])
-
-            elif row["activityCode"] == "DIV":
-                self.book_statement(row=row, id="ATG_0000008_0000001",
-                                    desc="Dividendeneinnahmen", sdesc="Verbuchung der Dividenden",
-                                    amount=row["amount"], soll=bank_account_id, haben=7020, account_id=account_id,
-                                    quality_check_relevant=True)
-
-            elif row["activityCode"] == "EXP":
-                # ATG_0000003: Expiration einer Stillhalterposition
-                if (row["assetCategory"] == "OPT" or row["assetCategory"] == "FOP"):
-                    if position_open:
-                        self.book_statement(row=row, id="ATG_0000003_0000001",
-                                            desc="Expiration einer Stillhalterposition", sdesc="Verbuchen des Gewinns",
-                                            amount=abs(open_in_depot["amount"].iloc[0]), soll=3500, haben=4830,
-                                            account_id=account_id, quality_check_relevant=False)
-
-                        self.close_open_position(open_in_depot["transactionID"].iloc[0])
-
+                    if self.fifo_positions.has_description(row["activityDescription"]):
+                        position_open = True
+                        open_in_depot = self.fifo_positions.lots_for_description(row["activityDescription"])
+                        open_quantity = self.fifo_positions.quantity_for_description(row["activityDescription"])
                     else:
-                        if row["amount"] == 0:
-                            self.track_processing(account_id, row["transactionID"], row["amount"], row["date"])
-
+                        self.fifo_positions.append(row)
+                        position_open = False
+
+                if trace is not None:
+                    trace.record(logging.DEBUG, "Zeile", transactionID=row["transactionID"],
+                                 activityCode=row["activityCode"], assetCategory=row["assetCategory"],
+                                 symbol=row["symbol"], amount=row["amount"], position_open=position_open)
+
+                # Die Suche nach der offenen Position muss auch für die vorab verbuchten Zeilen laufen, da diese dabei
+                # in die offenen Posten aufgenommen werden. Es fehlt nur noch das Schließen der Position.
+                if is_prebooked:
+                    if is_close_lot:
+                        self.close_open_position(row["transactionID"])
+                    lot_counts.append(len(self.fifo_positions))
+                    if instrumentation is not None:
+                        instrumentation.add_branch(*branch, time.perf_counter() - started)
+                    continue
+
+                # Hier drösle ich nun die einzelnen Geschäftsvorfälle auf und
+                # berwete diese ja nach Fall und Gegebenheit
+                sign = amount_sign(row["amount"])
+                if position_open and row["activityCode"] in self.dispatch_table.state_codes:
+                    state = position_state(open_quantity)
+                elif position_open:
+                    state = FLAT
                 else:
-                    logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                    logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
-
-            elif row["activityCode"] == "FOREX":
-                if row["assetCategory"] == "CASH":
-                    if row["amount"] > 0:
-                        self.book_statement(row=row, id="tbd",
-                                            # TODO: neuer Fall, Konto muss noch geprüft werden ob richtig
-                                            desc="Währungsumrechnung", sdesc="Verbuchung des Gewinns",
-                                            amount=row["amount"], soll=bank_account_id, haben=4840,
-                                            account_id=account_id,
-                                            quality_check_relevant=True)
-                    elif row["amount"] < 0:
-                        self.book_statement(row=row, id="tbd",
-                                            # TODO: neuer Fall, Konto muss noch geprüft werden ob richtig
-                                            desc="Währungsumrechnung", sdesc="Verbuchung des Verlusts",
-                                            amount=row["amount"], soll=bank_account_id, haben=6880,
-                                            account_id=account_id,
-                                            quality_check_relevant=True)
-
-                    elif row["amount"] == 0:
-                        pass
-
-                    else:
-                        logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                        logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
-
-            elif row["activityCode"] == "FRTAX":
-                self.book_statement(row=row, id="ATG_0000008_0000002",
-                                    desc="Dividendeneinnahmen", sdesc="Verbuchung der Quellsteuer",
-                                    amount=row["amount"], soll=7639, haben=bank_account_id, account_id=account_id,
-                                    quality_check_relevant=True)
-
-            elif row["activityCode"] == "OFEE":
-
-                if row["amount"] <= 0:
-                    self.book_statement(row=row, id="ATG_0000007_0000001",
-                                        desc="Marktdatengebuehren", sdesc="Verbuchung der Kosten",
-                                        amount=row["amount"], soll=6300, haben=bank_account_id, account_id=account_id,
-                                        quality_check_relevant=True)
-
-                elif row["amount"] > 0:
-                    self.book_statement(row=row, id="ATG_0000007_0000002",
-                                        desc="Marktdatengebuehren", sdesc="Verbuchung der Gutschrift",
-                                        amount=row["amount"], soll=bank_account_id, haben=6300, account_id=account_id,
-                                        quality_check_relevant=True)
-
-            elif row["activityCode"] == "PIL":
-                self.book_statement(row=row, id="",
-                                    # TODO => neu, Ersatzzahlung Dividenden https://ibkr.info/article/2713
-                                    desc="Dividendeneinnahmen", sdesc="Payment in Lieu of Dividend (Ordinary Dividend)",
-                                    amount=row["amount"], soll=bank_account_id, haben=7020, account_id=account_id,
-                                    quality_check_relevant=True)
-
-            elif row["activityCode"] == "SELL":
-
-                if row["assetCategory"] == "CFD":
-                    # Bei den CFD's habe ich keine direkte Position, sondern mir werden täglich die Gebühren
-                    # in Rechnung gestellt, somit ist es hier egal, ob eine Position eröffnet ist oder nicht
-                    # wenn keine Position eröffnet ist, gehe ich davon aus, dass diese noch besteht und ich die
-                    # verrechnung zu Recht bekomme. Daher schließe ich auch hier keine Position
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000002",
-                                            desc="CFD-Handel", sdesc="Verlust",
-                                            amount=row["amount"], soll=6300, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000001",
-                                            desc="CFD-Handel", sdesc="Gewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4905,
-                                            account_id=account_id, quality_check_relevant=True)
-
-                        self.close_open_position(int(row["transactionID"]))
-                    else:  # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf
-                        # auf einer Position agregiert werden, d.h. die Teilverkäufe bekommen hier keinen Abzug
-                        # daher tracke ich in einem solchen Fall nur dass ich den Datensatz bearbeitet habe,
-                        # aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
-                        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
-
-                elif row["assetCategory"] == "FUT":
-                    # Bei den Futures habe ich keine direkte Position, sondern mir werden täglich die Gebühren
-                    # in Rechnung gestellt, somit ist es hier egal, ob eine Position eröffnet ist oder nicht
-                    # wenn keine Position eröffnet ist, gehe ich davon aus, dass diese noch besteht und ich die
-                    # verrechnung zu Recht bekomme. Daher schließe ich auch hier keine Position da ich weder eine
-                    # offene, noch eine geschlossene Position tracke => falls ich jemald auch den Abgleich auf
-                    # direkter Ebene zu meinem Depot machen will, muss ich die Positionan manuell eröffnen und
-                    # schließen
-                    if row["amount"] < 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000020",
-                                            desc="Futures-Handel", sdesc="Verlust",
-                                            amount=row["amount"], soll=6300, haben=bank_account_id,
-                                            account_id=account_id, quality_check_relevant=True)
-                    elif row["amount"] > 0:
-                        self.book_statement(row=row, id="ATG_0000010_0000025",
-                                            desc="Futures-Handel", sdesc="Gewinn",
-                                            amount=row["amount"], soll=bank_account_id, haben=4905,
-                                            account_id=account_id, quality_check_relevant=True)
-                    else:  # es kommt vor, dass ich auch 0 € Buchungen habe, da die Kosten für den Verkauf
-                        # auf einer Position agregiert werden, d.h. die Teilverkäufe bekommen hier keinen Abzug
-                        # daher tracke ich in einem solchen Fall nur dass ich den Datensatz bearbeitet habe,
-                        # aber ich buche keine 0-Buchung, da Kostentechnisch nicht relevant
-                        self.track_processing(account_id, int(row["transactionID"]), row["amount"], row["date"])
-
-                elif (row["assetCategory"] == "OPT" or row["assetCategory"] == "FOP"):
-                    # If I do not have an open position, I will short a position
-                    if position_open == False:
-                        self.book_statement(row=row, id="ATG_0000002_0000001",
-                                            desc="Eröffnen einer Stillhalterposition",
-                                            sdesc="Eröffnung ohne bestehende Long-Position",
-                                            amount=row["amount"], soll=bank_account_id, haben=3500,
-                                            account_id=account_id, quality_check_relevant=True)
-                        self.add_open_position(row)
-
-                    # TODO: Position erhöhen, oder Teilposition schließen
-                    elif position_open == True:
-
-                        # Wenn ich schon short bin, muss ich meine Position erhöhen
-                        if open_in_depot["tradeQuantity"].sum() < 0:
-                            self.book_statement(row=row, id="ATG_0000002_0000002",
-                                                desc="Eröffnen einer Stillhalterposition",
-                                                sdesc="Erhöhung der Shortposition",
-                                                amount=row["amount"], soll=bank_account_id, haben=3500,
-                                                account_id=account_id, quality_check_relevant=True)
-
-                            self.add_open_position(row)  # Add entry to open position
-
-                        # If I'm long in the option, I need to close it FIFO
-                        elif open_in_depot["tradeQuantity"].sum() > 0:
-                            stock_adjustment, restbuchwert, einnahmen = self.close_position_fifo(
-                                "SELLTOCLOSELONG", row, open_in_depot, stock_adjustment, restbuchwert, einnahmen,
-                                bank_account_id,
-                                account_id=account_id)
-
-                elif (row["assetCategory"] == "STK"):
-                    if position_open == False:  # Falls es keine offenen Positionen gibt, eröffne ich einen Short
-                        self.book_statement(row=row, id="ATG_0000006_0000005",
-                                            desc="Aktienverkauf", sdesc="Sell-Short, ohne offene Position",
-                                            amount=row["amount"], soll=bank_account_id, haben=1510,
-                                            account_id=account_id, quality_check_relevant=True)
-                        self.add_open_position(row)
-
-                    elif position_open == True:  # Falls offene Position, Short oder Long im Depot?
-
-                        # Wenn ich schon short bin, muss ich die Position erhöhen
-                        if open_in_depot["tradeQuantity"].sum() < 0:
-                            self.book_statement(row=row, id="ATG_0000006_0000005",
-                                                desc="Aktienverkauf", sdesc="Erhöhung der Shortposition",
-                                                amount=row["amount"], soll=bank_account_id, haben=1510,
-                                                account_id=account_id, quality_check_relevant=True)
-
-                            self.add_open_position(row)
+                    state = NO_POSITION
+
+                entry = self.dispatch_table.get((row["activityCode"], row["assetCategory"], sign, state))
+                if entry is not None:
+                    handler, rule = entry
+                    handler(row, rule, open_in_depot, bank_account_id, account_id)
+
+                lot_counts.append(len(self.fifo_positions))
+                if instrumentation is not None:
+                    instrumentation.add_branch(*branch, time.perf_counter() - started)
+        except Exception:
+            # Der Ringpuffer zeigt, was vor der fehlerhaften Zeile verbucht wurde
+            self.trace.dump(f"Die Zeile {row.get('transactionID') if row else None} konnte nicht verbucht werden")
+            raise
+
+        return lot_counts
+
+    def get_shards(self, records, open_records):
+        ''' Teilt die Zeilen und offenen Positionen eines Accounts in unabhängige Shards auf. Zwei Einträge gehören
+            zum selben Shard, sobald sie sich über das Symbol, das korrigierte Symbol bei Verfällen (siehe book_rows)
+            oder die activityDescription finden können. Gibt je Shard die Positionen der Zeilen und der offenen
+            Positionen zurück. '''
+        parents = {}
+
+        def find(key):
+            parents.setdefault(key, key)
+            while parents[key] != key:
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+
+        def get_keys(row):
+            description = ("description", row.get("activityDescription", ""))
+            if row.get("symbol", "") == "":
+                return [description]
+
+            keys = [("symbol", row["symbol"]), description]
+            underlying = row.get("underlyingSymbol", "")
+            if row.get("activityCode") == "EXP" and underlying.rfind("1") > 0:
+                keys.append(("symbol", row["symbol"].replace(underlying, underlying[:-1] + " ")))
+            return keys
+
+        keys = [get_keys(row) for row in records] + [get_keys(lot) for lot in open_records]
+        for row_keys in keys:
+            root = find(row_keys[0])
+            for key in row_keys[1:]:
+                parents[find(key)] = root
+
+        shards = {}
+        for index, row_keys in enumerate(keys):
+            rows, lots = shards.setdefault(find(row_keys[0]), ([], []))
+            if index < len(records):
+                rows.append(index)
+            else:
+                lots.append(index - len(records))
+
+        return list(shards.values())
+
+    def book_shard(self, shard, assumed_empty):
+        ''' Verbucht die Zeilen eines Shards mit eigenem Journal, eigener Registry und eigenen offenen Positionen.
+            Die Zwischenwerte der Teilverkäufe werden nur innerhalb des Shards mitgeführt. '''
+        positions, records, prebooked, close_lot, lots, lot_positions, columns = shard
+
+        self.fifo_positions = FifoLotStore()
+        self.fifo_positions.load(lots, columns, lot_positions)
+        self.journal_buffer = JournalBuffer()
+        self.processed_registry = ProcessingRegistry()
+        self.assumed_empty = assumed_empty
+        self.stock_adjustment = 0
+        self.restbuchwert = 0
+        self.einnahmen = 0
+
+        lot_counts = self.book_rows(records, positions, prebooked, close_lot)
+
+        return ShardResult(positions, lot_counts, len(lots), self.journal_buffer, self.processed_registry,
+                           self.fifo_positions, self.instrumentation.take())
+
+    def book_shard_batch(self, batch, assumed_empty):
+        return [self.book_shard(shard, assumed_empty) for shard in batch]
+
+    def run_shards(self, shards, records, open_records, columns, prebooked, close_lot, assumed_empty):
+        ''' Verbucht die Shards, bei mehreren Prozessen in Batches mit ungefähr gleich vielen Zeilen '''
+        workers = self.max_workers or os.cpu_count() or 1
+
+        # Die Zeilen und offenen Positionen werden beim Verbuchen verändert und daher für jeden Durchlauf kopiert
+        shards = [(rows, [dict(records[position]) for position in rows], prebooked[rows], close_lot[rows],
+                   [dict(open_records[position]) for position in lots],
+                   [position - len(open_records) for position in lots], columns) for rows, lots in shards]
+
+        if workers > 1 and len(shards) > 1:
+            # Große Shards zuerst, danach reihum auf die Batches verteilt
+            order = sorted(range(len(shards)), key=lambda index: len(shards[index][0]), reverse=True)
+            batches = [order[start::workers * 4] for start in range(min(workers * 4, len(shards)))]
+
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                batch_results = executor.map(self.book_shard_batch,
+                                             [[shards[index] for index in batch] for batch in batches],
+                                             repeat(assumed_empty))
+                results = [None] * len(shards)
+                for batch, batch_result in zip(batches, batch_results):
+                    for index, result in zip(batch, batch_result):
+                        results[index] = result
+            return results
+
+        # book_shard ersetzt Journal, Registry und offene Positionen, diese werden danach wiederhergestellt
+        state = (self.fifo_positions, self.journal_buffer, self.processed_registry)
+        try:
+            return self.book_shard_batch(shards, assumed_empty)
+        finally:
+            self.fifo_positions, self.journal_buffer, self.processed_registry = state
+            self.assumed_empty = None
+
+    def book_shards(self, records, open, prebooked, close_lot, max_iterations=5):
+        ''' Verbucht die Zeilen eines Accounts getrennt nach Shards (siehe get_shards), die Shards werden in einem
+            Process-Pool verarbeitet. Journal, Registry und offene Positionen werden über die Positionen der Zeilen
+            wieder in die Reihenfolge der transactionID gebracht.
+
+            Ob es überhaupt offene Positionen gibt, hängt von allen Shards ab. Die Shards werden daher mit einer
+            Annahme dazu verbucht, die anschließend mit der Anzahl der offenen Positionen aller Shards geprüft wird.
+            Nur die Shards mit einer falschen Annahme werden erneut verbucht. Stimmen beide nach max_iterations
+            Durchläufen nicht überein, wird seriell verbucht. '''
+        if open is None:
+            open = pd.DataFrame()
+        open_records = open.to_dict("records")
+        shards = self.get_shards(records, open_records)
+        symbol_positions = {position for position, row in enumerate(records) if row["symbol"] != ""}
+        assumed_empty = set() if open_records else {0}
+
+        results = [None] * len(shards)
+        pending = list(range(len(shards)))
+
+        for _ in range(max_iterations):
+            self.instrumentation.count("book_shards Shards verbucht", len(pending))
+            pending_results = self.run_shards([shards[index] for index in pending], records, open_records,
+                                              list(open.columns), prebooked, close_lot, assumed_empty)
+            for index, result in zip(pending, pending_results):
+                results[index] = result
+                self.instrumentation.merge(result.instrumentation)
+
+            empty = self.get_empty_positions(results, len(records), len(open_records))
+            changed = (empty ^ assumed_empty) & symbol_positions
+            if not changed:
+                break
+
+            assumed_empty = empty
+            pending = [index for index, (rows, _) in enumerate(shards) if not changed.isdisjoint(rows)]
+        else:
+            logging.warning("Die Shards konnten nicht unabhängig verbucht werden, der Account wird seriell verbucht")
+            self.fifo_positions = FifoLotStore(open)
+            self.assumed_empty = None
+            self.book_rows(records, range(len(records)), prebooked, close_lot)
+            return self.fifo_positions.to_dataframe()
 
-                        # Wenn ich eine bestehende Long-Position habe, muss ich diese FIFO mäßig verarbeiten
-                        # Die Umsetzung ist in dem Prozessfluss ATG_0000006_Aktienverkauf_Close_Long beschrieben
-                        elif open_in_depot["tradeQuantity"].sum() > 0:
-                            stock_adjustment, restbuchwert, einnahmen = self.close_position_fifo(
-                                "SELL", row, open_in_depot, stock_adjustment, restbuchwert, einnahmen, bank_account_id,
-                                account_id=account_id)
+        for result in results:
+            self.journal_buffer.merge(result.journal_buffer)
+            self.processed_registry.merge(result.processed_registry)
 
-                else:
-                    logging.error(f"The following assetCategory is not defined: {row['assetCategory']}")
-                    logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
+        return FifoLotStore.combine([result.fifo_positions for result in results], open.columns)
 
-            elif row["activityCode"] == "STAX":
+    def get_empty_positions(self, results, count, open_count):
+        ''' Gibt die Positionen der Zeilen zurück, vor denen es in keinem Shard eine offene Position gibt '''
+        changes = np.zeros(count, dtype=np.int64)
+        for result in results:
+            changes[result.positions] += np.diff(np.asarray(result.lot_counts, dtype=np.int64),
+                                                 prepend=result.open_count)
 
-                self.book_statement(row=row, id="ATG_0000007_0000003",
-                                    desc="Marktdatengebuehren", sdesc="Steuerverbuchung",
-                                    amount=row["amount"], soll=6300, haben=bank_account_id, account_id=account_id,
-                                    quality_check_relevant=True)
+        before = open_count + np.concatenate([[0], np.cumsum(changes)[:-1]])
+        return set(np.flatnonzero(before == 0).tolist())
 
-            else:
-                logging.error(f"The following activity code is not defined: {row['activityCode']}")
-                logging.error(f"Der folgende Eintrag aus der Zeile {i} wurde nicht verarbeitet: {row}")
+    def generate_single_statements(self, data, open, state=None):
+        ''' In dieser Methode prüfe ich nun die einzelnen Datensätze und erstelle hier,
+            basierend auf den einzelnen Buchungsvorschriften und Fällen die
+            einzelnen Buchungssätze. Mit state wird auf dem Zustand eines früheren Laufs weiter verbucht
+            (siehe EngineState), dann werden die offenen Positionen aus open nicht verwendet. '''
 
-        if self.journal.empty:
-            journal = self.journal
+        # Da IB auch Teilverkäufe vornimmt, habe ich hier einen Abgleich eingebaut,
+        # der mir ermöglicht über die einzelen Zeilen hinweg die Trades zu verbuchen
+        self.stock_adjustment = 0
+        self.restbuchwert = 0
+        self.einnahmen = 0
+        if state is not None:
+            self.stock_adjustment, self.restbuchwert, self.einnahmen = state.accumulators
+
+        # Das Log-Level wird einmal für alle Zeilen geprüft
+        self.trace.refresh()
+
+        # Kombinationen ohne Buchungsregel werden einmal vorab gemeldet und nicht verarbeitet
+        unmapped = self.dispatch_table.prepare(data)
+        for (activity_code, asset_category, sign), count in unmapped.items():
+            logging.error(f"Für den activityCode {activity_code} mit der assetCategory {asset_category} und dem "
+                          f"Vorzeichen {sign} ist keine Buchung definiert, {count} Einträge werden nicht verarbeitet")
+
+        # Die zustandslosen Buchungen werden vorab gemeinsam verbucht
+        prebooked, close_lot = self.generate_stateless_statements(data)
+
+        records = data.to_dict("records")
+        if self.parallel_symbols and records:
+            lots = self.book_shards(records, open, prebooked, close_lot)
         else:
-            journal = self.journal[
-                ["Account", "Belegnummer", "SATZ_ID", "DESC", "SUBDESC", "DATE", "SETTLEDATE", "TEXT", "AMOUNT", "SOLL",
-                 "HABEN", "QUALITYREL"]]
-
-        return data, journal, self.fifo_positions
-
-    def generate_booking_journal(self, accounts_to_combine, types_to_process=None):
-        ''' Das ist die Hauptmethode, hier wird der Ablauf gesteuert um das Buchungssjournal zu erstellen'''
+            # Setzen der open files des accounts
+            self.fifo_positions = FifoLotStore(open) if state is None else state.fifo_positions
+            self.assumed_empty = None
+            self.book_rows(records, range(len(records)), prebooked, close_lot)
+            lots = self.fifo_positions.to_dataframe()
+
+        # Das Journal wird erst hier einmalig aus den gesammelten Buchungssätzen erstellt
+        journal = pd.DataFrame()
+        if len(self.journal_buffer) > 0:
+            journal = self.journal_buffer.to_dataframe()
+            self.journal_buffer.clear()
+
+        return data, journal, lots
+
+    def get_engine_state_path(self, account):
+        return os.path.join(self.pickle_files, f"EngineState_{account}.pkl")
+
+    def load_open_positions(self, account):
+        ''' Die offenen Positionen des Accounts aus dem Import, sonst aus working_files '''
+        if account in self.open_positions:
+            return self.open_positions[account]
+        return self.store.read(OPEN_POSITIONS.format(account=account))
+
+    def get_stored_journal(self, account, state):
+        ''' Die abgelegten Buchungen des Accounts, wenn sie zum Zustand passen, sonst None '''
+        if not has_current_journal(self.store):
+            return None
+        if self.store.get_attributes(JOURNAL).get("engine_states", {}).get(account) != state.digest:
+            return None
+        if self.store.get_rows(JOURNAL, partitions=[account]) != state.journal_rows:
+            return None
+        if state.journal_rows == 0:
+            return pd.DataFrame(columns=JOURNAL_COLUMNS)
+        return self.store.read(JOURNAL, partitions=[account], mmap_mode=None)
+
+    def save_engine_state(self, account, state, journal, stored_rows):
+        ''' Hängt die neuen Buchungen an die Partition des Accounts im abgelegten Journal an und speichert danach
+            den Zustand. Läuft im Hauptprozess, damit bei parallel nur ein Prozess die Ablage schreibt.
+            Bei stored_rows = 0 werden die bisherigen Buchungen des Accounts ersetzt. '''
+        new_journal = journal.iloc[stored_rows:]
+        new_journal = new_journal[JOURNAL_COLUMNS] if not new_journal.empty else pd.DataFrame(columns=JOURNAL_COLUMNS)
+
+        if has_current_journal(self.store):
+            engine_states = self.store.get_attributes(JOURNAL).get("engine_states", {})
+            self.store.append(JOURNAL, new_journal, attributes={"engine_states": {**engine_states,
+                                                                                  account: state.digest}},
+                              replace=[account] if stored_rows == 0 else [])
+        else:
+            if self.store.exists(JOURNAL):
+                logging.warning("The stored journal was written by another version, only the accounts booked in "
+                                "this run are kept")
+            self.store.write(JOURNAL, new_journal, partition_by="Account",
+                             attributes={"amount_scale": SCALE, "engine_states": {account: state.digest}})
+
+        state.save(self.get_engine_state_path(account))
+
+    def generate_incremental_statements(self, account, data, open):
+        ''' Verbucht nur die Zeilen, die nach dem gespeicherten Zustand des Accounts dazugekommen sind. Die
+            bisherigen Buchungen werden aus dem abgelegten Journal gelesen. Gibt es keinen passenden Zustand oder
+            passt das Journal nicht dazu, werden alle Zeilen verbucht. Das Ergebnis (Journal, Registry, offene
+            Positionen) entspricht einem kompletten Lauf. Gibt zusätzlich den neuen Zustand und die Anzahl der
+            bereits abgelegten Buchungen zurück, gespeichert wird beides mit save_engine_state. '''
+        path = self.get_engine_state_path(account)
+        open_hash = pd.util.hash_pandas_object(open, index=False).to_numpy().tobytes() if not open.empty else b""
+        # Alle Einstellungen, die das Ergebnis der Verbuchung verändern, gehören in den Fingerprint
+        fingerprint = get_fingerprint(account, self.start, self.end, sorted(self.account_mapping.items()),
+                                      sorted(self.accounts_to_combine.items()), list(open.columns), open_hash)
+
+        state = EngineState.load(path, fingerprint)
+        if state is not None and not state.covers(data):
+            logging.info(f"Die bereits verbuchten Zeilen haben sich geändert, Account {account} wird komplett "
+                         f"neu verbucht")
+            state = None
+        stored_journal = None if state is None else self.get_stored_journal(account, state)
+        if state is not None and stored_journal is None:
+            logging.info(f"Das abgelegte Journal passt nicht zum Zustand, Account {account} wird komplett neu "
+                         f"verbucht")
+            state = None
+        if state is None:
+            state = EngineState(fingerprint)
+            state.fifo_positions = FifoLotStore(open)
+            stored_journal = pd.DataFrame(columns=JOURNAL_COLUMNS)
+
+        new_data = state.get_new_rows(data)
+        logging.info(f"{len(new_data)} neue Zeilen werden verbucht, Account {account}")
+        _, journal, _ = self.generate_single_statements(new_data, None, state)
+
+        state.commit(new_data, journal, self.processed_registry, self.fifo_positions,
+                     (self.stock_adjustment, self.restbuchwert, self.einnahmen))
+
+        self.processed_registry = state.processed_registry
+        stored_rows = len(stored_journal)
+        if stored_rows and not journal.empty:
+            journal = pd.concat([stored_journal, journal], ignore_index=True)
+        elif stored_rows:
+            journal = stored_journal.reset_index(drop=True)
+        return journal, state.fifo_positions.to_dataframe(), state, stored_rows
+
+    def process_account(self, account, data, downloaded_data):
+        ''' Verarbeitet einen Account von der Selektion bis zum Export. Die Methode hängt nur von den Daten des
+            Accounts ab und kann daher auch in einem eigenen Prozess laufen (siehe generate_booking_journal). '''
+
+        logging.info(f"The following account will now be processed: {account} .........")
+
+        # Jeder Account bekommt seine eigene Liste der verarbeiteten Transaktionen
+        self.processed_registry = ProcessingRegistry()
+        self.modified_data = data
+
+        self.instrumentation.begin("Schritt 01 Statuszeilen")
+        # Schritt 01: Löschen der IB-Internen Statuszeilen:
+        # - Starting Balance
+        # - FX Translation P&L
+        # - Ending Balance
+        data = data[(data["activityDescription"] != "Starting Balance")]
+        data = data[(data["activityDescription"] != "FX Translations P&L")]
+        data = data[(data["activityDescription"] != "Ending Balance")]
+
+        self.instrumentation.begin("Schritt 02 Bankbewegungen")
+        # Schritt 02: Löschen der Bankbewegungen
+        # Diese müssen manuell gebucht werden um Doppelbuchungen zu vermeiden
+        # TODO: hier kann ich noch den Buchhungssatz für den Transfer zwischen den IB-Accounts einbauen
+        is_bank_transfer = (data["activityCode"] == "WITH") | (data["activityCode"] == "DEP")
+        bank_transfers = data[is_bank_transfer]
+        data = data[~is_bank_transfer]
+
+        self.instrumentation.begin("Schritt 03 Sortieren und Filtern")
+        # Schritt 03: Sortieren der Buchungen nach der Transaktions-ID um Fehlbuchungen zu vermeiden und
+        # filtern der Daten nach dem Datum
+        data.sort_values(by='transactionID', ascending=True, inplace=True)
+        data = data[data["date"] >= pd.to_datetime(self.start, format="%Y%m%d")]
+        data = data[data["date"] <= pd.to_datetime(self.end, format="%Y%m%d")]
+
+        # Zeilen ohne transactionID können weder in der Reihenfolge eingeordnet noch als verarbeitet gemerkt werden,
+        # sie werden nicht verbucht und fallen in den Quality Checks als nicht verarbeitet auf
+        has_id = data["transactionID"].notna().to_numpy()
+        if not has_id.all():
+            logging.error(f"{int((~has_id).sum())} Einträge ohne transactionID werden nicht verbucht, "
+                          f"Account {account}")
+
+        ##################################################################################################
+        # Debug Hilfen
+        # list_to_check = [400141989, ]
+        # data = data.loc[data["transactionID"].isin(list_to_check)]
+
+        # list_to_check = ["OFEE", ]
+        # data = data.loc[data["assetCategory"].isin(list_to_check)]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+        # data = data.loc[data["symbol"].isin(["UA",])]
+
+        ##################################################################################################
+
+        # Quality Check - IB Report: Cash Report - Broker Interest Paid and Received
+        # list_to_check = ["DINT", "CINT", "BFEE"]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Cash Report - Dividends
+        # list_to_check = ["DIV",]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Cash Report - Withholding Tax
+        # list_to_check = ["FRTAX",]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Cash Report - Sales Tax
+        # list_to_check = ["STAX",]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Cash Report - CFD Charges
+        # list_to_check = ["CFD",]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Cash Report - Other Fees
+        # list_to_check = ["OFEE",]
+        # data = data.loc[data["activityCode"].isin(list_to_check)]
+
+        # Quality Check - IB Report: Commissions
+        print(f"The trade commission in total is {data['tradeCommission'].sum()}")
+
+        ##################################################################################################
+
+        self.instrumentation.begin("Schritt 04 Offene Positionen laden")
+        # Schritt 04: Laden der offenen Positionen
+        open = self.load_open_positions(account)
+
+        self.instrumentation.begin("Schritt 05 Buchungssätze")
+        # Schritt 05: Erstellen der einzelnen Buchungsdaten => Methode: Generate Single Statements
+        # Bei einem inkrementellen Lauf werden nur die Zeilen nach dem letzten Lauf verbucht
+        engine_state, stored_rows = None, 0
+        if self.incremental:
+            journal, open, engine_state, stored_rows = self.generate_incremental_statements(account, data[has_id],
+                                                                                             open)
+        else:
+            _, journal, open = self.generate_single_statements(data[has_id], open)
+
+        self.instrumentation.begin("Schritt 06 Offene Positionen bereinigen")
+        # Schritt 06: Löschen der einzenen, nicht relevanten Einträge aus der Open-Trade Liste,
+        # wie z.B. die Dividendenzahlungen, Margin Variation Zahlungen, etc.
+        open = self.delete_selected_fifo_positions(open)
+
+        self.instrumentation.begin("Schritt 07 Quality Checks")
+        # Schritt 07: Quality Checks und Fehlerhandling!
+
+        # Schritt 07.01. - Abgleich der Salden aus den einzelnen Datenlisten
+        # Die Summen werden exakt als Ganzzahlen gebildet und verglichen (siehe FixedPoint)
+        modified_data_amount = int(np.abs(to_fixed_array(data["amount"])).sum())
+
+        if journal.empty:
+            quality_check = "no bookings generated"
+            journal_data_amount = 0
+        elif self.modified_data.empty:
+            quality_check = "no bookings generated"
+            modified_data_amount = 0
+        else:
+            # Only take relevant data into consideration, flag is set in the booking statements
+            relevant = (journal["Account"] == account) & (journal["QUALITYREL"] == True)
+            journal_data_amount = int(journal.loc[relevant, "AMOUNT"].astype("int64").abs().sum())
 
-        # Einlesen der Daten, die verarbeitet werden sollen, die offenen Positionen werden
-        # weiter unten pro Account eingelesen
-        imported_data = self.imported_data
-        modified_data = imported_data
-        results = []
+            if journal_data_amount == modified_data_amount:
+                quality_check = "erfolgreich"
+            else:
+                quality_check = "nicht erfolgreich"
+
+        # Ausgabe des Ergebnisses
+        journal_data_amount = round(from_fixed(journal_data_amount), 2)
+        modified_data_amount = round(from_fixed(modified_data_amount), 2)
+        print(f"Qualitätscheck Validierung: {quality_check}, "
+              f"die Journalsummer ist {journal_data_amount} und "
+              f"die der verabrbeiteten Daten ist {modified_data_amount}, Account {account}")
+
+        # Schritt 07.2. - Prüfung ob alle Zeilen verarbeitet wurden
+        # Die Daten, die in den "modified data" waren und nicht in den processed IDs aufgenommen wurden
+        # wurden nicht verarbeitet. Optimalerweise sind alle zeilen verarbeitet worden
+        processed_for_this_account = self.processed_registry.to_dataframe(account)
+        not_processed = data[~data["transactionID"].isin(processed_for_this_account["transactionID"])]
+
+        if not not_processed.empty:
+            logging.info(f"{len(not_processed)} Einträge wurden nicht verarbeitet, Account {account}")
+
+        # Schritt 07.3. - Buchungsdatum berücksichtigen
+        # IB gibt nicht bei allen Zeilen ein Settle-Datum aus und daher nehme ich überall wo es ausgegeben wird,
+        # das IB Buchungsdatum und wo es nicht ausgegeben wird das Datum was ein IB in dem Datumsfeld angibt
+
+        if not journal.empty:
+            journal["SETTLEDATE"] = journal["SETTLEDATE"].mask(journal["SETTLEDATE"].isna(), journal["DATE"])
+
+        self.instrumentation.begin("Schritt 08 Buchhaltung simulieren")
+        # Schritt 08:
+        # Simulation der Buchhaltung und des Jahresabschlusses
+        accounting = pd.DataFrame()
+        account_summary = pd.DataFrame()
+        if not journal.empty:
+            simulation_journal = journal[journal["Account"] == account]
+            accounting, account_summary, accounting_simulation_final = self.accounting_check(
+                simulation_journal, drill_down=save_accounting_drill_down)
+
+        self.instrumentation.begin("Schritt 09 Excel Export")
+        # Schritt 09:
+        # Nun speichere ich die ganzen Daten noch in einer Excel, um diese dann final abzulegen
+        if save_to_excel:
+            # create the writer object
+            path_to_store = os.path.join(self.dir_export, f"AccountingJournal_{account}.xlsx")
+            writer = pd.ExcelWriter(path_to_store, engine='xlsxwriter')
+            path_open_positions = os.path.join(self.dir_export, f"OpenPositions_{account}.xlsx")
+            writer_open_positions = pd.ExcelWriter(path_open_positions, engine='xlsxwriter')
+
+            # save the data to the excel
+
+            # Imported or Downloaded Data
+            df_to_store = downloaded_data
+            df_to_store.to_excel(writer, sheet_name='Downloaded_Data', index=False)
+
+            # From the program modified data
+            df_to_store = data[data["accountId"] == account]
+            df_to_store.to_excel(writer, sheet_name='Modified_Data', index=False)
+
+            # Excluded bank transfer data
+            df_to_store = bank_transfers[bank_transfers["accountId"] == account]
+            df_to_store.to_excel(writer, sheet_name='Bank_Transfers', index=False)
+
+            # Booking Journal
+            if not journal.empty:
+                df_to_store = journal[journal["Account"] == account].copy()
+                df_to_store["AMOUNT"] = from_fixed(df_to_store["AMOUNT"].astype("int64"))
+                df_to_store.to_excel(writer, sheet_name="Booking_Journal", index=False)
+
+            # Open FIFO Positions
+            if not open.empty:
+                df_to_store = open[open["accountId"] == account]
+                df_to_store.to_excel(writer, sheet_name=f"FIFO_Positions", index=False)
+                df_to_store.to_excel(writer_open_positions, sheet_name=f"OpenPositions", index=False)
+                writer_open_positions.save()
+
+            # Processed ID's
+            if not processed_for_this_account.empty:
+                processed_for_this_account.to_excel(writer, sheet_name="Processed_ID", index=False)
+                # not_processed.to_excel(writer, sheet_name="Not_Processed", index=False)
+
+            # Accounting Simulation
+            if not accounting.empty:
+                accounting.to_excel(writer, sheet_name="Acc_Sim_1", index=False)
+            if not account_summary.empty:
+                account_summary.to_excel(writer, sheet_name="Acc_Sim_2", index=False)
+                accounting_simulation_final.to_excel(writer, sheet_name="Acc_Sim_3", index=False)
+
+            writer.save()
+
+        self.instrumentation.begin("Schritt 11 Ausgabe")
+        # Schritt 11:
+        # Ausgabe der Informationen zum Abgleich mit den Testdaten
+        print(f'Journalsumme: {journal_data_amount}')
+        print(f'Verarbeitete Daten: {modified_data_amount}')
+        try:
+            print(f'Gewinn oder Verlust: {accounting_simulation_final["GuV_Final"][0]}')
+        except UnboundLocalError:
+            print("Gewinn oder Verlust: no statement calculated")
+        self.instrumentation.end()
+
+        return AccountResult(account, quality_check, journal, self.processed_registry, self.instrumentation.take(),
+                             engine_state, stored_rows)
+
+    def generate_booking_journal(self, accounts_to_combine, types_to_process=None, parallel=False,
+                                 max_workers=None, parallel_symbols=False, incremental=False, instrumentation=None,
+                                 trace=None, accounts=None, export=True):
+        ''' Das ist die Hauptmethode, hier wird der Ablauf gesteuert um das Buchungssjournal zu erstellen.
+            Mit parallel werden die Accounts in einem Process-Pool verarbeitet, die Ergebnisse werden in der
+            Reihenfolge der Accounts zusammengeführt und sind damit identisch zu einem seriellen Lauf.
+            Mit parallel_symbols werden zusätzlich die Symbole innerhalb eines Accounts getrennt verbucht
+            (siehe book_shards). Mit incremental werden nur die neuen Zeilen seit dem letzten Lauf verbucht
+            (siehe generate_incremental_statements), die Symbole werden dann nicht getrennt verbucht.
+            Mit instrumentation werden die Laufzeiten der Schritte gemessen (siehe Instrumentation), mit trace wird
+            das Protokoll der Verbuchung vorgegeben (siehe Trace).
+            Mit accounts werden nur diese Accounts verbucht (nach der Kombination), ohne export wird die Import-Datei
+            für den MS-Buchhalter nicht erstellt. '''
+        if instrumentation is not None:
+            self.instrumentation = instrumentation
+        if trace is not None:
+            self.trace = trace
+        if parallel_symbols and incremental:
+            logging.info("Bei der inkrementellen Verbuchung werden die Symbole nicht getrennt verbucht")
+        self.parallel_symbols = parallel_symbols and not incremental
+        self.incremental = incremental
+        self.accounts_to_combine = accounts_to_combine
+        self.max_workers = max_workers
 
         # Kombinieren der Accounts, falls es eine Migration von IB-Konten gab.
         # Da es eine Migration und Kombination ist, handelt es sich um das selbe Konto und es wird
@@ -1219,212 +1603,43 @@ class BookingStatementHandler:
 
         if dict_has_entry:
             for key, value in accounts_to_combine.items():
-                modified_data = modified_data.replace(to_replace=key, value=value)
-
                 for index, item in enumerate(self.accounts):
                     if item == key:
                         self.accounts[index] = value
 
-        self.accounts = list(set(self.accounts))
+        self.accounts = sorted(set(self.accounts))
+        if accounts is not None:
+            selected = {combine_account(account, accounts_to_combine) for account in accounts}
+            self.accounts = [account for account in self.accounts if account in selected]
         logging.debug(f"Die folgenden Accounts werden berücksichtigt: {self.accounts}")
 
         # Jeder Account wird einzeln betrachtet da für jeden das FIFO Prinzip gesondert gilt!
-        for account in self.accounts:
-            logging.info(f"The following account will now be processed: {account} .........")
-
-            # Selektion der Accountdaten
-            data = modified_data[modified_data["accountId"] == account]
-            self.modified_data = data
-
-            # Schritt 01: Löschen der IB-Internen Statuszeilen:
-            # - Starting Balance
-            # - FX Translation P&L
-            # - Ending Balance
-            data = data[(data["activityDescription"] != "Starting Balance")]
-            data = data[(data["activityDescription"] != "FX Translations P&L")]
-            data = data[(data["activityDescription"] != "Ending Balance")]
-
-            # Schritt 02: Löschen der Bankbewegungen
-            # Diese müssen manuell gebucht werden um Doppelbuchungen zu vermeiden
-            # TODO: hier kann ich noch den Buchhungssatz für den Transfer zwischen den IB-Accounts einbauen
-            bank_transfers = data[(data["activityCode"] == "WITH") | (data["activityCode"] == "DEP")]
-            data = data[~data.isin(bank_transfers)].dropna()
-
-            # Schritt 03: Sortieren der Buchungen nach der Transaktions-ID um Fehlbuchungen zu vermeiden und
-            # filtern der Daten nach dem Datum
-            data.sort_values(by='transactionID', ascending=True, inplace=True)
-            data = data[data["date"] >= float(self.start)]
-            data = data[data["date"] <= float(self.end)]
-
-            ##################################################################################################
-            # Debug Hilfen
-            # list_to_check = [400141989, ]
-            # data = data.loc[data["transactionID"].isin(list_to_check)]
-
-            # list_to_check = ["OFEE", ]
-            # data = data.loc[data["assetCategory"].isin(list_to_check)]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-            # data = data.loc[data["symbol"].isin(["UA",])]
-
-            ##################################################################################################
-
-            # Quality Check - IB Report: Cash Report - Broker Interest Paid and Received
-            # list_to_check = ["DINT", "CINT", "BFEE"]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Cash Report - Dividends
-            # list_to_check = ["DIV",]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Cash Report - Withholding Tax
-            # list_to_check = ["FRTAX",]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Cash Report - Sales Tax
-            # list_to_check = ["STAX",]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Cash Report - CFD Charges
-            # list_to_check = ["CFD",]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Cash Report - Other Fees
-            # list_to_check = ["OFEE",]
-            # data = data.loc[data["activityCode"].isin(list_to_check)]
-
-            # Quality Check - IB Report: Commissions
-            print(f"The trade commission in total is {data['tradeCommission'].sum()}")
-
-            ##################################################################################################
-
-            # Schritt 04: Laden der offenen Positionen
-            open_filename = os.path.join(self.pickle_files, f"OpenPositions_{account}.pkl")
-            open = pd.read_pickle(open_filename)
-
-            # Schritt 05: Erstellen der einzelnen Buchungsdaten => Methode: Generate Single Statements
-            data, journal, open = self.generate_single_statements(data, open)
-
-            # Schritt 06: Löschen der einzenen, nicht relevanten Einträge aus der Open-Trade Liste,
-            # wie z.B. die Dividendenzahlungen, Margin Variation Zahlungen, etc.
-            open = self.delete_selected_fifo_positions(open)
-
-            # Schritt 07: Quality Checks und Fehlerhandling!
-
-            # Schritt 07.01. - Abgleich der Salden aus den einzelnen Datenlisten
-            modified_data_amount = round(sum(abs(data["amount"])), 2)
-
-            if journal.empty:
-                quality_check = "no bookings generated"
-                journal_data_amount = 0
-            elif modified_data.empty:
-                quality_check = "no bookings generated"
-                modified_data_amount = 0
-            else:
-                # Only take relevant data into consideration, flag is set in the booking statements
-                data_check_journal_data = journal[journal["Account"] == account]
-                journal_data_amount = round(
-                    sum(abs(data_check_journal_data[data_check_journal_data["QUALITYREL"] == True]["AMOUNT"])), 2)
+        # Die Daten werden je Account aus der Ablage gelesen, die offenen Positionen weiter unten pro Account
+        tasks = [(account, *self.load_account_data(account, accounts_to_combine)) for account in self.accounts]
 
-                if (journal_data_amount == modified_data_amount) or (modified_data.empty and journal_data_amount.empty):
-                    quality_check = "erfolgreich"
-                else:
-                    quality_check = "nicht erfolgreich"
-
-            results.append(quality_check)
-
-            # Ausgabe des Ergebnisses
-            print(f"Qualitätscheck Validierung: {quality_check}, "
-                  f"die Journalsummer ist {journal_data_amount} und "
-                  f"die der verabrbeiteten Daten ist {modified_data_amount}, Account {account}")
-
-            # Schritt 07.2. - Prüfung ob alle Zeilen verarbeitet wurden
-            # Die Daten, die in den "modified data" waren und nicht in den processed IDs aufgenommen wurden
-            # wurden nicht verarbeitet. Optimalerweise sind alle zeilen verarbeitet worden
-
-            try:
-                if self.processed_entries:
-                    processed_for_this_account = self.processed_entries[self.processed_entries["account"] == account]
-                    not_processed = pd.concat(
-                        [data["transactionID"], processed_for_this_account["transactionID"]]).drop_duplicates(
-                        keep=False)
-            except ValueError:
-                not_processed = data["transactionID"]
-
-            # Schritt 07.3. - Buchungsdatum berücksichtigen
-            # IB gibt nicht bei allen Zeilen ein Settle-Datum aus und daher nehme ich überall wo es ausgegeben wird,
-            # das IB Buchungsdatum und wo es nicht ausgegeben wird das Datum was ein IB in dem Datumsfeld angibt
-
-            for index, row in journal.iterrows():
-                if row["SETTLEDATE"] == "":
-                    journal.loc[index, "SETTLEDATE"] = row["DATE"]
-
-            # Schritt 08:
-            # Simulation der Buchhaltung und des Jahresabschlusses
-            accounting = pd.DataFrame()
-            if not journal.empty:
-                simulation_journal = journal[journal["Account"] == account]
-                accounting, account_summary, accounting_simulation_final = self.accounting_check(simulation_journal)
-
-            # Schritt 09:
-            # Nun speichere ich die ganzen Daten noch in einer Excel, um diese dann final abzulegen
-            if save_to_excel:
-                # create the writer object
-                path_to_store = os.path.join(self.dir_export, f"AccountingJournal_{account}.xlsx")
-                writer = pd.ExcelWriter(path_to_store, engine='xlsxwriter')
-                path_open_positions = os.path.join(self.dir_export, f"OpenPositions_{account}.xlsx")
-                writer_open_positions = pd.ExcelWriter(path_open_positions, engine='xlsxwriter')
-
-                # save the data to the excel
-
-                # Imported or Downloaded Data
-                df_to_store = imported_data[imported_data["accountId"] == account]
-                df_to_store.to_excel(writer, sheet_name='Downloaded_Data', index=False)
-
-                # From the program modified data
-                df_to_store = data[data["accountId"] == account]
-                df_to_store.to_excel(writer, sheet_name='Modified_Data', index=False)
-
-                # Excluded bank transfer data
-                df_to_store = bank_transfers[bank_transfers["accountId"] == account]
-                df_to_store.to_excel(writer, sheet_name='Bank_Transfers', index=False)
-
-                # Booking Journal
-                if not journal.empty:
-                    df_to_store = journal[journal["Account"] == account]
-                    df_to_store.to_excel(writer, sheet_name="Booking_Journal", index=False)
-
-                # Open FIFO Positions
-                if not open.empty:
-                    df_to_store = open[open["accountId"] == account]
-                    df_to_store.to_excel(writer, sheet_name=f"FIFO_Positions", index=False)
-                    df_to_store.to_excel(writer_open_positions, sheet_name=f"OpenPositions", index=False)
-                    writer_open_positions.save()
-
-                # Processed ID's
-                if not self.processed_entries.empty:
-                    df_to_store = self.processed_entries[self.processed_entries["account"] == account]
-                    df_to_store.to_excel(writer, sheet_name="Processed_ID", index=False)
-                    # not_processed.to_excel(writer, sheet_name="Not_Processed", index=False)
-
-                # Accounting Simulation
-                if not accounting.empty:
-                    accounting.to_excel(writer, sheet_name="Acc_Sim_1", index=False)
-                    account_summary.to_excel(writer, sheet_name="Acc_Sim_2", index=False)
-                    accounting_simulation_final.to_excel(writer, sheet_name="Acc_Sim_3", index=False)
-
-                writer.save()
-
-            # Schritt 10:
-            # Erstellung der Buchungssatz - Importdatei
-            if not journal.empty:
-                data_to_import = journal[journal["Account"] == account]
-                self.generate_MSBuchhalter_Import(data_to_import, account, self.dir_export)
-
-            # Schritt 11:
-            # Ausgabe der Informationen zum Abgleich mit den Testdaten
-            print(f'Journalsumme: {journal_data_amount}')
-            print(f'Verarbeitete Daten: {modified_data_amount}')
-            try:
-                print(f'Gewinn oder Verlust: {accounting_simulation_final["GuV_Final"][0]}')
-            except UnboundLocalError:
-                print("Gewinn oder Verlust: no statement calculated")
+        if parallel and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(self.process_account, *zip(*tasks)))
+        else:
+            results = [self.process_account(*task) for task in tasks]
+
+        # Zusammenführen der Ergebnisse in der Reihenfolge der Accounts
+        self.processed_registry = ProcessingRegistry()
+        journals = []
+        for result in results:
+            self.quality_checks[result.account] = result.quality_check
+            self.processed_registry.merge(result.processed_registry)
+            self.instrumentation.merge(result.instrumentation)
+            if result.engine_state is not None:
+                self.save_engine_state(result.account, result.engine_state, result.journal, result.stored_rows)
+            if not result.journal.empty:
+                journals.append(result.journal)
+
+        self.journal = pd.concat(journals, ignore_index=True) if journals else pd.DataFrame()
+
+        self.instrumentation.begin("Schritt 10 MSBuchhalter Export")
+        # Schritt 10:
+        # Erstellung der Buchungssatz - Importdateien, alle Accounts in einem Durchlauf über das Journal
+        if export and not self.journal.empty:
+            ExportHandler(self.dir_export).generate_MSBuchhalter_Import(self.journal[JOURNAL_COLUMNS], self.accounts)
+        self.instrumentation.end()
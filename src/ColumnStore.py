@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_categorical_dtype, is_datetime64_ns_dtype, is_extension_array_dtype, \
+    is_integer_dtype, is_numeric_dtype
+
+# Version des Aufbaus der Ablage, muss erhöht werden, sobald sich die Dateien oder das Manifest ändern
+STORE_VERSION = 2
+
+# Namen der Ablagen in working_files
+CLEANED_DATA = "cleaned_data"  # aufbereiteter Kapitalflussbericht, partitioniert nach accountId
+OPEN_POSITIONS = "OpenPositions_{account}"  # offene Positionen des Vorjahres je Account
+JOURNAL = "journal"  # Buchungsjournal der letzten Verbuchung, partitioniert nach Account
+OPEN_POSITIONS_FILE = "OpenPositionsFile_{key}"  # gelesene Excel-Datei mit offenen Positionen, je Hash der Datei
+
+MANIFEST_FILENAME = "manifest.json"
+ROW_COLUMN = "__row__"  # Position der Zeile im geschriebenen DataFrame
+INDEX_COLUMN = "__index__"  # Index des geschriebenen DataFrames
+
+TEXT = "text"  # nur Zeichenketten, als Unicode mit fester Länge
+CATEGORY = "category"  # Codes als Zahlen, die Kategorien stehen im Manifest
+INTEGER = "integer"  # Ganzzahlen mit fehlenden Werten (z.B. Int64), Werte und Maske getrennt
+NUMPY = "numpy"  # Zahlen, Wahrheitswerte und Datumswerte direkt als NumPy-Array
+OBJECT = "object"  # alles andere, wird mit pickle gespeichert und kann nicht gemappt werden
+
+
+def is_text(values):
+    return all(isinstance(value, str) for value in values)
+
+
+def encode_column(values):
+    ''' Zerlegt eine Spalte in die Beschreibung für das Manifest und die Arrays, die gespeichert werden '''
+    dtype = values.dtype
+
+    if is_categorical_dtype(dtype) and is_text(dtype.categories):
+        return {"kind": CATEGORY, "categories": list(dtype.categories), "ordered": bool(dtype.ordered)}, \
+            {"": np.asarray(values.cat.codes)}
+    if is_extension_array_dtype(dtype) and is_integer_dtype(dtype):
+        return {"kind": INTEGER, "dtype": str(dtype)}, \
+            {"": values.to_numpy(dtype=dtype.numpy_dtype, na_value=0), ".mask": values.isna().to_numpy()}
+    if is_datetime64_ns_dtype(dtype) and not is_extension_array_dtype(dtype):
+        # Die Datumswerte von pandas haben Metadaten am dtype, die np.save nicht speichert, daher als int64
+        return {"kind": NUMPY, "dtype": "datetime64[ns]"}, {"": values.to_numpy().view(np.int64)}
+    if not is_extension_array_dtype(dtype) and (is_numeric_dtype(dtype) or is_bool_dtype(dtype)):
+        return {"kind": NUMPY}, {"": values.to_numpy()}
+    if dtype == object and is_text(values):
+        return {"kind": TEXT}, {"": values.to_numpy(dtype=str) if len(values) else np.array([], dtype="<U1")}
+
+    return {"kind": OBJECT, "dtype": str(dtype)}, {"": np.asarray(values, dtype=object)}
+
+
+def decode_column(meta, arrays):
+    ''' Setzt eine Spalte aus der Beschreibung und den gelesenen Arrays wieder zusammen '''
+    values = arrays[""]
+    kind = meta["kind"]
+
+    if kind == CATEGORY:
+        return pd.Categorical.from_codes(values, categories=pd.Index(meta["categories"], dtype=object),
+                                         ordered=meta["ordered"])
+    if kind == INTEGER:
+        return pd.arrays.IntegerArray(np.array(values), np.array(arrays[".mask"]))
+    if kind == TEXT:
+        return values.astype(object)
+    if kind == OBJECT:
+        return pd.array(values, dtype=meta["dtype"]) if meta["dtype"] != "object" else values
+
+    if "dtype" in meta:
+        return np.array(values).view(meta["dtype"])
+    return np.array(values)
+
+
+class ColumnStore:
+    ''' Ablage von DataFrames in working_files mit einer .npy-Datei je Spalte und Partition und einem Manifest
+        mit den Typen und Partitionen. Die Dateien können gemappt werden (mmap_mode) und beim Lesen werden nur die
+        angeforderten Spalten und Partitionen (z.B. einzelne Accounts) geöffnet.
+
+        Aufbau: <Verzeichnis>/<Name>/manifest.json und <Verzeichnis>/<Name>/part-0000/<Spalte>.npy
+        Das Manifest wird zuletzt geschrieben, eine unvollständig geschriebene Ablage gilt damit als nicht
+        vorhanden. '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get_manifest_path(self, name):
+        return os.path.join(self.get_path(name), MANIFEST_FILENAME)
+
+    def exists(self, name):
+        return os.path.exists(self.get_manifest_path(name))
+
+    def read_manifest(self, name):
+        with open(self.get_manifest_path(name), "r") as file:
+            manifest = json.load(file)
+        if manifest.get("version") != STORE_VERSION:
+            raise ValueError(f"The working store {name} was written with another version, please import again")
+        return manifest
+
+    def get_names(self, prefix=""):
+        ''' Die vollständig geschriebenen Ablagen, deren Name mit prefix beginnt '''
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.startswith(prefix) and self.exists(name))
+
+    def delete(self, name):
+        shutil.rmtree(self.get_path(name), ignore_errors=True)
+
+    def get_partitions(self, name):
+        ''' Die Werte der Partitionsspalte (z.B. die Accounts), ohne die Daten zu lesen '''
+        # Nach append kann ein Wert in mehreren Partitionen stehen
+        return list(dict.fromkeys(partition["value"] for partition in self.read_manifest(name)["partitions"]))
+
+    def get_columns(self, name):
+        return list(self.read_manifest(name)["columns"])
+
+    def get_attributes(self, name):
+        ''' Die beim Schreiben angegebenen Angaben zu den Daten (z.B. die Einheit der Beträge) '''
+        return self.read_manifest(name).get("attributes", {})
+
+    def get_rows(self, name, partitions=None):
+        ''' Die Anzahl der Zeilen der angegebenen Partitionen (None = alle), ohne die Daten zu lesen '''
+        return sum(partition["rows"] for partition in self.read_manifest(name)["partitions"]
+                   if partitions is None or partition["value"] in partitions)
+
+    def __write_parts__(self, path, data, partition_by, columns, number, row):
+        ''' Schreibt data als Partitionen part-<number>, part-<number + 1>, ... nach path, die Zeilen bekommen die
+            Positionen ab row. columns sind die Beschreibungen der Spalten für das Manifest, weicht eine Spalte in
+            einer Partition davon ab (z.B. Text mit leeren Werten), steht ihre Beschreibung bei der Partition.
+            Gibt die Partitionen für das Manifest und die Prüfsumme über die geschriebenen Arrays zurück. '''
+        if partition_by is not None and not data.empty:
+            groups = data.groupby(partition_by, sort=False, observed=True).indices.items()
+        else:
+            groups = [(None, np.arange(len(data)))]
+
+        partitions = []
+        checksum = hashlib.sha256()
+        frame = data.reset_index(drop=True)
+        frame[INDEX_COLUMN] = data.index.to_numpy()
+
+        for offset, (value, positions) in enumerate(groups):
+            directory = f"part-{number + offset:04d}"
+            # Reste eines abgebrochenen Laufs, die nicht im Manifest stehen, werden überschrieben
+            shutil.rmtree(os.path.join(path, directory), ignore_errors=True)
+            os.makedirs(os.path.join(path, directory))
+            part = frame.iloc[positions]
+            arrays_to_store = {ROW_COLUMN: ({"kind": NUMPY}, {"": np.asarray(positions, dtype=np.int64) + row})}
+            arrays_to_store.update({column: encode_column(part[column]) for column in frame.columns})
+
+            partition = {"value": value if value is None or isinstance(value, (str, int, float)) else str(value),
+                         "directory": directory, "rows": len(positions)}
+            for column, (meta, arrays) in arrays_to_store.items():
+                columns.setdefault(column, meta)
+                if meta != columns[column]:
+                    partition.setdefault("columns", {})[column] = meta
+                column_number = list(columns).index(column)
+                for suffix, array in arrays.items():
+                    file_path = os.path.join(path, directory, f"{column_number:04d}{suffix}.npy")
+                    np.save(file_path, array, allow_pickle=meta["kind"] == OBJECT)
+                    checksum.update(repr(array.tolist()).encode("utf-8") if meta["kind"] == OBJECT else
+                                    np.ascontiguousarray(array).tobytes())
+
+            partitions.append(partition)
+
+        return partitions, checksum.hexdigest()
+
+    def write(self, name, data, partition_by=None, attributes=None):
+        ''' Speichert den DataFrame, mit partition_by wird je Wert der Spalte eine eigene Partition angelegt.
+            attributes werden im Manifest abgelegt und können mit get_attributes gelesen werden.
+            Die Dateien werden in einem neuen Verzeichnis geschrieben und ersetzen danach die alte Ablage. '''
+        path = self.get_path(name)
+        temporary = path + ".tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+
+        columns = {}
+        partitions, checksum = self.__write_parts__(temporary, data, partition_by, columns, 0, 0)
+
+        manifest = {"version": STORE_VERSION, "rows": len(data), "partition_by": partition_by,
+                    "columns": columns, "partitions": partitions, "attributes": attributes or {},
+                    "checksum": checksum}
+        with open(os.path.join(temporary, MANIFEST_FILENAME), "w") as file:
+            json.dump(manifest, file, indent=1, default=str)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary, path)
+
+    def append(self, name, data, attributes=None, replace=()):
+        ''' Hängt data an die Ablage an, ohne die vorhandenen Dateien neu zu schreiben. Die Zeilen werden wie beim
+            Schreiben nach der Partitionsspalte aufgeteilt und kommen beim Lesen nach den vorhandenen Zeilen.
+            Die Partitionen mit den Werten aus replace werden dabei entfernt, attributes ergänzen die Angaben im
+            Manifest. Das Manifest wird erst nach den neuen Dateien ersetzt. '''
+        manifest = self.read_manifest(name)
+        path = self.get_path(name)
+        stored_columns = [column for column in manifest["columns"] if column not in (ROW_COLUMN, INDEX_COLUMN)]
+        if list(data.columns) != stored_columns:
+            raise ValueError(f"The columns do not match the working store {name}")
+
+        kept = [partition for partition in manifest["partitions"] if partition["value"] not in replace]
+        removed = [partition for partition in manifest["partitions"] if partition["value"] in replace]
+        row = manifest.get("next_row", manifest["rows"])
+        number = max(int(partition["directory"].split("-")[1]) for partition in manifest["partitions"]) + 1
+
+        partitions = []
+        checksum = manifest["checksum"]
+        if not data.empty or not kept:
+            # Ohne Partition könnten Spalten und Typen nicht mehr gelesen werden (siehe read)
+            partitions, part_checksum = self.__write_parts__(path, data, manifest["partition_by"],
+                                                             manifest["columns"], number, row)
+            checksum = hashlib.sha256((checksum + part_checksum).encode("utf-8")).hexdigest()
+
+        manifest["partitions"] = kept + partitions
+        manifest["rows"] = sum(partition["rows"] for partition in manifest["partitions"])
+        manifest["next_row"] = row + len(data)
+        manifest["attributes"] = {**manifest.get("attributes", {}), **(attributes or {})}
+        manifest["checksum"] = checksum
+
+        temporary = self.get_manifest_path(name) + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(manifest, file, indent=1, default=str)
+        os.replace(temporary, self.get_manifest_path(name))
+
+        for partition in removed:
+            shutil.rmtree(os.path.join(path, partition["directory"]), ignore_errors=True)
+
+    def read(self, name, columns=None, partitions=None, mmap_mode="r"):
+        ''' Liest die angegebenen Spalten (None = alle) der angegebenen Partitionen (None = alle). Die Zeilen
+            kommen in der Reihenfolge und mit dem Index wie beim Schreiben zurück. '''
+        manifest = self.read_manifest(name)
+        path = self.get_path(name)
+        numbers = {column: number for number, column in enumerate(manifest["columns"])}
+        if columns is None:
+            columns = [column for column in numbers if column not in (ROW_COLUMN, INDEX_COLUMN)]
+
+        selected = manifest["partitions"]
+        if partitions is not None:
+            selected = [partition for partition in selected if partition["value"] in partitions]
+
+        def load(partition, column):
+            meta = partition.get("columns", {}).get(column, manifest["columns"][column])
+            directory = partition["directory"]
+            arrays = {}
+            for suffix in [""] + ([".mask"] if meta["kind"] == INTEGER else []):
+                file_path = os.path.join(path, directory, f"{numbers[column]:04d}{suffix}.npy")
+                if meta["kind"] == OBJECT:
+                    arrays[suffix] = np.load(file_path, allow_pickle=True)
+                else:
+                    arrays[suffix] = np.load(file_path, mmap_mode=mmap_mode)
+            return decode_column(meta, arrays)
+
+        frames = []
+        # Ohne passende Partition wird die erste Partition ohne Zeilen gelesen, damit Spalten und Typen stimmen
+        for partition in selected or manifest["partitions"][:1]:
+            frame = pd.DataFrame({column: load(partition, column) for column in columns}, columns=columns)
+            frame.index = load(partition, INDEX_COLUMN)
+            frame[ROW_COLUMN] = load(partition, ROW_COLUMN)
+            frames.append(frame if selected else frame.iloc[:0])
+
+        data = frames[0]
+        if len(frames) > 1:
+            data = pd.concat(frames).sort_values(ROW_COLUMN, kind="stable")
+
+        return data.drop(columns=ROW_COLUMN)
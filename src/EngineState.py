@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from src.FifoLotStore import FifoLotStore
+from src.ProcessingRegistry import ProcessingRegistry
+
+# Version des gespeicherten Zustands, muss erhöht werden, sobald sich der Aufbau oder die Buchungslogik ändert
+STATE_VERSION = 7
+
+# Anzahl der zuletzt verbuchten Zeilen, deren Hashes ein späterer Lauf mit den Daten vergleicht (siehe covers)
+CHECK_ROWS = 1000
+
+
+def get_fingerprint(*values, files=()):
+    ''' Erstellt einen Hash über die Einstellungen und Dateien, von denen der gespeicherte Zustand abhängt '''
+    fingerprint = hashlib.sha256(repr((STATE_VERSION,) + values).encode("utf-8"))
+
+    for path in files:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                fingerprint.update(block)
+
+    return fingerprint.hexdigest()
+
+
+class EngineState:
+    ''' Zustand der Verbuchung eines Accounts am Ende eines Laufs, damit ein späterer Lauf nur die neuen Zeilen
+        verbuchen muss: offene Lots, verbuchte Transaction-IDs, die Zwischenwerte der Teilverkäufe und die laufenden
+        Summen je Konto. Das Journal gehört nicht zum Zustand, die Buchungen werden in der Ablage working_files/journal
+        an die Partition des Accounts angehängt (siehe BookingStatementHandler.save_engine_state). Über digest wird
+        geprüft, dass die Ablage zu diesem Zustand gehört.
+        Der Zustand gilt nur für den selben Fingerprint (Zeitraum, Konten, kombinierte Accounts, offene Positionen
+        des Vorjahres, ...). Die verbuchten Zeilen werden über ihre Anzahl und die Hashes der letzten CHECK_ROWS
+        Zeilen wiedererkannt, damit ein Lauf nicht alle bisherigen Zeilen neu hashen muss. Zeilen ohne
+        transactionID können nicht zugeordnet werden und müssen vorher aussortiert werden (siehe process_account). '''
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.fifo_positions = FifoLotStore()
+        self.processed_registry = ProcessingRegistry()
+        self.accumulators = (0, 0, 0)  # stock_adjustment, restbuchwert, einnahmen als Ganzzahlen (siehe FixedPoint)
+        self.balances = {}  # Konto => [Soll, Haben] als Ganzzahlen
+        self.journal_rows = 0  # Anzahl der Buchungen des Accounts im abgelegten Journal
+        self.last_transactionID = None
+        self.row_count = 0
+        self.tail_hashes = np.empty(0, dtype=np.uint64)  # Hashes der letzten verbuchten Zeilen
+        self.digest = fingerprint  # laufender Hash über alle verbuchten Zeilen
+
+    @staticmethod
+    def load(path, fingerprint):
+        ''' Lädt den Zustand, gibt None zurück, wenn es keinen passenden Zustand gibt '''
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as file:
+                state = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as error:
+            logging.warning(f"Der Zustand in {path} konnte nicht geladen werden: {error}")
+            return None
+
+        if state.fingerprint != fingerprint:
+            logging.info(f"Der Zustand in {path} passt nicht zu den Einstellungen, es wird komplett neu verbucht")
+            return None
+
+        return state
+
+    def save(self, path):
+        ''' Speichert den Zustand, die Datei wird erst nach dem Schreiben ersetzt '''
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def get_row_hashes(data):
+        return pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+    def get_booked_positions(self, data):
+        if self.last_transactionID is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero((data["transactionID"] <= self.last_transactionID).to_numpy())
+
+    def covers(self, data):
+        ''' Prüft, ob die bereits verbuchten Zeilen noch in den Daten enthalten sind: gleiche Anzahl bis zur
+            letzten verbuchten transactionID und unveränderte letzte CHECK_ROWS Zeilen. Ältere Zeilen werden nicht
+            erneut gehasht, wurden diese geändert, muss ohne incremental verbucht werden. '''
+        booked = self.get_booked_positions(data)
+        if len(booked) != self.row_count:
+            return False
+        tail = data.iloc[booked[len(booked) - len(self.tail_hashes):]]
+        return bool(np.array_equal(self.get_row_hashes(tail), self.tail_hashes))
+
+    def get_new_rows(self, data):
+        if self.last_transactionID is None:
+            return data
+        return data[(data["transactionID"] > self.last_transactionID).to_numpy()]
+
+    @staticmethod
+    def get_balances(journal):
+        ''' Summen je Konto auf Soll- und Habenseite, die Beträge des Journals sind Ganzzahlen (siehe FixedPoint) '''
+        if journal.empty:
+            return {}
+
+        amounts = journal["AMOUNT"].astype("int64")
+        soll = amounts.groupby(journal["SOLL"].astype(int)).sum()
+        haben = amounts.groupby(journal["HABEN"].astype(int)).sum()
+
+        return {int(konto): [int(soll.get(konto, 0)), int(haben.get(konto, 0))]
+                for konto in soll.index.union(haben.index)}
+
+    def commit(self, data, journal, processed_registry, fifo_positions, accumulators):
+        ''' Übernimmt das Ergebnis eines Laufs über die neuen Zeilen aus data und die dabei erstellten Buchungen.
+            Der Aufwand hängt nur von den neuen Zeilen ab. '''
+        if not data.empty:
+            hashes = self.get_row_hashes(data)
+            self.last_transactionID = int(data["transactionID"].max())
+            self.tail_hashes = np.concatenate([self.tail_hashes, hashes])[-CHECK_ROWS:]
+            self.digest = hashlib.sha256(self.digest.encode("utf-8") + hashes.tobytes()).hexdigest()
+        self.processed_registry.merge(processed_registry, offset=self.row_count)
+        self.row_count += len(data)
+        self.fifo_positions = fifo_positions
+        self.accumulators = accumulators
+        self.journal_rows += len(journal)
+
+        for konto, (soll, haben) in self.get_balances(journal).items():
+            balance = self.balances.setdefault(konto, [0, 0])
+            balance[0] += soll
+            balance[1] += haben
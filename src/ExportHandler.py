@@ -0,0 +1,104 @@
+import os
+
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_number
+
+from src.FixedPoint import from_fixed
+
+# Spalten der Import-Datei für den MS-Buchhalter 3.0
+MSB_COLUMNS = ["Belegdatum", "Buchungsdatum", "Belegnummernkreis", "Belegnummer", "Buchungstext", "Betrag",
+               "Sollkonto", "Habenkonto", "Steuerschlüssel", "Kostenstelle 1", "Kostenstelle 2", "Währung"]
+
+
+class ExportHandler:
+    ''' Erstellt die Import-Dateien für den MS-Buchhalter aus dem Buchungsjournal.
+        Die Spalten werden als Ganzes formatiert und blockweise in die CSV-Dateien geschrieben, das Journal wird
+        dabei nicht verändert. Alle Accounts werden in einem Durchlauf über das Journal exportiert. '''
+
+    def __init__(self, path, chunk_size=50000):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def get_MSBuchhalter_path(self, account):
+        return os.path.join(self.path, f"AccountingJournal_Import_MSB_{account}.csv")
+
+    def format_dates(self, *columns):
+        ''' Formatiert die Datumsspalten (YYYYMMDD oder datetime) als dd.mm.yyyy.
+            Jeder Wert wird über alle Spalten hinweg nur einmal geparst. '''
+        values = pd.concat(columns, ignore_index=True)
+        codes, uniques = pd.factorize(values.to_numpy())
+        uniques = pd.Series(uniques)
+
+        if is_datetime64_any_dtype(uniques):
+            dates = uniques
+        else:
+            # Zahlen (z.B. 20210105.0) werden vor dem Parsen in YYYYMMDD umgewandelt
+            uniques = uniques.map(lambda value: str(int(value)) if is_number(value) else value)
+            dates = pd.to_datetime(uniques, format="%Y%m%d")
+
+        formatted = dates.dt.strftime("%d.%m.%Y").to_numpy()[codes]
+        formatted[codes == -1] = None
+
+        result = []
+        start = 0
+        for column in columns:
+            result.append(pd.Series(formatted[start:start + len(column)], index=column.index))
+            start += len(column)
+
+        return result
+
+    def format_MSBuchhalter(self, journal):
+        ''' Erstellt die Zeilen der Import-Datei für einen Block des Journals '''
+
+        # IB gibt nicht bei allen Zeilen ein Settle-Datum aus, dann wird das Buchungsdatum verwendet
+        missing = journal["SETTLEDATE"].isna()
+        if not is_datetime64_any_dtype(journal["SETTLEDATE"]):
+            missing |= journal["SETTLEDATE"] == ""
+        settledate = journal["SETTLEDATE"].mask(missing, journal["DATE"])
+        belegdatum, buchungsdatum = self.format_dates(journal["DATE"], settledate)
+
+        import_data = pd.DataFrame(index=journal.index)
+        import_data["Belegdatum"] = belegdatum
+        import_data["Buchungsdatum"] = buchungsdatum
+        import_data["Belegnummernkreis"] = ""
+        import_data["Belegnummer"] = ""
+        import_data["Buchungstext"] = journal["TEXT"]
+        # Die Beträge sind im Journal Ganzzahlen (siehe FixedPoint) und werden erst hier umgerechnet
+        betrag = from_fixed(journal["AMOUNT"].astype("int64"))
+        import_data["Betrag"] = betrag.astype(str).str.replace(".", ",", regex=False)
+        import_data["Sollkonto"] = journal["SOLL"].astype("int64").astype(str)
+        import_data["Habenkonto"] = journal["HABEN"].astype("int64").astype(str)
+        import_data["Steuerschlüssel"] = "0"
+        import_data["Kostenstelle 1"] = ""
+        import_data["Kostenstelle 2"] = ""
+        import_data["Währung"] = "EUR"
+
+        return import_data
+
+    def generate_MSBuchhalter_Import(self, journal, accounts=None):
+        ''' Schreibt die Import-Dateien aller Accounts des Journals. Accounts aus der Liste ohne Buchungen
+            bekommen eine Datei, die nur die Überschriften enthält. '''
+        files = {}
+
+        try:
+            for start in range(0, len(journal), self.chunk_size):
+                chunk = journal.iloc[start:start + self.chunk_size]
+                import_data = self.format_MSBuchhalter(chunk)
+
+                for account, positions in chunk.groupby("Account", sort=False).indices.items():
+                    header = account not in files
+                    if header:
+                        files[account] = open(self.get_MSBuchhalter_path(account), "w", newline="",
+                                              encoding="utf-8")
+                    import_data.iloc[positions].to_csv(files[account], sep=";", index=False, header=header,
+                                                       quotechar='"')
+
+            for account in accounts or []:
+                if account not in files:
+                    files[account] = open(self.get_MSBuchhalter_path(account), "w", newline="", encoding="utf-8")
+                    pd.DataFrame(columns=MSB_COLUMNS).to_csv(files[account], sep=";", index=False, quotechar='"')
+        finally:
+            for file in files.values():
+                file.close()
+
+        return [self.get_MSBuchhalter_path(account) for account in files]
@@ -0,0 +1,236 @@
+import math
+
+import pandas as pd
+
+from src.FixedPoint import from_fixed, to_fixed
+
+
+def transaction_key(transactionID):
+    ''' Vereinheitlicht die Transaction-ID (int, float oder str) für den Lookup '''
+    try:
+        return int(transactionID)
+    except (TypeError, ValueError):
+        return transactionID
+
+
+def is_missing(value):
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def is_equal(left, right):
+    ''' Vergleich zweier Zellen, wobei leere Werte wie bei drop_duplicates als gleich gelten '''
+    if is_missing(left) or is_missing(right):
+        return is_missing(left) and is_missing(right)
+    return left == right
+
+
+# Felder, die ein Lot für Lookup, FIFO und die Buchungstexte direkt führt
+LOT_FIELDS = ("transactionID", "tradeQuantity", "amount", "activityDescription", "symbol", "date")
+
+# Stückzahl und Buchwert werden als Ganzzahlen geführt (siehe FixedPoint), leere Werte werden 0
+FIXED_FIELDS = ("tradeQuantity", "amount")
+
+
+class Lot:
+    ''' Kompakter Eintrag einer offenen Position. Die Felder aus LOT_FIELDS liegen direkt im Lot, alle weiteren
+        Spalten werden aus der Zeile gelesen, die das Lot eröffnet hat. Die Zeile wird dabei nicht kopiert.
+        tradeQuantity und amount sind Ganzzahlen, mit denen close_position_fifo direkt rechnet. Umgerechnet wird
+        nur für die Buchungstexte (lot["tradeQuantity"]) und den Export (to_record).
+        Ein Lot wird nicht verändert, eine Anpassung ersetzt es durch ein neues (siehe FifoLotStore.update). '''
+
+    __slots__ = LOT_FIELDS + ("row",)
+
+    def __init__(self, row):
+        self.row = row
+        for field in LOT_FIELDS:
+            setattr(self, field, to_fixed(row.get(field, math.nan)) if field in FIXED_FIELDS else row.get(field))
+
+    def __getitem__(self, column):
+        if column in FIXED_FIELDS:
+            return from_fixed(getattr(self, column))
+        if column in LOT_FIELDS:
+            return getattr(self, column)
+        return self.row[column]
+
+    def replace(self, column, value):
+        lot = Lot.__new__(Lot)
+        lot.row = self.row
+        for field in LOT_FIELDS:
+            setattr(lot, field, getattr(self, field))
+        setattr(lot, column, value)
+        return lot
+
+    def is_same(self, row):
+        ''' Prüft, ob row dieses Lot noch einmal eröffnen würde (entspricht drop_duplicates über die Felder) '''
+        return all(getattr(self, field) == to_fixed(row.get(field, math.nan)) if field in FIXED_FIELDS else
+                   is_equal(getattr(self, field), row.get(field)) for field in LOT_FIELDS)
+
+    def to_record(self):
+        ''' Die Zeile mit den aktuellen Werten des Lots, nur für den Export '''
+        record = dict(self.row)
+        for field in LOT_FIELDS:
+            if field not in record:
+                continue
+            value = getattr(self, field)
+            if field in FIXED_FIELDS:
+                # leere Werte bleiben leer, solange das Lot nicht angepasst wurde
+                if value == 0 and is_missing(record[field]):
+                    continue
+                value = from_fixed(value)
+            record[field] = value
+        return record
+
+
+class FifoLotStore:
+    ''' Verwaltet die offenen Positionen (Lots) eines Accounts.
+        Pro Symbol gibt es eine FIFO-Queue mit den Lots (siehe Lot), zusätzlich einen Index über die
+        activityDescription (für Einträge ohne Symbol) und über die Transaction-ID. Lookup, Anpassung und
+        Schließen eines Lots brauchen damit keine Filter über alle offenen Positionen mehr. Je Symbol und
+        activityDescription wird zusätzlich die Summe der tradeQuantity mitgeführt, damit Long/Short ohne Schleife
+        über die Lots feststeht. Ein DataFrame wird nur für den Export erstellt. Zu jedem Lot wird die Position der
+        Zeile gespeichert, die es eröffnet hat (die offenen Positionen aus dem Vorjahr haben negative Positionen),
+        damit die Lots mehrerer Stores wieder in die Reihenfolge der Eröffnung gebracht werden können. '''
+
+    def __init__(self, open_positions=None, positions=None):
+        self.lots = {}  # laufende Nummer => Lot, in der Reihenfolge der Eröffnung
+        self.positions = {}  # laufende Nummer => Position der Zeile
+        self.by_symbol = {}
+        self.by_description = {}
+        self.by_transaction = {}
+        self.quantity_by_symbol = {}  # Symbol => Summe der tradeQuantity als Ganzzahl
+        self.quantity_by_description = {}
+        self.columns = []
+        self.column_set = set()
+        self.sequence = 0
+        self.position = 0  # Position der Zeile, die gerade verarbeitet wird
+
+        if open_positions is not None:
+            self.load(open_positions.to_dict("records"), open_positions.columns, positions)
+
+    def load(self, lots, columns, positions=None):
+        ''' Übernimmt offene Positionen als Liste von Dictionaries '''
+        self.columns = list(columns)
+        self.column_set = set(self.columns)
+        if positions is None:
+            positions = range(-len(lots), 0)
+        for position, lot in zip(positions, lots):
+            self.position = position
+            self.append(lot)
+
+    def __len__(self):
+        return len(self.lots)
+
+    @property
+    def empty(self):
+        return len(self.lots) == 0
+
+    def __add_to_index__(self, index, key, seq, lot, totals=None):
+        index.setdefault(key, {})[seq] = lot
+        if totals is not None:
+            totals[key] = totals.get(key, 0) + lot.tradeQuantity
+
+    def __remove_from_index__(self, index, key, seq, totals=None):
+        bucket = index.get(key)
+        if bucket is not None:
+            lot = bucket.pop(seq, None)
+            if not bucket:
+                del index[key]
+                if totals is not None:
+                    del totals[key]
+            elif totals is not None and lot is not None:
+                totals[key] -= lot.tradeQuantity
+
+    def append(self, row):
+        ''' Nimmt einen Eintrag ohne weitere Prüfung in die offenen Positionen auf '''
+        lot = Lot(row)
+
+        if not self.column_set.issuperset(row):
+            self.columns += [column for column in row if column not in self.column_set]
+            self.column_set.update(row)
+
+        seq = self.sequence
+        self.sequence += 1
+        self.lots[seq] = lot
+        self.positions[seq] = self.position
+        self.__add_to_index__(self.by_symbol, lot.symbol, seq, lot, self.quantity_by_symbol)
+        self.__add_to_index__(self.by_description, lot.activityDescription, seq, lot, self.quantity_by_description)
+        self.__add_to_index__(self.by_transaction, transaction_key(lot.transactionID), seq, lot)
+
+        return lot
+
+    def add(self, row):
+        ''' Eröffnet eine Position, außer es gibt bereits ein identisches Lot (entspricht drop_duplicates) '''
+        key = transaction_key(row["transactionID"])
+        for lot in self.by_transaction.get(key, {}).values():
+            if lot.is_same(row):
+                return lot
+
+        return self.append(row)
+
+    def close(self, transactionID):
+        ''' Schließt alle Lots mit der Transaction-ID '''
+        bucket = self.by_transaction.pop(transaction_key(transactionID), {})
+
+        for seq, lot in bucket.items():
+            del self.lots[seq]
+            del self.positions[seq]
+            self.__remove_from_index__(self.by_symbol, lot.symbol, seq, self.quantity_by_symbol)
+            self.__remove_from_index__(self.by_description, lot.activityDescription, seq, self.quantity_by_description)
+
+    def update(self, transactionID, column, value):
+        ''' Passt einen Wert (tradeQuantity oder amount als Ganzzahl) bei einer Teilschließung an. Das Lot wird
+            dabei in allen Indizes ersetzt, bereits zurückgegebene Lots behalten ihre Werte. '''
+        bucket = self.by_transaction.get(transaction_key(transactionID), {})
+
+        for seq, lot in list(bucket.items()):
+            if column == "tradeQuantity":
+                self.quantity_by_symbol[lot.symbol] += value - lot.tradeQuantity
+                self.quantity_by_description[lot.activityDescription] += value - lot.tradeQuantity
+            lot = lot.replace(column, value)
+            self.lots[seq] = lot
+            bucket[seq] = lot
+            self.by_symbol[lot.symbol][seq] = lot
+            self.by_description[lot.activityDescription][seq] = lot
+
+    def has_symbol(self, symbol):
+        return symbol in self.by_symbol
+
+    def has_description(self, description):
+        return description in self.by_description
+
+    def lots_for_symbol(self, symbol):
+        ''' Gibt die offenen Lots des Symbols in FIFO-Reihenfolge zurück. Es wird nichts kopiert, die Lots werden
+            beim Durchlaufen vom ältesten an gelesen. Während des Durchlaufens dürfen Lots angepasst, aber nicht
+            geschlossen werden (siehe close_position_fifo). '''
+        return self.by_symbol.get(symbol, {}).values()
+
+    def lots_for_description(self, description):
+        return self.by_description.get(description, {}).values()
+
+    def quantity_for_symbol(self, symbol):
+        ''' Summe der tradeQuantity der offenen Lots als Ganzzahl, leere Werte zählen wie bei pandas nicht mit '''
+        return self.quantity_by_symbol.get(symbol, 0)
+
+    def quantity_for_description(self, description):
+        return self.quantity_by_description.get(description, 0)
+
+    def to_dataframe(self):
+        ''' Erstellt die offenen Positionen als DataFrame für den Export '''
+        return pd.DataFrame([lot.to_record() for lot in self.lots.values()], columns=self.columns)
+
+    @staticmethod
+    def combine(stores, columns=None):
+        ''' Erstellt die offenen Positionen mehrerer Stores (z.B. der Shards eines Accounts) als DataFrame,
+            in der Reihenfolge der Zeilen, die die Lots eröffnet haben '''
+        columns = [] if columns is None else list(columns)
+        entries = []
+
+        for store in stores:
+            columns += [column for column in store.columns if column not in columns]
+            entries += [(store.positions[seq], seq, lot) for seq, lot in store.lots.items()]
+
+        entries.sort(key=lambda entry: (entry[0], entry[1]))
+        return pd.DataFrame([lot.to_record() for _, _, lot in entries], columns=columns)
@@ -0,0 +1,36 @@
+import numpy as np
+
+# Beträge, Buchwerte und Stückzahlen werden in der Verbuchung als Ganzzahlen in Einheiten von 1 / SCALE geführt.
+# 8 Nachkommastellen reichen für alle Werte von IB, der größte Betrag ist damit ca. 92 Mrd.
+DECIMALS = 8
+SCALE = 10 ** DECIMALS
+
+
+def to_fixed(value):
+    ''' Wandelt einen Betrag oder eine Stückzahl in die Ganzzahl um, leere Werte werden 0 '''
+    if value != value:  # NaN
+        return 0
+    return int(round(value * SCALE))
+
+
+def to_fixed_array(values):
+    ''' Wie to_fixed für eine ganze Spalte, das Ergebnis ist ein int64-Array '''
+    values = np.nan_to_num(np.asarray(values, dtype=float), nan=0.0)
+    return np.rint(values * SCALE).astype(np.int64)
+
+
+def from_fixed(values):
+    ''' Wandelt Ganzzahlen (einzeln, Array oder Series) für die Ausgabe wieder in Beträge um '''
+    return values / SCALE
+
+
+def scale_fixed(value, numerator, denominator):
+    ''' Berechnet value * numerator / denominator mit Ganzzahlen und rundet wie round() auf die Einheit, z.B. für
+        den Anteil eines Betrags bei einem Teilverkauf '''
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    quotient, remainder = divmod(value * numerator, denominator)
+    if remainder * 2 > denominator or (remainder * 2 == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
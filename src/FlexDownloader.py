@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import time
+import xml.etree.ElementTree as eTree
+from contextlib import suppress
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# Adresse des Flex Web Service von IB, SendRequest und GetStatement werden angehängt
+FLEX_URL = "https://gdcdyn.interactivebrokers.com/Universal/servlet/FlexStatementService"
+FLEX_VERSION = "3"
+
+# Fehlercodes, bei denen der Bericht noch nicht fertig ist oder IB später erneut gefragt werden soll,
+# z.B. 1019 = Statement generation in progress, 1018 = Too many requests
+RETRY_CODES = frozenset(("1001", "1004", "1009", "1018", "1019", "1021"))
+
+CHUNK_SIZE = 1 << 16
+
+
+class FlexError(Exception):
+    ''' Fehler des Flex Web Service mit dem Fehlercode von IB '''
+
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.message = message
+
+
+def parse_response(data):
+    ''' Liest eine FlexStatementResponse, gibt den Status und die Elemente als dict zurück '''
+    root = eTree.fromstring(data)
+    if root.tag != "FlexStatementResponse":
+        # ältere Antworten von GetStatement enthalten nur <code>
+        return "Fail", {"ErrorCode": "", "ErrorMessage": root[0].text if len(root) else ""}
+    elements = {child.tag: (child.text or "").strip() for child in root}
+    return elements.get("Status", ""), elements
+
+
+class FlexDownloader:
+    ''' Lädt mehrere Flex-Queries gleichzeitig über den Flex Web Service von IB herunter.
+
+        Je Query wird mit SendRequest ein Bericht angefordert und danach mit GetStatement abgeholt. Solange IB den
+        Bericht noch erstellt (Fehlercode 1019 und die anderen RETRY_CODES), wird mit wachsendem Abstand erneut
+        gefragt, bis timeout erreicht ist. Höchstens max_concurrent Anfragen laufen gleichzeitig, die Wartezeiten
+        zählen nicht dazu. Der Bericht wird in Blöcken direkt in die Datei geschrieben und erst am Ende
+        umbenannt, eine halb geschriebene Datei bleibt damit nie liegen.
+
+        Die HTTP-Anfragen laufen über urllib in Threads (asyncio.to_thread), es wird kein weiteres Paket
+        benötigt. Mit url kann z.B. der FlexStubServer für Tests ohne IB verwendet werden. '''
+
+    def __init__(self, token, directory, url=None, max_concurrent=4, poll_interval=1.0, max_interval=30.0,
+                 timeout=600.0, request_timeout=60.0):
+        self.token = token
+        self.directory = directory
+        self.url = (url or FLEX_URL).rstrip("/")
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self.semaphore = None
+
+    def get_path(self, query_id):
+        return os.path.join(self.directory, f"Flex_{query_id}.xml")
+
+    def fetch(self, url):
+        ''' Kurze Antworten wie die von SendRequest werden komplett gelesen '''
+        with urlopen(url, timeout=self.request_timeout) as response:
+            return response.read()
+
+    def stream(self, url, path):
+        ''' Schreibt die Antwort von GetStatement blockweise in die Datei. Ist der Bericht noch nicht fertig oder
+            gibt es einen Fehler, kommt statt dessen eine kurze FlexStatementResponse, die zurückgegeben wird. '''
+        temporary = path + ".part"
+        with urlopen(url, timeout=self.request_timeout) as response:
+            chunk = response.read(CHUNK_SIZE)
+            if b"<FlexStatementResponse" in chunk[:512]:
+                return chunk + response.read()
+
+            with open(temporary, "wb") as file:
+                while chunk:
+                    file.write(chunk)
+                    chunk = response.read(CHUNK_SIZE)
+
+        os.replace(temporary, path)
+        return None
+
+    async def request(self, function, *args):
+        async with self.semaphore:
+            return await asyncio.to_thread(function, *args)
+
+    async def send_request(self, query_id):
+        ''' Fordert den Bericht an, gibt den Referenzcode und die Adresse für GetStatement zurück '''
+        url = f"{self.url}.SendRequest?" + urlencode({"t": self.token, "q": query_id, "v": FLEX_VERSION})
+        delay = self.poll_interval
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            status, elements = parse_response(await self.request(self.fetch, url))
+            if status == "Success":
+                return elements["ReferenceCode"], elements.get("Url") or f"{self.url}.GetStatement"
+
+            code = elements.get("ErrorCode", "")
+            if code not in RETRY_CODES or time.monotonic() + delay > deadline:
+                raise FlexError(code, elements.get("ErrorMessage", ""))
+            logging.info(f"Flex query {query_id}: {elements.get('ErrorMessage', '')}, next try in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_interval)
+
+    async def download(self, query_id):
+        ''' Lädt den Bericht einer Query herunter und gibt den Pfad der Datei zurück '''
+        reference_code, statement_url = await self.send_request(query_id)
+        url = f"{statement_url}?" + urlencode({"q": reference_code, "t": self.token, "v": FLEX_VERSION})
+        path = self.get_path(query_id)
+        delay = self.poll_interval
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            await asyncio.sleep(delay)
+            response = await self.request(self.stream, url, path)
+            if response is None:
+                logging.info(f"Flex query {query_id} was downloaded to {path}")
+                return path
+
+            status, elements = parse_response(response)
+            code = elements.get("ErrorCode", "")
+            if code not in RETRY_CODES or time.monotonic() + delay > deadline:
+                raise FlexError(code, elements.get("ErrorMessage", ""))
+            logging.info(f"Flex query {query_id}: {elements.get('ErrorMessage', '')}, next try in {delay:.1f}s")
+            delay = min(delay * 2, self.max_interval)
+
+    async def download_all(self, query_ids):
+        ''' Lädt alle Queries gleichzeitig herunter, die Pfade kommen in der Reihenfolge der Queries zurück.
+            Schlägt eine Query fehl, werden die anderen abgebrochen und der Fehler weitergegeben. '''
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        os.makedirs(self.directory, exist_ok=True)
+        tasks = [asyncio.ensure_future(self.download(query_id)) for query_id in query_ids]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for query_id in query_ids:
+                with suppress(FileNotFoundError):
+                    os.remove(self.get_path(query_id) + ".part")
+
+    def run(self, query_ids):
+        return asyncio.run(self.download_all(list(query_ids)))
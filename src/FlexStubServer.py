@@ -0,0 +1,147 @@
+import argparse
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+SERVLET = "/Universal/servlet/FlexStatementService"
+
+RESPONSE = """<FlexStatementResponse timestamp="01 January, 2022 12:00 AM EST">
+<Status>{status}</Status>
+{elements}
+</FlexStatementResponse>
+"""
+
+
+class FlexStubServer:
+    ''' Lokaler Ersatz für den Flex Web Service von IB, um den FlexDownloader ohne Zugang zu IB zu testen.
+
+        Die Berichte liegen als <Query-ID>.xml im Verzeichnis (z.B. mit SyntheticStatement erstellt). SendRequest
+        gibt einen Referenzcode zurück, GetStatement antwortet für jeden Referenzcode zuerst pending-mal mit
+        1019 (Statement generation in progress) und liefert danach die Datei. Ein falscher Token ergibt 1012,
+        eine unbekannte Query 1014.
+
+        Verwendung: with FlexStubServer("import") as server: FlexDownloader(..., url=server.url) '''
+
+    def __init__(self, directory, token="token", pending=1, host="127.0.0.1", port=0):
+        self.directory = directory
+        self.token = token
+        self.pending = pending
+        self.references = {}  # Referenzcode => [Query-ID, Anzahl der Abfragen]
+        self.reference_codes = count(1000000001)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.get_request_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{SERVLET}"
+
+    def get_request_handler(self):
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                request = urlparse(self.path)
+                parameters = {key: values[0] for key, values in parse_qs(request.query).items()}
+                if parameters.get("t") != stub.token:
+                    return self.send_xml(stub.get_error("1012", "Token has expired."))
+                if request.path == SERVLET + ".SendRequest":
+                    return self.send_xml(stub.send_request(parameters.get("q", "")))
+                if request.path == SERVLET + ".GetStatement":
+                    return stub.get_statement(self, parameters.get("q", ""))
+                self.send_error(404)
+
+            def send_xml(self, text):
+                data = text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def get_path(self, query_id):
+        return os.path.join(self.directory, f"{os.path.basename(query_id)}.xml")
+
+    def get_error(self, code, message):
+        return RESPONSE.format(status="Warn" if code == "1019" else "Fail",
+                               elements=f"<ErrorCode>{code}</ErrorCode>\n"
+                                        f"<ErrorMessage>{escape(message)}</ErrorMessage>")
+
+    def send_request(self, query_id):
+        if not query_id or not os.path.exists(self.get_path(query_id)):
+            return self.get_error("1014", "Query is invalid.")
+
+        with self.lock:
+            reference_code = str(next(self.reference_codes))
+            self.references[reference_code] = [query_id, 0]
+        return RESPONSE.format(status="Success", elements=f"<ReferenceCode>{reference_code}</ReferenceCode>\n"
+                                                          f"<Url>{self.url}.GetStatement</Url>")
+
+    def get_statement(self, handler, reference_code):
+        with self.lock:
+            reference = self.references.get(reference_code)
+            if reference is not None:
+                reference[1] += 1
+        if reference is None:
+            return handler.send_xml(self.get_error("1015", "Reference code is invalid."))
+        if reference[1] <= self.pending:
+            return handler.send_xml(self.get_error("1019", "Statement generation in progress. Please try again "
+                                                           "shortly."))
+
+        path = self.get_path(reference[0])
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/xml")
+        handler.send_header("Content-Length", str(os.path.getsize(path)))
+        handler.end_headers()
+        with open(path, "rb") as file:
+            shutil.copyfileobj(file, handler.wfile)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokaler Ersatz für den Flex Web Service von IB")
+    parser.add_argument("directory", help="Verzeichnis mit den Berichten als <Query-ID>.xml")
+    parser.add_argument("--token", default="token")
+    parser.add_argument("--pending", type=int, default=1, help="Anzahl der Antworten 1019 je Bericht")
+    parser.add_argument("--port", type=int, default=8765)
+    arguments = parser.parse_args()
+
+    server = FlexStubServer(arguments.directory, arguments.token, arguments.pending, port=arguments.port)
+    print(f"Flex stub server for {arguments.directory} at {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,38 @@
+import glob
+import hashlib
+import json
+import logging
 import os
 import xml.etree.ElementTree as eTree
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import suppress
+from itertools import repeat
 
 import pandas as pd
-from ib_insync import FlexReport
-from ib_insync import util
-from ib_insync.objects import DynamicObject
 
+from src.ColumnStore import CLEANED_DATA, OPEN_POSITIONS, OPEN_POSITIONS_FILE, ColumnStore
 from src.PathHandler import PathHandler
+from src.StatementSchema import SCHEMA_VERSION, STATEMENT_OF_FUNDS_FIELDS, STATEMENT_OF_FUNDS_SCHEMA, \
+    apply_schema
+
+# Schlüssel, über den doppelte Zeilen aus überlappenden Kapitalflussberichten erkannt werden
+DUPLICATE_KEY = ["accountId", "transactionID", "levelOfDetail"]
+
+
+def read_statement_of_funds(path, row_filter=None):
+    ''' Liest die StatementOfFundsLine einer Datei, wird bei mehreren Dateien im Process-Pool aufgerufen.
+        Zurückgegeben werden die Zeilen und die Anzahl der verworfenen Zeilen je Grund (siehe StatementFilter). '''
+    handler = ImportHandler()
+    handler.__load__(path)
+    funds = handler.__extract_columns__("StatementOfFundsLine", STATEMENT_OF_FUNDS_FIELDS, row_filter)
+    return funds, row_filter.rejected if row_filter is not None else {}
+
+
+def read_open_positions(path):
+    ''' Liest eine Excel-Datei mit offenen Positionen, wird bei mehreren Dateien im Process-Pool aufgerufen.
+        Es werden nur die Spalten des Schemas gelesen. '''
+    data = pd.read_excel(path, engine='openpyxl', usecols=lambda column: column in STATEMENT_OF_FUNDS_SCHEMA)
+    return apply_schema(data)
 
 
 class ImportHandler:
@@ -16,18 +41,47 @@ class ImportHandler:
         # Zuerst muss ich hier einmal die Pfade erstellen
         self.dir = PathHandler()
         dir = self.dir.get_working_dir()
-        self.dir_pickle_file = os.path.join(dir, "working_files", "cleaned_data.pkl")
+        self.store = ColumnStore(os.path.join(dir, "working_files"))
         self.dir_excel_backup = os.path.join(dir, "working_files", "ib_statement_prepared.xlsx")
+        self.dir_cache_manifest = os.path.join(dir, "working_files", "cleaned_data.json")
         self.dir_pickle_file_open_positions = os.path.join(dir, "working_files", "open_positions.pkl")
         self.dir_open_position_backup = os.path.join(dir, "working_files", "open_positions.xlsx")
         self.dir_import = os.path.join(dir, "import")
-        self.data = None
-        self.root = None
+        self.path = None
+        self.topics = None
 
     def __load__(self, path):
-        with open(path, 'rb') as file:
-            self.data = file.read()
-            self.root = eTree.fromstring(self.data)
+        ''' Merkt sich nur die Datei, die XML wird erst beim Extrahieren Stück für Stück gelesen '''
+        self.path = path
+        self.topics = None
+
+    def __iterparse__(self, topic=None, row_filter=None):
+        """
+        Stream the report and yield the attributes of every node of the given topic.
+        Processed elements are removed from their parent, so memory stays bounded
+        no matter how large the statement is. The topics found on the way are stored.
+        Nodes rejected by row_filter (see StatementFilter) are skipped before they are copied.
+        """
+        topics = set()
+        parents = []
+
+        for event, node in eTree.iterparse(self.path, events=("start", "end")):
+            if event == "start":
+                parents.append(node)
+                continue
+
+            parents.pop()
+            if node.attrib:
+                topics.add(node.tag)
+            if node.tag == topic and (row_filter is None or row_filter(node.attrib)):
+                yield dict(node.attrib)
+
+            # Der Knoten ist vollständig verarbeitet und wird aus dem Baum entfernt
+            node.clear()
+            if parents:
+                del parents[-1][-1]
+
+        self.topics = topics
 
     def __extract__(self, topic: str, parseNumbers=True) -> list:
         """
@@ -35,8 +89,10 @@ class ImportHandler:
         The topic is a string like TradeConfirm, ChangeInDividendAccrual,
         Order, etc.
         """
+        from ib_insync.objects import DynamicObject
+
         cls = type(topic, (DynamicObject,), {})
-        results = [cls(**node.attrib) for node in self.root.iter(topic)]
+        results = [cls(**attrib) for attrib in self.__iterparse__(topic)]
         if parseNumbers:
             for obj in results:
                 d = obj.__dict__
@@ -46,92 +102,238 @@ class ImportHandler:
                         d[k] = int(v)
         return results
 
+    def __extract_columns__(self, topic: str, fields: list, row_filter=None) -> pd.DataFrame:
+        """
+        Extract the given fields of all items of a topic straight into columns.
+        Missing attributes become empty strings, the typing is done by the schema.
+        Only the items accepted by row_filter are extracted.
+        """
+        columns = {field: [] for field in fields}
+        for attrib in self.__iterparse__(topic, row_filter):
+            for field in fields:
+                columns[field].append(attrib.get(field, ""))
+        return pd.DataFrame(columns, columns=fields)
+
     def __prepare_dataframe__(self, topic: str, parseNumbers=True):
         """Same as extract but return the result as a pandas DataFrame."""
+        from ib_insync import util
+
         return util.df(self.__extract__(topic, parseNumbers))
 
     def __store_dataframes__(self, data):
-        data.to_pickle(self.dir_pickle_file)
-
-    def __clean_StatementOfFundsLine__(self, data):
-
-        cleaned_funds = data[[
-            "accountId",
-            "transactionID",
-            "tradeID",
-            "orderID",
-            "date",
-            "reportDate",
-            "settleDate",
-            "activityCode",
-            "assetCategory",
-            "symbol",
-            "description",
-            "conid",
-            "underlyingConid",
-            "isin",
-            "underlyingSymbol",
-            "activityDescription",
-            "buySell",
-            "putCall",
-            "multiplier",
-            "strike",
-            "expiry",
-            "tradeQuantity",
-            "tradePrice",
-            "tradeGross",
-            "tradeCommission",
-            "currency",
-            "debit",
-            "credit",
-            "amount",
-            "tradeCode",
-            "balance",
-            "levelOfDetail"
-        ]]
-
-        cleaned_funds.to_excel(self.dir_excel_backup)
-        self.__store_dataframes__(cleaned_funds)
+        ''' Die Daten werden je Account abgelegt, damit jeder Account einzeln gelesen werden kann '''
+        self.store.write(CLEANED_DATA, data, partition_by="accountId")
+
+    def __get_cache_key__(self, *paths, row_filter=None):
+        ''' Der Schlüssel des Caches ist der Hash der Importdateien und der Bedingungen an die Zeilen zusammen mit
+            der Version des Schemas '''
+        file_hash = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    file_hash.update(block)
+        if row_filter is not None:
+            file_hash.update(row_filter.get_key().encode("utf-8"))
+
+        return f"{file_hash.hexdigest()}-{SCHEMA_VERSION}"
+
+    def __resolve_import_files__(self, import_filenames):
+        ''' Löst die Dateinamen und Muster (z.B. "*.xml") im Import-Ordner auf, jede Datei kommt nur einmal vor '''
+        if isinstance(import_filenames, str):
+            import_filenames = [import_filenames]
+
+        paths = []
+        for filename in import_filenames:
+            pattern = os.path.join(self.dir_import, filename)
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(filename) else [pattern]
+            if not matches:
+                print(f"No statement of funds matches {filename}")
+            paths += [path for path in matches if path not in paths]
+
+        return paths
+
+    def __merge_statements__(self, paths, max_workers=None, row_filter=None):
+        ''' Liest mehrere Kapitalflussberichte parallel ein und führt sie zusammen. Zeilen, die schon aus einer
+            anderen Datei übernommen wurden (gleicher DUPLICATE_KEY), werden direkt verworfen. Innerhalb einer Datei
+            bleiben alle Zeilen erhalten, wie beim Import einer einzelnen Datei. Es werden nur die Schlüssel
+            gemerkt, der Speicher wächst damit nicht mit der Überlappung der Dateien.
+            Zeilen ohne transactionID (z.B. Starting Balance) werden nicht zusammengeführt. '''
+        workers = min(max_workers or os.cpu_count() or 1, len(paths))
+        seen = set()
+        frames = []
+
+        def merge(funds):
+            keys = list(funds[DUPLICATE_KEY].itertuples(index=False, name=None))
+            keep = [transactionID == "" or key not in seen for transactionID, key in zip(funds["transactionID"], keys)]
+            # Die Schlüssel dieser Datei gelten erst für die folgenden Dateien
+            seen.update(keys)
+            frames.append(funds[keep])
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for funds, rejected in executor.map(read_statement_of_funds, paths, repeat(row_filter)):
+                    merge(funds)
+                    if row_filter is not None:
+                        row_filter.merge(rejected)
+        else:
+            for path in paths:
+                merge(read_statement_of_funds(path, row_filter)[0])
+
+        funds = pd.concat(frames, ignore_index=True)
+        print(f"{len(paths)} statements of funds with {len(funds)} unique rows were merged....")
+
+        # Ein sortierter Datensatz für die Verbuchung, die Zeilen ohne transactionID bleiben vorne
+        order = pd.to_numeric(funds["transactionID"], errors="coerce").fillna(-1)
+        return funds.iloc[order.argsort(kind="stable")].reset_index(drop=True)
+
+    def __load_from_cache__(self, cache_key):
+        ''' Lädt die aufbereiteten Daten, wenn diese aus der selben Importdatei erstellt wurden '''
+        try:
+            with open(self.dir_cache_manifest, 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get("key") != cache_key or not self.store.exists(CLEANED_DATA):
+            return None
+
+        try:
+            return self.store.read(CLEANED_DATA)
+        except (OSError, ValueError):
+            return None
+
+    def __store_cache_manifest__(self, cache_key, source):
+        with open(self.dir_cache_manifest, 'w') as file:
+            json.dump({"key": cache_key, "source": source, "schema_version": SCHEMA_VERSION}, file)
+
+    def __clean_StatementOfFundsLine__(self, data, excel_backup=False, persist=True):
+
+        # Nur die bekannten Felder werden übernommen und in die Typen des Schemas umgewandelt
+        cleaned_funds = apply_schema(data[STATEMENT_OF_FUNDS_FIELDS])
+
+        # Die Excel-Sicherung dauert lange und wird daher nur auf Wunsch erstellt
+        if excel_backup:
+            cleaned_funds.to_excel(self.dir_excel_backup)
+        if persist:
+            self.__store_dataframes__(cleaned_funds)
 
         print("The statement of funds was prepared successfully....")
         return cleaned_funds
 
+    def __report_rejected_rows__(self, row_filter):
+        ''' Gibt aus, welche Zeilen beim Einlesen verworfen wurden '''
+        if row_filter is None or not row_filter.rejected:
+            return
+
+        for (field, value), count in sorted(row_filter.rejected.items()):
+            if field == "accountId":
+                logging.error(f"The following account ({value}) is in the statement of funds but missing in the "
+                              f"config-file, {count} rows were skipped")
+            print(f"{count} rows were skipped while reading ({field}: {value})....")
+
     def get_report_topics(self):
         """Get the set of topics that can be extracted from this report."""
-        return set(node.tag for node in self.root.iter() if node.attrib)
-
-    def import_ib_xml_manual(self, import_filename):
-        ''' Hier importiere ich den Kapitalflussbericht, den ich manuell von IB heruntergeladen habe'''
-        path_import_file = os.path.join(self.dir_import, import_filename)
-        self.__load__(path_import_file)
-        funds = self.__prepare_dataframe__("StatementOfFundsLine")
-        cleaned_data = self.__clean_StatementOfFundsLine__(funds)
+        if self.topics is None:
+            for _ in self.__iterparse__():
+                pass
+        return self.topics
+
+    def import_ib_xml_manual(self, import_filename, excel_backup=False, row_filter=None, persist=True):
+        ''' Hier importiere ich den Kapitalflussbericht, den ich manuell von IB heruntergeladen habe.
+            Es kann auch eine Liste von Dateien oder ein Muster (z.B. "Kapitalflussbericht*.xml") angegeben
+            werden, die Dateien werden dann zusammengeführt (siehe __merge_statements__).
+            Mit row_filter (siehe StatementFilter) werden nur die Zeilen eingelesen, die verbucht werden können.
+            Wurden die Dateien seit dem letzten Import nicht verändert, werden die aufbereiteten Daten geladen.
+            Die Daten werden zurückgegeben und können direkt an den BookingStatementHandler übergeben werden,
+            ohne persist werden sie nicht in working_files abgelegt. '''
+        paths = self.__resolve_import_files__(import_filename)
+        if not paths:
+            raise FileNotFoundError(f"No statement of funds found for {import_filename}")
+        cache_key = self.__get_cache_key__(*paths, row_filter=row_filter)
+
+        cleaned_data = self.__load_from_cache__(cache_key)
+        if cleaned_data is not None:
+            if excel_backup:
+                cleaned_data.to_excel(self.dir_excel_backup)
+            print("The statement of funds is unchanged, the prepared data was loaded....")
+            return cleaned_data
+
+        if len(paths) == 1:
+            self.__load__(paths[0])
+            funds = self.__extract_columns__("StatementOfFundsLine", STATEMENT_OF_FUNDS_FIELDS, row_filter)
+        else:
+            funds = self.__merge_statements__(paths, row_filter=row_filter)
+        self.__report_rejected_rows__(row_filter)
+        cleaned_data = self.__clean_StatementOfFundsLine__(funds, excel_backup, persist)
+        if persist:
+            self.__store_cache_manifest__(cache_key, [os.path.basename(path) for path in paths])
         return cleaned_data
 
-    def import_open_position(self, account, open_position_filename):
-        ''' Hier importiere ich offene Positionen, sollten diese vorhanden sein '''
+    def import_open_positions(self, open_position_filenames, excel_backup=False, persist=True, max_workers=None):
+        ''' Importiert die offenen Positionen je Account (dict Account => Dateiname im Import-Ordner).
+            Jede Datei wird nur einmal gelesen, auch wenn sie für mehrere Accounts verwendet wird (z.B. das
+            Backup_OpenPositions.xlsx). Die gelesenen Dateien werden je Hash der Datei in working_files gemerkt
+            und bei einem erneuten Import von dort geladen, mehrere neue Dateien werden parallel gelesen.
+            Ohne persist werden die offenen Positionen nur zurückgegeben und nicht in working_files abgelegt. '''
+        paths = {account: os.path.join(self.dir_import, filename)
+                 for account, filename in open_position_filenames.items()}
+        keys = {path: self.__get_cache_key__(path) for path in set(paths.values())}
 
-        path_import_file = os.path.join(self.dir_import, open_position_filename)
-        data = pd.read_excel(path_import_file, engine='openpyxl')
+        files = {}
+        for path, key in keys.items():
+            with suppress(OSError, ValueError):
+                if self.store.exists(OPEN_POSITIONS_FILE.format(key=key)):
+                    files[path] = self.store.read(OPEN_POSITIONS_FILE.format(key=key), mmap_mode=None)
 
-        dir_pickle_file_open_positions = os.path.join(self.dir.get_working_dir(), "working_files",
-                                                      f"OpenPositions_{account}.pkl")
-        dir_open_position_backup = os.path.join(self.dir.get_working_dir(), "working_files",
-                                                f"OpenPositions_{account}.xlsx")
+        missing = sorted(path for path in keys if path not in files)
+        workers = min(max_workers or os.cpu_count() or 1, len(missing))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                files.update(zip(missing, executor.map(read_open_positions, missing)))
+        else:
+            files.update((path, read_open_positions(path)) for path in missing)
 
-        data.to_excel(dir_open_position_backup)
-        data.to_pickle(dir_pickle_file_open_positions)
+        if persist:
+            for path in missing:
+                self.store.write(OPEN_POSITIONS_FILE.format(key=keys[path]), files[path])
+            # Gemerkte Dateien, die es so nicht mehr gibt, werden gelöscht
+            for name in self.store.get_names(OPEN_POSITIONS_FILE.format(key="")):
+                if name not in [OPEN_POSITIONS_FILE.format(key=key) for key in keys.values()]:
+                    self.store.delete(name)
 
-        print(f"The open positions were loaded successfully and stored as OpenPositions_{account}....")
+        open_positions = {}
+        for account, path in paths.items():
+            # Jeder Account bekommt seine eigene Kopie, die Daten werden bei der Verbuchung verändert
+            data = files[path].copy()
 
-        return data
+            # Die Excel-Sicherung dauert lange und wird daher nur auf Wunsch erstellt
+            if excel_backup:
+                dir_open_position_backup = os.path.join(self.dir.get_working_dir(), "working_files",
+                                                        f"OpenPositions_{account}.xlsx")
+                data.to_excel(dir_open_position_backup)
+            if persist:
+                self.store.write(OPEN_POSITIONS.format(account=account), data)
 
-    def import_ib_xml_automatic(self, token, queryid):  # TODO, habe ich explzit ausgebaut, muss hier einmal die Dinge
-        # anpassen dass ich auch die einzelnen Punkte zu verschiedenen Punkten laden kann
+            open_positions[account] = data
+            print(f"The open positions were loaded successfully and stored as OpenPositions_{account}....")
 
-        report = FlexReport()
-        report.download(token, queryid)
-        funds = report.df("StatementOfFundsLine")
-        cleaned_data = self.__clean_StatementOfFundsLine__(funds)
+        logging.info(f"{len(missing)} of {len(keys)} open position files were read, the others were unchanged")
+        return open_positions
 
-        return cleaned_data
+    def import_open_position(self, account, open_position_filename, excel_backup=False, persist=True):
+        ''' Hier importiere ich offene Positionen eines Accounts, siehe import_open_positions '''
+        return self.import_open_positions({account: open_position_filename}, excel_backup, persist)[account]
+
+    def import_ib_xml_automatic(self, token, query_ids, excel_backup=False, row_filter=None, persist=True, url=None,
+                                max_concurrent=4):
+        ''' Lädt die Flex-Queries (z.B. eine je Account und Zeitraum) gleichzeitig über den Flex Web Service von IB
+            herunter (siehe FlexDownloader) und importiert sie danach wie import_ib_xml_manual. Die Berichte werden
+            als Flex_<Query-ID>.xml im Import-Ordner abgelegt, ein unveränderter Bericht kommt aus dem Cache. '''
+        # asyncio und urllib werden nur für den Download geladen
+        from src.FlexDownloader import FlexDownloader
+
+        downloader = FlexDownloader(token, self.dir_import, url=url, max_concurrent=max_concurrent)
+        paths = downloader.run(query_ids)
+        print(f"{len(paths)} flex queries were downloaded....")
+
+        return self.import_ib_xml_manual(paths, excel_backup=excel_backup, row_filter=row_filter, persist=persist)
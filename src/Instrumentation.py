@@ -0,0 +1,118 @@
+import cProfile
+import json
+import logging
+import os
+import time
+
+# Dateinamen des Berichts und des Profils, beide werden im Export-Ordner abgelegt
+REPORT_FILENAME = "Instrumentation.json"
+PROFILE_FILENAME = "Instrumentation.prof"
+
+
+class Instrumentation:
+    ''' Misst die Laufzeit der einzelnen Schritte (Laufzeit und CPU-Zeit), die Anzahl und die Zeit je
+        Kombination aus activityCode und assetCategory in generate_single_statements und zählt einzelne
+        Fälle wie die Optionen in close_position_fifo. Ohne enabled wird nichts gemessen.
+
+        Die Schritte werden nacheinander mit begin gestartet, ein neuer Schritt beendet den vorherigen.
+        In einem Process-Pool misst jeder Prozess für sich, die Ergebnisse werden mit take abgeholt und mit
+        merge wieder zusammengeführt. '''
+
+    def __init__(self, enabled=False, profile=False):
+        self.enabled = enabled
+        self.profile = profile
+        self.profiler = None
+        self.stages = {}  # Name => [Aufrufe, Laufzeit, CPU-Zeit]
+        self.branches = {}  # (activityCode, assetCategory) => [Anzahl, Zeit]
+        self.counters = {}  # Name => Anzahl
+        self.current = None  # (Name, Startzeit, CPU-Startzeit) des laufenden Schritts
+
+    def __getstate__(self):
+        ''' Ein anderer Prozess beginnt mit leeren Messwerten, das Profil bleibt im Hauptprozess '''
+        state = self.__dict__.copy()
+        state["profiler"] = None
+        state["stages"] = {}
+        state["branches"] = {}
+        state["counters"] = {}
+        state["current"] = None
+        return state
+
+    def begin(self, name):
+        ''' Beendet den laufenden Schritt und startet den nächsten '''
+        if not self.enabled:
+            return
+        self.end()
+        self.current = (name, time.perf_counter(), time.process_time())
+
+    def end(self):
+        if not self.enabled or self.current is None:
+            return
+        name, wall, cpu = self.current
+        self.current = None
+        self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+        stage[0] += calls
+        stage[1] += wall
+        stage[2] += cpu
+
+    def add_branch(self, activity_code, asset_category, seconds, count=1):
+        branch = self.branches.setdefault((activity_code, asset_category), [0, 0.0])
+        branch[0] += count
+        branch[1] += seconds
+
+    def count(self, name, count=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def take(self):
+        ''' Gibt die bisherigen Messwerte zurück und beginnt wieder mit leeren Messwerten '''
+        values = (self.stages, self.branches, self.counters)
+        self.stages, self.branches, self.counters = {}, {}, {}
+        return values
+
+    def merge(self, values):
+        ''' Übernimmt die Messwerte aus take, z.B. aus einem anderen Prozess '''
+        stages, branches, counters = values
+        for name, (calls, wall, cpu) in stages.items():
+            self.add_stage(name, wall, cpu, calls)
+        for (activity_code, asset_category), (count, seconds) in branches.items():
+            self.add_branch(activity_code, asset_category, seconds, count)
+        for name, count in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def start_profile(self):
+        ''' Startet cProfile, erfasst wird nur der Hauptprozess '''
+        if self.enabled and self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self, path):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        self.profiler = None
+
+    def to_dict(self):
+        stages = {name: {"calls": calls, "wall": round(wall, 4), "cpu": round(cpu, 4)}
+                  for name, (calls, wall, cpu) in self.stages.items()}
+        branches = [{"activityCode": activity_code, "assetCategory": asset_category, "count": count,
+                     "seconds": round(seconds, 4)}
+                    for (activity_code, asset_category), (count, seconds) in self.branches.items()]
+        branches.sort(key=lambda branch: branch["seconds"], reverse=True)
+
+        return {"stages": stages, "branches": branches, "counters": dict(sorted(self.counters.items()))}
+
+    def write_report(self, directory):
+        ''' Schreibt den Bericht (und das Profil, falls aktiviert) in den Export-Ordner '''
+        if not self.enabled:
+            return
+        self.end()
+        self.stop_profile(os.path.join(directory, PROFILE_FILENAME))
+
+        path = os.path.join(directory, REPORT_FILENAME)
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2, default=str)
+        logging.info(f"Der Bericht zur Laufzeit wurde in {path} gespeichert")
@@ -0,0 +1,62 @@
+import pandas as pd
+
+# Spalten und Reihenfolge des Buchungsjournals
+JOURNAL_COLUMNS = ["Account", "Belegnummer", "SATZ_ID", "DESC", "SUBDESC", "DATE", "SETTLEDATE", "TEXT", "AMOUNT",
+                   "SOLL", "HABEN", "QUALITYREL"]
+
+
+class JournalBuffer:
+    ''' Sammelt die Buchungssätze spaltenweise und erstellt das Journal erst am Ende als DataFrame.
+        Ein pd.concat pro Buchung würde das Journal bei jeder Buchung komplett neu aufbauen.
+        Jeder Buchungssatz merkt sich die Position der Zeile, aus der er entstanden ist, damit vorab
+        verbuchte Blöcke (siehe extend) wieder in der Reihenfolge der Zeilen einsortiert werden. '''
+
+    def __init__(self):
+        self.columns = {column: [] for column in JOURNAL_COLUMNS}
+        self.positions = []
+        self.frames = []
+        self.position = 0  # Position der Zeile, die gerade verbucht wird
+
+    def __len__(self):
+        return len(self.positions) + sum(len(frame) for frame in self.frames)
+
+    def append(self, entry):
+        ''' Hängt einen Buchungssatz an die Spalten an '''
+        for column in JOURNAL_COLUMNS:
+            self.columns[column].append(entry[column])
+        self.positions.append(self.position)
+
+    def extend(self, frame, positions):
+        ''' Übernimmt einen Block von Buchungssätzen mit den Positionen der zugehörigen Zeilen '''
+        frame = frame[JOURNAL_COLUMNS].copy()
+        frame["_position"] = positions
+        self.frames.append(frame)
+
+    def merge(self, other):
+        ''' Übernimmt die Buchungssätze eines anderen Buffers (z.B. eines Shards) mit ihren Positionen '''
+        if other.positions:
+            self.extend(pd.DataFrame(other.columns, columns=JOURNAL_COLUMNS), other.positions)
+        self.frames.extend(other.frames)
+
+    def clear(self):
+        for column in JOURNAL_COLUMNS:
+            self.columns[column] = []
+        self.positions = []
+        self.frames = []
+        self.position = 0
+
+    def to_dataframe(self):
+        ''' Erstellt das Journal in einem Schritt aus den gesammelten Spalten '''
+        journal = pd.DataFrame(self.columns, columns=JOURNAL_COLUMNS)
+        if not self.frames:
+            return journal
+
+        frames = self.frames
+        if self.positions:
+            journal["_position"] = self.positions
+            frames = [journal] + frames
+
+        journal = pd.concat(frames, ignore_index=True)
+        journal = journal.sort_values("_position", kind="stable").drop(columns="_position")
+
+        return journal.reset_index(drop=True)
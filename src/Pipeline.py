@@ -0,0 +1,169 @@
+import glob
+import os
+
+from src.Instrumentation import Instrumentation
+from src.PathHandler import PathHandler
+from src.Trace import Trace
+
+
+def import_data(config, persist=True, instrumentation=None, accounts=None):
+    ''' Importiert den Kapitalflussbericht und die offenen Positionen aller Accounts. Die Daten werden im Speicher
+        zurückgegeben (siehe book_data), mit persist werden sie zusätzlich in working_files abgelegt.
+        Mit accounts werden nur die offenen Positionen dieser Accounts neu importiert. '''
+    # Die Handler laden pandas und werden erst importiert, wenn der Schritt wirklich ausgeführt wird
+    from src.ImportHandler import ImportHandler
+
+    instrumentation = instrumentation or Instrumentation()
+    imp = ImportHandler()
+
+    # Importieren des Kapitalflussberichts - aktuell nur manuell
+    print(os.getcwd())
+    import_filename = config.get_statement_of_funds_names()
+    open_position_filename = config.get_file_open_positions_name()
+    print(import_filename)
+    instrumentation.begin("Import Kapitalflussbericht")
+
+    # Zeilen anderer Accounts, außerhalb des Zeitraums und die Saldenzeilen werden gar nicht erst eingelesen
+    if config.get_flex_queries():
+        # Mit Flex-Queries werden die Berichte zuerst über den Flex Web Service heruntergeladen
+        data = imp.import_ib_xml_automatic(config.get_flex_token(), config.get_flex_queries(),
+                                           excel_backup=config.get_excel_backup(),
+                                           row_filter=config.get_statement_filter(), persist=persist,
+                                           url=config.get_flex_url(), max_concurrent=config.get_flex_max_concurrent())
+    else:
+        data = imp.import_ib_xml_manual(import_filename, excel_backup=config.get_excel_backup(),
+                                        row_filter=config.get_statement_filter(), persist=persist)
+
+    # Die offenen Positionen aus der Konfiguration ersetzen das Backup des Accounts,
+    # jede Datei wird dabei nur einmal gelesen
+    instrumentation.begin("Import offene Positionen")
+    open_position_files = {}
+    for key in config.get_ib_accounts():
+        if accounts is None or key in accounts:
+            open_position_files[key] = open_position_filename.get(key, "Backup_OpenPositions.xlsx")
+
+    open_positions = imp.import_open_positions(open_position_files, excel_backup=config.get_excel_backup(),
+                                               persist=persist)
+    instrumentation.end()
+
+    return data, open_positions
+
+
+def book_data(config, data=None, open_positions=None, instrumentation=None, trace=None, accounts=None, since=None,
+              persist=False, export=True):
+    ''' Erstellt die Buchungssätze und die Exporte. Ohne data und open_positions werden die Daten des letzten
+        Imports aus working_files gelesen. Gibt den BookingStatementHandler mit dem Journal zurück.
+        Verbucht werden nur die Accounts aus accounts und, mit since (YYYYMMDD), nur die Accounts, die ab diesem
+        Tag Zeilen haben. Mit persist wird das Journal für export_data in working_files abgelegt. '''
+    from src.BookingStatementHandler import BookingStatementHandler
+
+    accounts_to_process = config.get_ib_accounts()
+    account_mapping = config.get_ib_to_accounting_map()
+    start_date = config.get_start_date()
+    end_date = config.get_end_date()
+    bookings = BookingStatementHandler(accounts_to_process, account_mapping, start_date, end_date, data=data,
+                                       open_positions=open_positions)
+
+    accounts_to_combine = config.get_ib_acc_combination()
+    if since:
+        changed = bookings.get_changed_accounts(since, accounts_to_combine)
+        accounts = changed if accounts is None else [account for account in accounts if account in changed]
+
+    bookings.generate_booking_journal(accounts_to_combine, parallel=config.get_parallel_accounts(),
+                                      parallel_symbols=config.get_parallel_symbols(),
+                                      incremental=config.get_incremental(), instrumentation=instrumentation,
+                                      trace=trace, accounts=accounts, export=export)
+    if persist:
+        bookings.store_journal()
+
+    return bookings
+
+
+def export_data(config, accounts=None, since=None):
+    ''' Erstellt die Import-Dateien für den MS-Buchhalter aus dem zuletzt verbuchten Journal in working_files,
+        ohne neu zu verbuchen. accounts und since schränken die Accounts wie in book_data ein.
+        Gibt die Pfade der geschriebenen Dateien zurück. '''
+    import pandas as pd
+
+    from src.BookingStatementHandler import combine_account, has_current_journal
+    from src.ColumnStore import JOURNAL, ColumnStore
+    from src.ExportHandler import ExportHandler
+
+    directory = PathHandler().get_working_dir()
+    store = ColumnStore(os.path.join(directory, "working_files"))
+    if not store.exists(JOURNAL):
+        raise FileNotFoundError("There is no booking journal in working_files, please run book first")
+    if not has_current_journal(store):
+        # z.B. ein Journal mit den Beträgen in Euro, bevor diese als Ganzzahlen abgelegt wurden
+        raise ValueError("The booking journal in working_files was written by another version, please run book again")
+
+    selected = store.get_partitions(JOURNAL)
+    if accounts is not None:
+        accounts_to_combine = config.get_ib_acc_combination()
+        targets = {combine_account(account, accounts_to_combine) for account in accounts}
+        selected = [account for account in selected if account in targets]
+
+    journal = store.read(JOURNAL, partitions=selected)
+    if since:
+        selected = list(journal.loc[pd.to_datetime(journal["DATE"]) >= pd.Timestamp(since), "Account"].unique())
+        journal = journal[journal["Account"].isin(selected)]
+
+    return ExportHandler(os.path.join(directory, "export")).generate_MSBuchhalter_Import(journal, selected)
+
+
+def check_config(config):
+    ''' Prüft die Konfiguration und ob die angegebenen Dateien vorhanden sind, ohne Daten zu lesen.
+        Gibt die gefundenen Probleme als Liste zurück, eine leere Liste bedeutet alles in Ordnung. '''
+    problems = []
+    dir_import = os.path.join(PathHandler().get_working_dir(), "import")
+
+    for name, get_date in (("start_date", config.get_start_date), ("end_date", config.get_end_date)):
+        try:
+            if not get_date():
+                problems.append(f"[Dates] {name} is missing")
+        except ValueError:
+            problems.append(f"[Dates] {name} is not a date like 31.12.2021")
+
+    try:
+        accounts = config.get_ib_accounts()
+    except KeyError:
+        return problems + ["[Accounts] IB-Accounts is missing"]
+
+    settings = config.read_config()
+    for account in accounts:
+        try:
+            int(settings["IBAccountMappingToAccounting"][account])
+        except KeyError:
+            problems.append(f"[IBAccountMappingToAccounting] account {account} is not mapped")
+        except ValueError:
+            problems.append(f"[IBAccountMappingToAccounting] account {account} is not mapped to a number")
+
+    for key, value in config.get_ib_acc_combination().items():
+        if value not in accounts:
+            problems.append(f"[IBTransferMapping] {key} is combined with {value}, which is not in IB-Accounts")
+
+    filenames = config.get_statement_of_funds_names()
+    if config.get_flex_queries():
+        # Die Kapitalflussberichte werden heruntergeladen
+        filenames = []
+        if not config.get_flex_token():
+            problems.append("[Download] Token is missing for the flex queries")
+    elif not filenames:
+        problems.append("[Import] Dateiname Kapitalflussbericht is missing")
+    for filename in filenames:
+        if not glob.glob(os.path.join(dir_import, filename)):
+            problems.append(f"[Import] no statement of funds matches {filename} in {dir_import}")
+
+    for account, filename in config.get_file_open_positions_name().items():
+        if not os.path.exists(os.path.join(dir_import, filename)):
+            problems.append(f"[OpenPositions] {filename} of account {account} is missing in {dir_import}")
+
+    return problems
+
+
+def run_pipeline(config, persist=True, instrumentation=None, trace=None, accounts=None, since=None):
+    ''' Import und Verbuchung in einem Aufruf, die Daten werden dabei direkt im Speicher übergeben '''
+    data, open_positions = import_data(config, persist=persist, instrumentation=instrumentation)
+    return book_data(config, data, open_positions, instrumentation=instrumentation,
+                     trace=trace or Trace(config.get_trace_buffer()), accounts=accounts, since=since,
+                     persist=persist)
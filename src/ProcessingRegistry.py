@@ -0,0 +1,70 @@
+import pandas as pd
+
+# Spalten des Processed_ID Sheets
+PROCESSED_COLUMNS = ["account", "transactionID", "date", "processedAmount"]
+
+
+class ProcessingRegistry:
+    ''' Merkt sich die verbuchten Transaction-IDs je Account.
+        Die Prüfung, ob eine ID schon verbucht wurde, ist ein Lookup im Dictionary, die Einträge selbst werden
+        nur angehängt und erst am Ende eines Accounts in einen DataFrame umgewandelt. Wie beim Journal wird die
+        Position der Zeile mitgeführt, damit vorab registrierte Blöcke in der richtigen Reihenfolge erscheinen. '''
+
+    def __init__(self):
+        self.keys = set()
+        self.entries = {}
+        self.position = 0  # Position der Zeile, die gerade verbucht wird
+
+    def __contains__(self, key):
+        account_id, transactionID = key
+        return (account_id, int(transactionID)) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def register(self, account_id, transactionID, amount, date, position=None):
+        ''' Speichert die Transaction-ID, falls diese noch nicht verbucht wurde. Gibt zurück, ob sie neu war. '''
+        transactionID = int(transactionID)
+        key = (account_id, transactionID)
+
+        if key in self.keys:
+            return False
+
+        self.keys.add(key)
+        columns = self.entries.setdefault(account_id, {column: [] for column in PROCESSED_COLUMNS + ["position"]})
+        columns["account"].append(account_id)
+        columns["transactionID"].append(transactionID)
+        columns["date"].append(date)
+        columns["processedAmount"].append(amount)
+        columns["position"].append(self.position if position is None else position)
+
+        return True
+
+    def register_many(self, account_ids, transactionIDs, amounts, dates, positions):
+        ''' Registriert einen Block von Zeilen, die vorab verbucht wurden '''
+        for entry in zip(account_ids, transactionIDs, amounts, dates, positions):
+            self.register(*entry)
+
+    def merge(self, other, offset=0):
+        ''' Übernimmt die Einträge einer anderen Registry (z.B. aus einem anderen Prozess), bestehende bleiben.
+            offset wird auf die Positionen addiert, wenn die andere Registry spätere Zeilen verbucht hat. '''
+        for columns in other.entries.values():
+            self.register_many(columns["account"], columns["transactionID"], columns["processedAmount"],
+                               columns["date"], [position + offset for position in columns["position"]])
+
+    def to_dataframe(self, account_id=None):
+        ''' Erstellt die verbuchten Einträge eines oder aller Accounts als DataFrame '''
+        if account_id is None:
+            frames = [self.to_dataframe(account) for account in self.entries]
+            if not frames:
+                return pd.DataFrame(columns=PROCESSED_COLUMNS)
+            return pd.concat(frames, ignore_index=True)
+
+        columns = self.entries.get(account_id)
+        if columns is None:
+            return pd.DataFrame(columns=PROCESSED_COLUMNS)
+
+        processed = pd.DataFrame(columns, columns=PROCESSED_COLUMNS + ["position"])
+        processed = processed.sort_values("position", kind="stable").drop(columns="position")
+
+        return processed.reset_index(drop=True)
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_number
+
+# Version des Schemas, muss erhöht werden, sobald sich die Felder oder Typen ändern
+SCHEMA_VERSION = 1
+
+ID = "id"  # Ganzzahl, leere Werte bleiben leer (Int64)
+DATE = "date"  # YYYYMMDD => datetime64
+AMOUNT = "amount"  # float, leere Werte werden NaN
+QUANTITY = "quantity"  # float, leere Werte werden 0
+CODE = "code"  # kategorische Werte wie activityCode oder assetCategory
+TEXT = "text"  # Zeichenkette, leere Werte bleiben ""
+
+# Die Felder der StatementOfFundsLine, die verarbeitet werden, mit ihrem Typ
+STATEMENT_OF_FUNDS_SCHEMA = {
+    "accountId": TEXT,
+    "transactionID": ID,
+    "tradeID": ID,
+    "orderID": ID,
+    "date": DATE,
+    "reportDate": DATE,
+    "settleDate": DATE,
+    "activityCode": CODE,
+    "assetCategory": CODE,
+    "symbol": TEXT,
+    "description": TEXT,
+    "conid": ID,
+    "underlyingConid": ID,
+    "isin": TEXT,
+    "underlyingSymbol": TEXT,
+    "activityDescription": TEXT,
+    "buySell": CODE,
+    "putCall": CODE,
+    "multiplier": AMOUNT,
+    "strike": AMOUNT,
+    "expiry": DATE,
+    "tradeQuantity": QUANTITY,
+    "tradePrice": AMOUNT,
+    "tradeGross": AMOUNT,
+    "tradeCommission": AMOUNT,
+    "currency": CODE,
+    "debit": AMOUNT,
+    "credit": AMOUNT,
+    "amount": QUANTITY,
+    "tradeCode": CODE,
+    "balance": AMOUNT,
+    "levelOfDetail": CODE,
+}
+
+STATEMENT_OF_FUNDS_FIELDS = list(STATEMENT_OF_FUNDS_SCHEMA)
+
+
+def is_empty(value):
+    if value is None or (isinstance(value, str) and value == ""):
+        return True
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def to_ids(values):
+    return pd.array([None if is_empty(value) else int(value) for value in values], dtype="Int64")
+
+
+def to_dates(values):
+    if is_datetime64_any_dtype(values):
+        return values
+
+    # Jeder Wert wird nur einmal geparst, Zahlen (z.B. 20210105 aus Excel) werden vorher in YYYYMMDD umgewandelt
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    uniques = [None if is_empty(value) else str(int(value)) if is_number(value) else value for value in uniques]
+    dates = pd.to_datetime(pd.Series(uniques, dtype=object), format="%Y%m%d").to_numpy(dtype="datetime64[ns]")
+
+    # Leere Werte haben den Code -1 und bekommen damit das angehängte NaT
+    return np.append(dates, np.datetime64("NaT", "ns"))[codes]
+
+
+def to_numbers(values, default=np.nan):
+    numbers = pd.to_numeric(pd.Series(values, dtype=object).replace("", np.nan)).astype(float)
+    return numbers.fillna(default).to_numpy()
+
+
+def to_texts(values):
+    return np.array(["" if is_empty(value) else str(value) for value in values], dtype=object)
+
+
+def apply_schema(data, schema=None):
+    ''' Wandelt die Spalten eines DataFrames in die Typen des Schemas um, Spalten ohne Schema bleiben unverändert.
+        Die Umwandlung funktioniert sowohl für die Zeichenketten aus der XML als auch für bereits geparste Werte
+        (z.B. aus Excel oder dem FlexReport). '''
+    schema = STATEMENT_OF_FUNDS_SCHEMA if schema is None else schema
+    typed = {}
+
+    for column in data.columns:
+        kind = schema.get(column)
+        values = data[column]
+
+        if kind == ID:
+            values = to_ids(values)
+        elif kind == DATE:
+            values = to_dates(values)
+        elif kind == AMOUNT:
+            values = to_numbers(values)
+        elif kind == QUANTITY:
+            values = to_numbers(values, default=0.0)
+        elif kind == CODE:
+            values = pd.Categorical(to_texts(values))
+        elif kind == TEXT:
+            values = to_texts(values)
+
+        typed[column] = values
+
+    return pd.DataFrame(typed, index=data.index, columns=data.columns)
+
+
+# Zeilen von IB, die nur Salden enthalten und nie verbucht werden
+BALANCE_ROWS = ("Starting Balance", "FX Translations P&L", "Ending Balance")
+
+
+class StatementFilter:
+    ''' Bedingungen an die Zeilen des Kapitalflussberichts, die schon beim Lesen der XML auf den Attributen geprüft
+        werden, damit Zeilen, die nie verbucht werden, gar nicht erst eingelesen werden:
+        - nur die angegebenen Accounts (leer = alle)
+        - nur Zeilen zwischen start_date und end_date (YYYYMMDD), Zeilen ohne Datum werden ebenfalls verworfen
+        - nur die angegebenen levelOfDetail (leer = alle)
+        - ohne die Saldenzeilen aus BALANCE_ROWS
+        Die Anzahl der verworfenen Zeilen wird je Grund in rejected gezählt. '''
+
+    def __init__(self, accounts=None, start_date="", end_date="", levels_of_detail=None, balance_rows=BALANCE_ROWS):
+        self.accounts = frozenset(accounts or ())
+        self.start_date = start_date or ""
+        self.end_date = end_date or ""
+        self.levels_of_detail = frozenset(levels_of_detail or ())
+        self.balance_rows = frozenset(balance_rows or ())
+        self.rejected = {}
+
+    def get_key(self):
+        ''' Beschreibung der Bedingungen für den Schlüssel des Caches '''
+        return repr((sorted(self.accounts), self.start_date, self.end_date, sorted(self.levels_of_detail),
+                     sorted(self.balance_rows)))
+
+    def reject(self, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return False
+
+    def __call__(self, attrib):
+        if self.accounts and attrib.get("accountId", "") not in self.accounts:
+            return self.reject(("accountId", attrib.get("accountId", "")))
+
+        if attrib.get("activityDescription", "") in self.balance_rows:
+            return self.reject(("activityDescription", attrib.get("activityDescription", "")))
+
+        if self.levels_of_detail and attrib.get("levelOfDetail", "") not in self.levels_of_detail:
+            return self.reject(("levelOfDetail", attrib.get("levelOfDetail", "")))
+
+        if self.start_date or self.end_date:
+            # Datumswerte, die nicht als YYYYMMDD vorliegen, werden erst bei der Verbuchung gefiltert
+            date = attrib.get("date", "")[:8]
+            if date == "":
+                return self.reject(("date", "leer"))
+            if date.isdigit() and ((self.start_date and date < self.start_date) or
+                                   (self.end_date and date > self.end_date)):
+                return self.reject(("date", "außerhalb des Zeitraums"))
+
+        return True
+
+    def merge(self, rejected):
+        for reason, count in rejected.items():
+            self.rejected[reason] = self.rejected.get(reason, 0) + count
@@ -0,0 +1,281 @@
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import quoteattr
+
+import pandas as pd
+
+from src.StatementSchema import STATEMENT_OF_FUNDS_FIELDS
+
+# Gewichtung der Geschäftsvorfälle im synthetischen Kapitalflussbericht
+ACTIVITY_WEIGHTS = {
+    "stock_trade": 30,
+    "option_trade": 14,
+    "option_expiry": 4,
+    "future_trade": 6,
+    "cfd_trade": 5,
+    "future_adjustment": 3,
+    "dividend": 8,
+    "withholding_tax": 4,
+    "payment_in_lieu": 1,
+    "cash": 10,
+    "cfd_charge": 5,
+    "forex": 3,
+    "transfer": 2,
+    "fx_translation": 1,
+}
+
+
+class SyntheticStatement:
+    ''' Erstellt einen realistischen, aber frei erfundenen Kapitalflussbericht (StatementOfFundsLine) und die
+        passenden offenen Positionen des Vorjahres, z.B. für Benchmarks ohne echte Daten.
+        Enthalten sind Aktien, Optionen, Optionen auf Futures, Futures und CFDs mit Teilausführungen (mehrere
+        Zeilen je Order), Zuteilungen und Verfällen, dazu Dividenden, Steuern, Zinsen, Gebühren, CFD-Zahlungen,
+        Forex und Bankbewegungen. Mit dem selben seed entsteht immer die selbe Datei. '''
+
+    def __init__(self, accounts=("U0000001",), symbols=50, rows=10000, seed=1, year=2021):
+        self.accounts = list(accounts)
+        self.symbols = ["S%04d" % index for index in range(symbols)]
+        self.rows = rows
+        self.seed = seed
+        self.year = year
+        self.transactionID = 100000000
+        self.days = self.__get_business_days__()
+        self.settle_days = {day: self.days[min(index + 2, len(self.days) - 1)] for index, day in enumerate(self.days)}
+
+    def __get_business_days__(self):
+        day = date(self.year, 1, 1)
+        days = []
+        while day.year == self.year:
+            if day.weekday() < 5:
+                days.append(int(day.strftime("%Y%m%d")))
+            day += timedelta(days=1)
+        return days
+
+    def __next_id__(self, random_generator):
+        self.transactionID += random_generator.randint(1, 20)
+        return self.transactionID
+
+    def get_rows_per_account(self):
+        rows = [self.rows // len(self.accounts)] * len(self.accounts)
+        rows[0] += self.rows - sum(rows)
+        return dict(zip(self.accounts, rows))
+
+    def get_open_positions(self, account):
+        ''' Offene Aktienpositionen aus dem Vorjahr, je Symbol mit einer Wahrscheinlichkeit von 50% '''
+        random_generator = random.Random(f"{self.seed}-{account}-open")
+        lots = []
+        for index, symbol in enumerate(self.symbols):
+            if random_generator.random() < 0.5:
+                continue
+            quantity = random_generator.choice([50, 100, 200])
+            price = round(random_generator.uniform(10, 200), 2)
+            day = int(f"{self.year - 1}1215")
+            lot = {field: "" for field in STATEMENT_OF_FUNDS_FIELDS}
+            lot.update(accountId=account, transactionID=90000000 + index, date=day, reportDate=day,
+                       settleDate=day, activityCode="BUY", assetCategory="STK", symbol=symbol,
+                       description=f"{symbol} INC", underlyingSymbol=symbol, buySell="BUY",
+                       activityDescription=f"Buy {quantity} {symbol}", multiplier=1, tradeQuantity=quantity,
+                       tradePrice=price, tradeGross=-quantity * price, tradeCommission=-1.0, currency="EUR",
+                       debit=round(-quantity * price - 1.0, 6), amount=round(-quantity * price - 1.0, 6),
+                       levelOfDetail="BaseCurrency", balance=0)
+            lots.append(lot)
+        return lots
+
+    def write_open_positions(self, path, account):
+        ''' Schreibt die offenen Positionen im Format von import/Template_OpenPositions.xlsx '''
+        pd.DataFrame(self.get_open_positions(account), columns=STATEMENT_OF_FUNDS_FIELDS).to_excel(path, index=False)
+
+    def generate(self, account, count):
+        ''' Erzeugt die Zeilen eines Accounts in der Reihenfolge der transactionID. Die Zeilen werden einzeln
+            zurückgegeben, damit auch sehr große Dateien geschrieben werden können. '''
+        random_generator = random.Random(f"{self.seed}-{account}")
+        activities = list(ACTIVITY_WEIGHTS)
+        weights = list(ACTIVITY_WEIGHTS.values())
+        stocks = {lot["symbol"]: lot["tradeQuantity"] for lot in self.get_open_positions(account)}
+        options = {}  # Optionssymbol => (Menge, Kategorie, Underlying, Put/Call, Strike)
+        rows = []
+
+        def line(index, **fields):
+            day = self.days[min(index * len(self.days) // max(count, 1), len(self.days) - 1)]
+            row = {field: "" for field in STATEMENT_OF_FUNDS_FIELDS}
+            row.update(accountId=account, date=day, reportDate=day, currency="EUR", levelOfDetail="BaseCurrency",
+                       multiplier=1, tradeQuantity=0, tradePrice=0, tradeGross=0, tradeCommission=0, balance=0)
+            if random_generator.random() < 0.8:
+                row["settleDate"] = self.settle_days[day]
+            row["transactionID"] = self.__next_id__(random_generator)
+            row.update(fields)
+            amount = float(row.get("amount") or 0)
+            if amount < 0:
+                row["debit"] = amount
+            elif amount > 0:
+                row["credit"] = amount
+            rows.append(row)
+
+        line(0, activityDescription="Starting Balance", amount=0)
+        line(0, activityCode="DEP", assetCategory="CASH", activityDescription="Cash Transfer", amount=100000)
+
+        index = 0
+        while index < count:
+            yield from rows
+            rows.clear()
+            activity = random_generator.choices(activities, weights)[0]
+            symbol = random_generator.choice(self.symbols)
+
+            if activity == "stock_trade":
+                # Eine Order wird oft in mehreren Teilen ausgeführt, jede Ausführung ist eine eigene Zeile
+                held = stocks.get(symbol, 0)
+                side = "SELL" if held > 0 and random_generator.random() < 0.45 else "BUY"
+                quantity = random_generator.choice([50, 100, 150, 200])
+                if side == "SELL":
+                    # Leerverkäufe von Aktien kann die Verbuchung nicht abbilden, verkauft wird höchstens der Bestand
+                    quantity = min(quantity, held)
+                price = round(random_generator.uniform(10, 200), 2)
+                order = self.__next_id__(random_generator)
+                fills = self.__split__(random_generator, quantity)
+                for fill in fills:
+                    signed = fill if side == "BUY" else -fill
+                    line(index, activityCode=side, assetCategory="STK", symbol=symbol, description=f"{symbol} INC",
+                         underlyingSymbol=symbol, buySell=side, orderID=order,
+                         tradeID=self.__next_id__(random_generator),
+                         activityDescription=f"{side.title()} {signed} {symbol} ", tradeQuantity=signed,
+                         tradePrice=price, tradeGross=round(-signed * price, 6), tradeCommission=-1.0,
+                         amount=round(-signed * price - 1.0, 6))
+                stocks[symbol] = held + (quantity if side == "BUY" else -quantity)
+                index += len(fills)
+
+            elif activity == "option_trade":
+                category = random_generator.choice(["OPT", "OPT", "FOP"])
+                underlying = symbol if category == "OPT" else f"F{symbol}"
+                put_call = random_generator.choice("PC")
+                strike = random_generator.choice([50, 100, 150])
+                expiry = self.days[-1]
+                option = f"{underlying:<6}{str(expiry)[2:]}{put_call}{strike * 1000:08d}"
+                quantity = random_generator.randint(1, 5)
+                held = options.get(option, (0,))[0]
+                side = random_generator.choice(["BUY", "SELL"])
+                if held != 0:
+                    # Optionen werden nicht nach FIFO verbucht, es gibt daher je Option nur ein Lot, das mit dem
+                    # nächsten Trade komplett geschlossen wird
+                    side = "SELL" if held > 0 else "BUY"
+                    quantity = abs(held)
+                signed = quantity if side == "BUY" else -quantity
+                premium = round(random_generator.uniform(10, 300) * quantity, 6)
+                line(index, activityCode=side, assetCategory=category, symbol=option, underlyingSymbol=underlying,
+                     buySell=side, putCall=put_call, multiplier=100, strike=strike, expiry=expiry,
+                     activityDescription=f"{side.title()} {signed} {option} ", tradeQuantity=signed,
+                     tradeCommission=-1.0, amount=-premium if side == "BUY" else premium)
+                options[option] = (held + signed, category, underlying, put_call, strike)
+                index += 1
+
+            elif activity == "option_expiry" and options:
+                # Offene Optionen verfallen oder werden zugeteilt, bei Aktienoptionen mit Einbuchung der Aktie
+                option = random_generator.choice(sorted(options))
+                held, category, underlying, put_call, strike = options.pop(option)
+                if held == 0:
+                    continue
+                # Zugeteilt werden nur Puts und gedeckte Calls, damit der Aktienbestand nie negativ wird
+                covered = put_call == "P" or stocks.get(underlying, 0) >= 100 * -held
+                code = "ASSIGN" if held < 0 and category == "OPT" and covered and random_generator.random() < 0.4 \
+                    else "EXP"
+                line(index, activityCode=code, assetCategory=category, symbol=option, underlyingSymbol=underlying,
+                     buySell="BUY" if held < 0 else "SELL", putCall=put_call, multiplier=100, strike=strike,
+                     expiry=self.days[-1], activityDescription=f"{code} {-held} {option} ", tradeQuantity=-held,
+                     amount=0)
+                index += 1
+                if code == "ASSIGN":
+                    side = "BUY" if put_call == "P" else "SELL"
+                    quantity = 100 * -held if side == "BUY" else 100 * held
+                    line(index, activityCode="ASSIGN", assetCategory="STK", symbol=underlying,
+                         underlyingSymbol=underlying, buySell=side, activityDescription=f"Assign {underlying}",
+                         tradeQuantity=quantity, tradePrice=strike, amount=round(-quantity * strike, 6))
+                    stocks[underlying] = stocks.get(underlying, 0) + quantity
+                    index += 1
+
+            elif activity in ("future_trade", "cfd_trade"):
+                category = "FUT" if activity == "future_trade" else "CFD"
+                side = random_generator.choice(["BUY", "SELL"])
+                amount = random_generator.choice([0, round(random_generator.uniform(-500, 500), 6)])
+                line(index, activityCode=side, assetCategory=category, symbol=f"F{symbol}",
+                     underlyingSymbol=symbol, buySell=side, activityDescription=f"{side.title()} {symbol}",
+                     tradeQuantity=1 if side == "BUY" else -1, amount=amount)
+                index += 1
+
+            elif activity == "future_adjustment":
+                line(index, activityCode="ADJ", assetCategory="FUT", symbol=f"F{symbol}", underlyingSymbol=symbol,
+                     activityDescription=f"Position MTM {symbol}",
+                     amount=round(random_generator.uniform(-50, 50), 6))
+                index += 1
+
+            elif activity == "dividend":
+                line(index, activityCode="DIV", assetCategory="STK", symbol=symbol, underlyingSymbol=symbol,
+                     activityDescription=f"{symbol} Cash Dividend", amount=round(random_generator.uniform(1, 50), 6))
+                index += 1
+
+            elif activity == "withholding_tax":
+                line(index, activityCode="FRTAX", assetCategory="STK", symbol=symbol, underlyingSymbol=symbol,
+                     activityDescription=f"{symbol} Cash Dividend - US Tax",
+                     amount=round(-random_generator.uniform(1, 10), 6))
+                index += 1
+
+            elif activity == "payment_in_lieu":
+                line(index, activityCode="PIL", assetCategory="STK", symbol=symbol, underlyingSymbol=symbol,
+                     activityDescription=f"{symbol} Payment in Lieu of Dividend",
+                     amount=round(random_generator.uniform(1, 10), 6))
+                index += 1
+
+            elif activity == "cash":
+                code = random_generator.choice(["CINT", "DINT", "BFEE", "OFEE", "STAX"])
+                line(index, activityCode=code, assetCategory="" if code == "OFEE" else "CASH",
+                     activityDescription=f"EUR {code} {index}", amount=round(random_generator.uniform(-20, 5), 6))
+                index += 1
+
+            elif activity == "cfd_charge":
+                if random_generator.random() < 0.5:
+                    line(index, activityCode="CFD", activityDescription=f"CFD INTEREST {index}",
+                         amount=round(random_generator.uniform(-5, 1), 6))
+                else:
+                    line(index, activityCode="CFD", assetCategory="CFD", symbol=f"F{symbol}",
+                         underlyingSymbol=symbol, activityDescription=f"F{symbol} USD conversion",
+                         amount=round(random_generator.uniform(-5, 5), 6))
+                index += 1
+
+            elif activity == "forex":
+                line(index, activityCode="FOREX", assetCategory="CASH", symbol="EUR.USD",
+                     activityDescription="Forex EUR.USD", amount=round(random_generator.uniform(-5, 5), 6))
+                index += 1
+
+            elif activity == "transfer":
+                code = random_generator.choice(["DEP", "WITH"])
+                line(index, activityCode=code, assetCategory="CASH", activityDescription="Cash Transfer",
+                     amount=1000 if code == "DEP" else -1000)
+                index += 1
+
+            elif activity == "fx_translation":
+                line(index, activityDescription="FX Translations P&L",
+                     amount=round(random_generator.uniform(-5, 5), 6))
+                index += 1
+
+        line(count - 1, activityDescription="Ending Balance", amount=0)
+        yield from rows
+
+    def __split__(self, random_generator, quantity):
+        ''' Teilt eine Order in bis zu vier Ausführungen auf '''
+        parts = random_generator.choice([1, 1, 2, 3, 4])
+        if quantity < parts * 10:
+            return [quantity]
+        cuts = sorted(random_generator.sample(range(10, quantity, 10), parts - 1)) if parts > 1 else []
+        return [end - start for start, end in zip([0] + cuts, cuts + [quantity])]
+
+    def write_xml(self, path):
+        ''' Schreibt den Kapitalflussbericht im Format des Flex-Reports, Account für Account '''
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(f'<FlexQueryResponse queryName="Synthetic" type="AF">\n'
+                       f'<FlexStatements count="{len(self.accounts)}">\n')
+            for account, count in self.get_rows_per_account().items():
+                file.write(f'<FlexStatement accountId="{account}" fromDate="{self.year}0101" '
+                           f'toDate="{self.year}1231" period="Year">\n<StatementOfFunds>\n')
+                for row in self.generate(account, count):
+                    attributes = " ".join(f"{field}={quoteattr(str(value))}" for field, value in row.items())
+                    file.write(f"<StatementOfFundsLine {attributes} />\n")
+                file.write("</StatementOfFunds>\n</FlexStatement>\n")
+            file.write("</FlexStatements>\n</FlexQueryResponse>\n")
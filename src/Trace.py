@@ -0,0 +1,42 @@
+import logging
+from collections import deque
+
+
+class Trace:
+    ''' Protokoll der Verbuchung mit strukturierten Einträgen (Ereignis und Felder). Die Einträge werden nur
+        erstellt, wenn active gesetzt ist, und erst beim Schreiben ins Log formatiert.
+
+        active wird mit refresh einmal vor der Verbuchung bestimmt und nicht bei jeder Zeile: entweder ist das
+        Log-Level DEBUG bzw. INFO aktiv oder es gibt einen Ringpuffer. Der Ringpuffer hält die letzten size
+        Einträge im Speicher und wird nur ins Log geschrieben, wenn eine Zeile nicht verbucht werden kann. '''
+
+    def __init__(self, size=0):
+        self.size = size
+        self.records = deque(maxlen=size) if size > 0 else None
+        self.level = logging.CRITICAL + 1  # niedrigstes Level, das ins Log geschrieben wird
+        self.active = False
+
+    def refresh(self):
+        ''' Prüft einmal, ob die Einträge ins Log geschrieben oder im Ringpuffer gehalten werden '''
+        logger = logging.getLogger()
+        self.level = logging.DEBUG if logger.isEnabledFor(logging.DEBUG) else \
+            logging.INFO if logger.isEnabledFor(logging.INFO) else logging.CRITICAL + 1
+        self.active = self.level <= logging.INFO or self.records is not None
+
+    def record(self, level, event, **fields):
+        ''' Hält den Eintrag im Ringpuffer und schreibt ihn ins Log, falls das Level aktiv ist.
+            Aufrufer prüfen vorher active, damit die Felder nicht umsonst erstellt werden. '''
+        if self.records is not None:
+            self.records.append((level, event, fields))
+        if level >= self.level:
+            logging.log(level, "%s: %s", event, fields)
+
+    def dump(self, reason):
+        ''' Schreibt den Ringpuffer als Fehler ins Log, z.B. wenn eine Zeile nicht verbucht werden kann '''
+        if not self.records:
+            return
+
+        logging.error("%s, die letzten %d Einträge der Verbuchung:", reason, len(self.records))
+        for level, event, fields in self.records:
+            logging.error("  %s %s: %s", logging.getLevelName(level), event, fields)
+        self.records.clear()
@@ -0,0 +1,46 @@
+import os
+
+import pandas as pd
+import pytest
+
+import src.BookingStatementHandler as booking_statement_handler
+from src.BookingStatementHandler import BookingStatementHandler
+from src.StatementSchema import STATEMENT_OF_FUNDS_FIELDS, apply_schema
+from src.SyntheticStatement import SyntheticStatement
+
+SYNTHETIC_ACCOUNT = "U0000001"
+
+# Das erwartete Journal des synthetischen Berichts (Seed 11), die Beträge als Ganzzahlen (siehe FixedPoint)
+EXPECTED_JOURNAL_PATH = os.path.join(os.path.dirname(__file__), "data", "synthetic_journal.csv")
+
+
+def get_synthetic_statement():
+    ''' Der synthetische Kapitalflussbericht und die offenen Positionen des Vorjahres mit festem Seed '''
+    synthetic = SyntheticStatement((SYNTHETIC_ACCOUNT,), symbols=6, rows=400, seed=11)
+    data = apply_schema(pd.DataFrame(synthetic.generate(SYNTHETIC_ACCOUNT, 400), columns=STATEMENT_OF_FUNDS_FIELDS))
+    open_positions = apply_schema(pd.DataFrame(synthetic.get_open_positions(SYNTHETIC_ACCOUNT),
+                                               columns=STATEMENT_OF_FUNDS_FIELDS))
+    return data, open_positions
+
+
+@pytest.fixture
+def synthetic_bookings(tmp_path, monkeypatch):
+    ''' Verbucht den synthetischen Bericht im Arbeitsverzeichnis tmp_path, ohne Excel und Export '''
+    for directory in ("working_files", "export", "import"):
+        (tmp_path / directory).mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(booking_statement_handler, "save_to_excel", False)
+
+    data, open_positions = get_synthetic_statement()
+    bookings = BookingStatementHandler([SYNTHETIC_ACCOUNT], {SYNTHETIC_ACCOUNT: 1810}, "20210101", "20211231",
+                                       data=data, open_positions={SYNTHETIC_ACCOUNT: open_positions})
+    bookings.generate_booking_journal({}, export=False)
+    return bookings
+
+
+@pytest.fixture
+def expected_journal():
+    return pd.read_csv(EXPECTED_JOURNAL_PATH, sep=";", keep_default_na=False, parse_dates=["DATE", "SETTLEDATE"],
+                       dtype={"Account": object, "SATZ_ID": object, "DESC": object, "SUBDESC": object,
+                              "TEXT": object, "Belegnummer": "int64", "AMOUNT": "int64", "SOLL": "int64",
+                              "HABEN": "int64", "QUALITYREL": bool})
@@ -0,0 +1,30 @@
+import pandas as pd
+
+from src.BookingRules import FLAT, LONG, NO_POSITION, POSITION_STATES, SHORT, BookingRule, DispatchTable
+
+HANDLERS = ("posting", "posting_and_open", "fifo_close", "first_lot_close", "variant", "cfd_charge", "tracking",
+            "zero_tracking", "ignore", "error")
+
+
+def get_handler(key):
+    return DispatchTable({handler: handler for handler in HANDLERS}).get(key)[0]
+
+
+def test_specific_rules_take_precedence_over_any_category():
+    assert get_handler(("ASSIGN", "OPT", 0, LONG)) == "variant"
+    assert get_handler(("ASSIGN", "FOP", -1, NO_POSITION)) == "zero_tracking"
+    for state in (NO_POSITION, FLAT, LONG, SHORT):
+        assert get_handler(("ASSIGN", "STK", -1, state)) == "variant"
+
+
+def test_assign_of_other_categories_is_tracked_like_before():
+    ''' Im Ablauf vor der Tabelle wurden Zuteilungen z.B. von Futures ohne Buchung als bearbeitet gemerkt, wenn der
+        amount 0 war. Die Zeilen dürfen daher nicht als Kombination ohne Regel gelten. '''
+    for state in POSITION_STATES:
+        assert get_handler(("ASSIGN", "FUT", 0, state)) == "zero_tracking"
+
+    table = DispatchTable({handler: handler for handler in HANDLERS})
+    data = pd.DataFrame({"activityCode": ["ASSIGN", "ASSIGN", "EXP"], "assetCategory": ["FUT", "XYZ", "FUT"],
+                         "amount": [0.0, 0.0, 0.0]})
+    assert table.prepare(data) == {("EXP", "FUT", 0): 1}
+    assert table.get(("ASSIGN", "XYZ", 0, NO_POSITION))[1] == BookingRule("zero_tracking")
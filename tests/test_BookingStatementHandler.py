@@ -0,0 +1,31 @@
+import pandas as pd
+
+from tests.conftest import get_synthetic_statement
+
+STATELESS_CODES = {"DIV", "FRTAX", "CINT", "DINT", "BFEE", "OFEE", "STAX", "PIL", "FOREX", "CFD"}
+STATUS_LINES = ("Starting Balance", "FX Translations P&L", "Ending Balance")
+
+
+def test_stateless_rows_are_booked_like_the_expected_journal(synthetic_bookings, expected_journal):
+    ''' Die vorab mit Spaltenoperationen verbuchten Zeilen ergeben Zeile für Zeile die Buchungen des erwarteten
+        Journals, einschließlich TEXT und QUALITYREL. Die Zeilen mit offenen Positionen bleiben für book_rows. '''
+    data, _ = get_synthetic_statement()
+    data = data[~data["activityCode"].isin(["WITH", "DEP"]) & ~data["activityDescription"].isin(STATUS_LINES)]
+    data = data.sort_values("transactionID", kind="stable")
+
+    prebooked, _ = synthetic_bookings.generate_stateless_statements(data)
+    journal = synthetic_bookings.journal_buffer.to_dataframe()
+    journal["SETTLEDATE"] = journal["SETTLEDATE"].mask(journal["SETTLEDATE"].isna(), journal["DATE"])
+
+    booked = data[prebooked]
+    assert STATELESS_CODES <= set(booked["activityCode"])
+    # Käufe und Verkäufe von Futures und CFDs sind reine Zahlungen, Aktien und Optionen gehen über die Lots
+    assert not (booked["activityCode"].isin(["BUY", "SELL", "ASSIGN", "EXP"]) &
+                booked["assetCategory"].isin(["STK", "OPT", "FOP"])).any()
+
+    # book_rows kann später weitere Buchungen mit der selben Belegnummer erstellen (z.B. beim Schließen der
+    # Position), diese folgen im Journal nach den Buchungen aus dem Vorlauf
+    expected = expected_journal[expected_journal["Belegnummer"].isin(booked["transactionID"])]
+    prepass = expected.groupby("Belegnummer").cumcount() < expected["Belegnummer"].map(
+        journal["Belegnummer"].value_counts())
+    pd.testing.assert_frame_equal(journal, expected[prepass].reset_index(drop=True))
@@ -0,0 +1,78 @@
+import logging
+
+import pandas as pd
+import pytest
+
+import src.BookingStatementHandler as booking_statement_handler
+from src.BookingStatementHandler import BookingStatementHandler
+from src.StatementSchema import STATEMENT_OF_FUNDS_FIELDS, apply_schema
+from src.SyntheticStatement import SyntheticStatement
+
+ACCOUNT = "U0000001"
+
+
+@pytest.fixture
+def statement(tmp_path, monkeypatch):
+    ''' Ein synthetischer Kapitalflussbericht, verbucht wird im Arbeitsverzeichnis tmp_path '''
+    for directory in ("working_files", "export", "import"):
+        (tmp_path / directory).mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(booking_statement_handler, "save_to_excel", False)
+
+    synthetic = SyntheticStatement((ACCOUNT,), symbols=8, rows=600, seed=7)
+    data = apply_schema(pd.DataFrame(synthetic.generate(ACCOUNT, 600), columns=STATEMENT_OF_FUNDS_FIELDS))
+    open_positions = apply_schema(pd.DataFrame(synthetic.get_open_positions(ACCOUNT),
+                                               columns=STATEMENT_OF_FUNDS_FIELDS))
+    return data.sort_values("transactionID", kind="stable").reset_index(drop=True), open_positions
+
+
+def book(data, open_positions, incremental):
+    bookings = BookingStatementHandler([ACCOUNT], {ACCOUNT: 1810}, "20210101", "20211231", data=data,
+                                       open_positions={ACCOUNT: open_positions})
+    bookings.generate_booking_journal({}, incremental=incremental, export=False)
+    return bookings
+
+
+def get_open_positions(bookings):
+    open_positions = bookings.fifo_positions.to_dataframe()
+    return open_positions.sort_values("transactionID").reset_index(drop=True)
+
+
+def test_incremental_runs_equal_a_full_run(statement, caplog):
+    ''' Werden 30%, 60% und 100% der Zeilen nacheinander verbucht, entsprechen Journal, verarbeitete IDs und offene
+        Positionen einem kompletten Lauf, ohne dass ein Lauf komplett neu verbucht '''
+    data, open_positions = statement
+    full = book(data, open_positions, incremental=False)
+
+    caplog.set_level(logging.INFO)
+    for share in (0.3, 0.6, 1.0):
+        incremental = book(data.iloc[:int(len(data) * share)], open_positions, incremental=True)
+    assert "komplett neu verbucht" not in caplog.text
+    # Jeder Lauf hat nur seine neuen Buchungen an das abgelegte Journal angehängt
+    assert len(incremental.store.read_manifest("journal")["partitions"]) == 3
+    assert incremental.store.get_rows("journal", partitions=[ACCOUNT]) == len(full.journal)
+
+    pd.testing.assert_frame_equal(incremental.journal, full.journal)
+    pd.testing.assert_frame_equal(incremental.processed_registry.to_dataframe(ACCOUNT),
+                                  full.processed_registry.to_dataframe(ACCOUNT))
+    pd.testing.assert_frame_equal(get_open_positions(incremental), get_open_positions(full))
+    assert incremental.quality_checks == full.quality_checks
+
+
+def test_rows_without_transaction_id_are_rejected(statement, caplog):
+    ''' Zeilen ohne transactionID werden mit Meldung nicht verbucht und führen im nächsten Lauf nicht zu einer
+        kompletten Neuverbuchung '''
+    data, open_positions = statement
+    data = data.copy()
+    missing = data.index[(data.index >= len(data) // 2) & (data["amount"] != 0)][0]
+    data.loc[missing, "transactionID"] = pd.NA
+
+    caplog.set_level(logging.INFO)
+    first = book(data, open_positions, incremental=True)
+    assert "1 Einträge ohne transactionID werden nicht verbucht" in caplog.text
+    assert first.quality_checks[ACCOUNT] == "nicht erfolgreich"
+
+    caplog.clear()
+    second = book(data, open_positions, incremental=True)
+    assert "komplett neu verbucht" not in caplog.text
+    pd.testing.assert_frame_equal(second.journal, first.journal)
@@ -0,0 +1,51 @@
+from src.FifoLotStore import FifoLotStore
+from src.FixedPoint import to_fixed
+
+
+def lot(transactionID, symbol, quantity, amount):
+    return {"transactionID": transactionID, "symbol": symbol, "activityDescription": f"Buy {symbol}",
+            "tradeQuantity": quantity, "amount": amount, "date": "20210104"}
+
+
+def check_totals(store):
+    ''' Die mitgeführten Summen müssen immer der Summe über die Lots entsprechen '''
+    for symbol in store.by_symbol:
+        assert store.quantity_for_symbol(symbol) == sum(lot.tradeQuantity for lot in store.lots_for_symbol(symbol))
+    for description in store.by_description:
+        assert store.quantity_for_description(description) == \
+            sum(lot.tradeQuantity for lot in store.lots_for_description(description))
+    assert set(store.quantity_by_symbol) == set(store.by_symbol)
+    assert set(store.quantity_by_description) == set(store.by_description)
+
+
+def test_quantities_follow_append_update_and_close():
+    store = FifoLotStore()
+    store.append(lot(1, "AAA", 100, -1000.5))
+    store.append(lot(2, "AAA", 50, -600.25))
+    store.append(lot(3, "BBB", -20, 400.0))
+    check_totals(store)
+    assert store.quantity_for_symbol("AAA") == to_fixed(150)
+    assert store.quantity_for_description("Buy BBB") == to_fixed(-20)
+
+    store.update(1, "tradeQuantity", to_fixed(30))
+    check_totals(store)
+    assert store.quantity_for_symbol("AAA") == to_fixed(80)
+
+    store.close(1)
+    store.close(3)
+    check_totals(store)
+    assert store.quantity_for_symbol("AAA") == to_fixed(50)
+    assert not store.has_symbol("BBB") and store.quantity_for_symbol("BBB") == 0
+
+
+def test_lots_for_symbol_is_a_live_view_in_fifo_order():
+    store = FifoLotStore()
+    for transactionID in (1, 2, 3):
+        store.append(lot(transactionID, "AAA", 10, -100.0))
+    lots = store.lots_for_symbol("AAA")
+
+    assert [lot.transactionID for lot in lots] == [1, 2, 3]
+    store.update(2, "amount", to_fixed(-40.0))
+    store.close(1)
+    assert [(lot.transactionID, lot["amount"]) for lot in lots] == [(2, -40.0), (3, -100.0)]
+    assert store.to_dataframe()["transactionID"].tolist() == [2, 3]
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from src.ExportHandler import ExportHandler
+from src.FixedPoint import SCALE, from_fixed, scale_fixed, to_fixed, to_fixed_array
+from tests.conftest import SYNTHETIC_ACCOUNT, get_synthetic_statement
+from tests.test_BookingStatementHandler import STATUS_LINES
+
+
+def test_journal_amounts_are_scaled_integers(synthetic_bookings, expected_journal):
+    ''' Das Journal führt die Beträge als Ganzzahlen in Einheiten von 1 / SCALE wie im erwarteten Journal, der
+        Quality Check stimmt damit ohne Rundung exakt '''
+    journal = synthetic_bookings.journal
+    assert journal["AMOUNT"].dtype == np.int64
+    pd.testing.assert_series_equal(journal["AMOUNT"], expected_journal["AMOUNT"])
+
+    data, _ = get_synthetic_statement()
+    data = data[~data["activityCode"].isin(["WITH", "DEP"]) & ~data["activityDescription"].isin(STATUS_LINES)]
+    relevant = journal.loc[journal["QUALITYREL"], "AMOUNT"]
+    assert int(relevant.abs().sum()) == int(np.abs(to_fixed_array(data["amount"])).sum())
+    assert synthetic_bookings.quality_checks == {SYNTHETIC_ACCOUNT: "erfolgreich"}
+
+
+def test_amounts_are_converted_only_at_export(expected_journal):
+    ''' Der Export wandelt die Ganzzahlen in Beträge um, ohne Nachkommastellen zu verlieren '''
+    betrag = ExportHandler("export").format_MSBuchhalter(expected_journal)["Betrag"]
+
+    amounts = betrag.str.replace(",", ".", regex=False).astype(float)
+    np.testing.assert_array_equal(to_fixed_array(amounts), expected_journal["AMOUNT"].to_numpy())
+
+
+def test_conversions():
+    assert to_fixed(1694.46666667) == 169446666667
+    assert to_fixed(float("nan")) == 0
+    assert from_fixed(to_fixed(-0.1) * 3) == -0.3
+    assert to_fixed_array([0.1, None, -2.5]).tolist() == [SCALE // 10, 0, -25 * SCALE // 10]
+    # Halbe Einheiten werden wie bei round() auf die gerade Zahl gerundet
+    assert scale_fixed(5, 1, 2) == 2 and scale_fixed(7, 1, 2) == 4 and scale_fixed(-5, 1, -2) == 2
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from src import FlexDownloader as flex_downloader
+from src.FlexDownloader import CHUNK_SIZE, FlexDownloader, FlexError
+from src.FlexStubServer import FlexStubServer
+
+TOKEN = "token"
+
+
+def write_statement(directory, query_id, lines=2000):
+    ''' Schreibt einen Bericht, der größer als ein Block (CHUNK_SIZE) ist, und gibt den Inhalt zurück '''
+    body = "".join(f'<StatementOfFundsLine transactionID="{query_id}{index:06d}" amount="{index}.5" />\n'
+                   for index in range(lines))
+    data = f'<FlexQueryResponse queryName="{query_id}" type="AF">\n{body}</FlexQueryResponse>\n'.encode("utf-8")
+    with open(os.path.join(directory, f"{query_id}.xml"), "wb") as file:
+        file.write(data)
+    return data
+
+
+@pytest.fixture
+def statements(tmp_path):
+    source = tmp_path / "stub"
+    source.mkdir()
+    return source, {query_id: write_statement(source, query_id) for query_id in ("111", "222", "333")}
+
+
+def get_downloader(server, directory, **kwargs):
+    options = dict(poll_interval=0.01, max_interval=0.05, timeout=10.0, request_timeout=5.0)
+    options.update(kwargs)
+    return FlexDownloader(TOKEN, str(directory), url=server.url, **options)
+
+
+def test_downloads_all_queries_concurrently(statements, tmp_path, monkeypatch):
+    ''' Alle Queries werden gleichzeitig angefordert und in der Reihenfolge der Queries zurückgegeben '''
+    source, contents = statements
+    target = tmp_path / "import"
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(contents), timeout=5)
+    fetch = FlexDownloader.fetch
+
+    def counting_fetch(self, url):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        try:
+            # SendRequest aller Queries muss gleichzeitig laufen, sonst läuft die Barriere in den Timeout
+            if ".SendRequest" in url:
+                barrier.wait()
+            return fetch(self, url)
+        finally:
+            with lock:
+                running["now"] -= 1
+
+    monkeypatch.setattr(FlexDownloader, "fetch", counting_fetch)
+
+    with FlexStubServer(str(source), token=TOKEN, pending=1) as server:
+        paths = get_downloader(server, target, max_concurrent=len(contents)).run(list(contents))
+
+    assert paths == [str(target / f"Flex_{query_id}.xml") for query_id in contents]
+    for query_id, path in zip(contents, paths):
+        with open(path, "rb") as file:
+            assert file.read() == contents[query_id]
+    assert running["max"] == len(contents)
+
+
+def test_max_concurrent_limits_requests(statements, tmp_path, monkeypatch):
+    source, contents = statements
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    fetch = FlexDownloader.fetch
+
+    def counting_fetch(self, url):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        try:
+            return fetch(self, url)
+        finally:
+            with lock:
+                running["now"] -= 1
+
+    monkeypatch.setattr(FlexDownloader, "fetch", counting_fetch)
+
+    with FlexStubServer(str(source), token=TOKEN, pending=1) as server:
+        get_downloader(server, tmp_path / "import", max_concurrent=1).run(list(contents))
+
+    assert running["max"] == 1
+
+
+def test_retries_with_backoff_until_statement_is_ready(statements, tmp_path, monkeypatch):
+    ''' Solange der Stub 1019 meldet, wird mit doppeltem Abstand (höchstens max_interval) erneut gefragt '''
+    source, contents = statements
+    delays = []
+    sleep = asyncio.sleep
+
+    async def recording_sleep(delay):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(flex_downloader.asyncio, "sleep", recording_sleep)
+
+    with FlexStubServer(str(source), token=TOKEN, pending=3) as server:
+        path, = get_downloader(server, tmp_path / "import", poll_interval=0.01, max_interval=0.03).run(["111"])
+        requests = list(server.references.values())
+
+    assert requests == [["111", 4]]
+    assert delays == pytest.approx([0.01, 0.02, 0.03, 0.03])
+    with open(path, "rb") as file:
+        assert file.read() == contents["111"]
+
+
+def test_writes_part_file_and_renames_when_complete(statements, tmp_path, monkeypatch):
+    source, contents = statements
+    target = tmp_path / "import"
+    renamed = []
+    replace = os.replace
+
+    def recording_replace(source_path, target_path):
+        # Beim Umbenennen ist der Bericht komplett in der .part-Datei und die Zieldatei gibt es noch nicht
+        with open(source_path, "rb") as file:
+            assert file.read() == contents["222"]
+        assert not os.path.exists(target_path)
+        renamed.append((source_path, target_path))
+        replace(source_path, target_path)
+
+    monkeypatch.setattr(flex_downloader.os, "replace", recording_replace)
+
+    with FlexStubServer(str(source), token=TOKEN, pending=0) as server:
+        path, = get_downloader(server, target).run(["222"])
+
+    assert len(contents["222"]) > CHUNK_SIZE
+    assert renamed == [(path + ".part", path)]
+    assert sorted(os.listdir(target)) == ["Flex_222.xml"]
+
+
+def test_timeout_leaves_no_file(statements, tmp_path):
+    ''' Wird der Bericht nicht rechtzeitig fertig, kommt der Fehler von IB und es bleibt keine Datei liegen '''
+    source, _ = statements
+    target = tmp_path / "import"
+
+    with FlexStubServer(str(source), token=TOKEN, pending=1000) as server:
+        with pytest.raises(FlexError) as error:
+            get_downloader(server, target, timeout=0.1).run(["111", "222"])
+
+    assert error.value.code == "1019"
+    assert os.listdir(target) == []
+
+
+def test_errors_are_not_retried(statements, tmp_path):
+    source, _ = statements
+
+    with FlexStubServer(str(source), token=TOKEN) as server:
+        with pytest.raises(FlexError) as error:
+            FlexDownloader("wrong", str(tmp_path / "import"), url=server.url, poll_interval=0.01).run(["111"])
+        assert error.value.code == "1012"
+
+        with pytest.raises(FlexError) as error:
+            get_downloader(server, tmp_path / "import").run(["999"])
+        assert error.value.code == "1014"
+        assert server.references == {}
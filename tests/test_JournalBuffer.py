@@ -0,0 +1,25 @@
+import pandas as pd
+
+from src.JournalBuffer import JOURNAL_COLUMNS, JournalBuffer
+
+
+def test_journal_matches_expected_frame(synthetic_bookings, expected_journal):
+    ''' Das aus dem Buffer erstellte Journal hat die Spalten, die Reihenfolge und die Werte des erwarteten
+        Journals (tests/data/synthetic_journal.csv) '''
+    journal = synthetic_bookings.journal
+
+    assert list(journal.columns) == JOURNAL_COLUMNS
+    pd.testing.assert_frame_equal(journal, expected_journal)
+
+
+def test_blocks_are_sorted_back_by_row_position(expected_journal):
+    ''' Einzelne Buchungssätze und vorab verbuchte Blöcke kommen in der Reihenfolge ihrer Zeilen zurück '''
+    buffer = JournalBuffer()
+    records = expected_journal.to_dict("records")
+    buffer.extend(expected_journal.iloc[1::2], list(range(1, len(records), 2)))
+    for position in range(0, len(records), 2):
+        buffer.position = position
+        buffer.append(records[position])
+
+    assert len(buffer) == len(records)
+    pd.testing.assert_frame_equal(buffer.to_dataframe(), expected_journal)